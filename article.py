@@ -0,0 +1,112 @@
+from collections import namedtuple
+from typing import Optional
+
+# Sub-records are tuples: a handful of pointers each, instead of a dict (plus an empty affiliations list
+# per author) for every author, keyword, grant and MeSH heading of every article.
+
+class Author(namedtuple('Author', ['name'])):
+    __slots__ = ()
+
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'affiliations': []}
+
+
+class Keyword(namedtuple('Keyword', ['name', 'major_topic'])):
+    __slots__ = ()
+
+    def to_dict(self) -> dict:
+        return {'majorTopic': self.major_topic, 'name': self.name}
+
+
+class Grant(namedtuple('Grant', ['grant_id', 'grant_country', 'agency'])):
+    __slots__ = ()
+
+    def to_dict(self) -> dict:
+        return {'grant_id': self.grant_id, 'grant_country': self.grant_country, 'agency': self.agency}
+
+
+class MeshHeading(namedtuple('MeshHeading', ['name', 'major_topic'])):
+    __slots__ = ()
+
+    def to_dict(self) -> dict:
+        return {'majorTopic': self.major_topic, 'name': self.name}
+
+
+class Article:
+    '''
+    One citation, as parsed from the XML or rebuilt from MySQL. Slotted, with the list fields held as
+    tuples of the records above, so a file's worth of articles costs a fraction of the equivalent dicts.
+    Writers serialize it directly (SQLManager.get_article_row, ElasticPush.generate_dict); to_dict()
+    gives the parse_article() dict shape, which is also what the content hash is computed over.
+    A deleted citation is an Article with only pubmed_id, version and deleted=True.
+    `xml` is the serialized <PubmedArticle> the record was parsed from, kept only when the article cache
+    needs it (see parse_xml.iter_articles); it isn't content, so equality ignores it.
+    '''
+    __slots__ = ('pubmed_id', 'title', 'pub_date', 'accepted_date', 'received_date', 'authors', 'keywords', 'grants',
+                 'mesh_headings', 'abstract', 'doi', 'journal', 'nlm_unique_id', 'pub_types', 'version', 'deleted', 'xml')
+    CONTENT_SLOTS = __slots__[:-1]
+
+    def __init__(self, pubmed_id: str, title: str = '', pub_date: str = '', accepted_date: str = '', received_date: str = '',
+                 authors: tuple = (), keywords: tuple = (), grants: tuple = (), mesh_headings: tuple = (), abstract: str = '',
+                 doi: Optional[str] = None, journal: str = '', nlm_unique_id: Optional[str] = None, pub_types: tuple = (),
+                 version: int = 0, deleted: bool = False, xml: Optional[bytes] = None):
+        self.pubmed_id = pubmed_id
+        self.title = title
+        self.pub_date = pub_date
+        self.accepted_date = accepted_date
+        self.received_date = received_date
+        self.authors = authors
+        self.keywords = keywords
+        self.grants = grants
+        self.mesh_headings = mesh_headings
+        self.abstract = abstract
+        self.doi = doi
+        self.journal = journal
+        self.nlm_unique_id = nlm_unique_id
+        self.pub_types = pub_types
+        self.version = version
+        self.deleted = deleted
+        self.xml = xml
+
+    @staticmethod
+    def deleted_record(pubmed_id: str, version: int = 0) -> 'Article':
+        return Article(pubmed_id, version=version, deleted=True)
+
+    # Writes the article's fields into `d` (a new dict by default) in parse_article() order, leaving out
+    # the optional ones it doesn't have. `version` is left to the caller, since it isn't content.
+    def to_dict(self, d: Optional[dict] = None) -> dict:
+        if d is None:
+            d = {}
+        d['pubmed_id'] = self.pubmed_id
+        if self.deleted:
+            d['deleted'] = True
+            return d
+        d['title'] = self.title
+        d['pub_date'] = self.pub_date
+        if self.accepted_date:
+            d['accepted_date'] = self.accepted_date
+        if self.received_date:
+            d['received_date'] = self.received_date
+        if self.authors:
+            d['authors'] = [author.to_dict() for author in self.authors]
+        if self.keywords:
+            d['keywords'] = [keyword.to_dict() for keyword in self.keywords]
+        if self.grants:
+            d['grants'] = [grant.to_dict() for grant in self.grants]
+        if self.mesh_headings:
+            d['mesh_headings'] = [mesh_heading.to_dict() for mesh_heading in self.mesh_headings]
+        d['abstract'] = self.abstract
+        if self.doi is not None:
+            d['doi'] = self.doi
+        d['journal'] = self.journal
+        d['nlm_unique_id'] = self.nlm_unique_id
+        d['pub_types'] = list(self.pub_types)
+        return d
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Article):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in Article.CONTENT_SLOTS)
+
+    def __repr__(self) -> str:
+        return f'Article(pubmed_id={self.pubmed_id!r}, version={self.version!r}, deleted={self.deleted!r})'
@@ -0,0 +1,395 @@
+from collections import namedtuple
+import fcntl
+import glob
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+import threading
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from article import Article, Author, Grant, Keyword, MeshHeading
+from utils import Utils
+
+# Cache files start with MAGIC, the format version and marshal's version (marshal output is only
+# guaranteed to be readable by the same marshal version), followed by length-prefixed records.
+# Version 2 added each record's source XML.
+MAGIC = b'MBAC'
+FORMAT_VERSION = 2
+HEADER = MAGIC + struct.pack('<BB', FORMAT_VERSION, marshal.version)
+RECORD_LENGTH = struct.Struct('<I')
+CACHE_SUFFIX = '.mbac'
+
+# Default size budget for ArticleCache.
+ARTICLE_CACHE_MAX_BYTES = 20 * 1024 * 1024 * 1024
+
+# ArticleIndex: one slot per PMID of (file id, offset, length, version), little-endian uint32s; file id 0
+# is an empty slot. The table grows INDEX_GROW_SLOTS slots at a time.
+INDEX_SLOT = struct.Struct('<IIII')
+INDEX_GROW_SLOTS = 1 << 20
+INDEX_FILE = 'pmid.idx'
+# Line n of the files table is file id n: "<PubMed file name>\t<cache entry name>".
+INDEX_FILES_FILE = 'pmid.files'
+UINT32_MAX = 2**32 - 1
+
+# Where the newest cached record of a PMID is: its PubMed file, the cache entry, and the record's bytes in it.
+IndexEntry = namedtuple('IndexEntry', ['file_name', 'path', 'offset', 'length', 'version'])
+
+# Article <-> a tuple of plain values marshal can write (sub-records become plain tuples), source XML included.
+def encode_article(article: Article) -> bytes:
+    return marshal.dumps((
+        article.pubmed_id, article.title, article.pub_date, article.accepted_date, article.received_date,
+        tuple(map(tuple, article.authors)), tuple(map(tuple, article.keywords)), tuple(map(tuple, article.grants)),
+        tuple(map(tuple, article.mesh_headings)), article.abstract, article.doi, article.journal, article.nlm_unique_id,
+        tuple(article.pub_types), article.version, article.deleted, article.xml,
+    ))
+
+def decode_article(data: bytes) -> Article:
+    (pubmed_id, title, pub_date, accepted_date, received_date, authors, keywords, grants, mesh_headings, abstract,
+     doi, journal, nlm_unique_id, pub_types, version, deleted, xml) = marshal.loads(data)
+    return Article(pubmed_id, title, pub_date, accepted_date, received_date, tuple(map(Author._make, authors)),
+                   tuple(map(Keyword._make, keywords)), tuple(map(Grant._make, grants)),
+                   tuple(map(MeshHeading._make, mesh_headings)), abstract, doi, journal, nlm_unique_id, pub_types,
+                   version, deleted, xml)
+
+
+class ChecksumReader:
+    '''
+    Wraps a raw .gz file object and md5s every byte read from it, so gzip reading the file for the parser
+    also produces its cache checksum. hexdigest() reads whatever the parser left unread first.
+    '''
+    def __init__(self, fileobj, chunk_size: int = 1024 * 1024):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.md5 = hashlib.md5()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.md5.update(data)
+        return data
+
+    def hexdigest(self) -> str:
+        for _ in iter(lambda: self.read(self.chunk_size), b''):
+            pass
+        return self.md5.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+class ArticleIndex:
+    '''
+    PMID -> IndexEntry for every record ArticleCache wrote, as a memory-mapped table with a fixed-size
+    slot at offset pmid * 16, so a lookup is one slot read and an update one slot write. The file is
+    sparse: slots for PMIDs that were never written take no disk space. A slot is only overwritten by a
+    record with the same or a newer version, so it always points at the newest record seen.
+    `entries_dir` is where the cache entries named in the files table live.
+    Several processes can share the index: add() holds an flock on the files table while it takes the next
+    file id from the table on disk and writes the slots, and lookup() reloads the table (and the mapping)
+    when another process added to them.
+    '''
+    def __init__(self, index_dir: str, entries_dir: str):
+        self.index_dir = index_dir
+        self.entries_dir = entries_dir
+        self.lock = threading.Lock()
+        self.files = [None]
+        self.files_path = os.path.join(index_dir, INDEX_FILES_FILE)
+        if os.path.exists(self.files_path):
+            self.reload_files()
+        index_path = os.path.join(index_dir, INDEX_FILE)
+        self.index_file = open(index_path, 'r+b' if os.path.exists(index_path) else 'w+b')
+        self.mmap = None
+        self.remap()
+
+    # Reads the files table from `f` (open on files_path), or under a shared flock if no `f` is given.
+    def reload_files(self, f=None):
+        if f is None:
+            with open(self.files_path, encoding='utf-8') as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                self.reload_files(f)
+            return
+        f.seek(0)
+        self.files = [None] + [tuple(line.rstrip('\n').split('\t')) for line in f]
+
+    def remap(self):
+        if self.mmap is not None:
+            self.mmap.close()
+        size = os.fstat(self.index_file.fileno()).st_size
+        self.mmap = mmap.mmap(self.index_file.fileno(), size) if size else None
+
+    # Another process may have grown the file since it was mapped, so this goes by the file's size
+    # (len() of the mapping is what this process can see; mmap.size() is the file's current size).
+    def grow(self, max_pubmed_id: int):
+        size = os.fstat(self.index_file.fileno()).st_size
+        needed = (max_pubmed_id + 1) * INDEX_SLOT.size
+        if needed > size:
+            slots = -(-(max_pubmed_id + 1) // INDEX_GROW_SLOTS) * INDEX_GROW_SLOTS
+            self.index_file.truncate(slots * INDEX_SLOT.size)
+        if self.mmap is None or len(self.mmap) != os.fstat(self.index_file.fileno()).st_size:
+            self.remap()
+
+    def indexed_entries(self) -> set:
+        with self.lock:
+            if os.path.exists(self.files_path):
+                self.reload_files()
+            return {entry_name for _, entry_name in self.files[1:]}
+
+    # Points the PMIDs of `records` ((pubmed_id, offset, length, version) tuples) at cache entry `path` of `file_name`.
+    def add(self, file_name: str, path: str, records: Iterable[tuple]):
+        records = [(int(pubmed_id), offset, length, min(version, UINT32_MAX))
+                   for pubmed_id, offset, length, version in records if str(pubmed_id).isdigit()]
+        if not records:
+            return
+        entry_name = os.path.basename(path)
+        with self.lock, open(self.files_path, 'a+', encoding='utf-8') as f:
+            # Released when f is closed. The file id is the entry's line in the table on disk, whatever
+            # other processes appended since this one last read it.
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self.reload_files(f)
+            f.write(f'{os.path.basename(file_name)}\t{entry_name}\n')
+            f.flush()
+            self.files.append((os.path.basename(file_name), entry_name))
+            file_id = len(self.files) - 1
+            self.grow(max(pubmed_id for pubmed_id, _, _, _ in records))
+            for pubmed_id, offset, length, version in records:
+                position = pubmed_id * INDEX_SLOT.size
+                current_file_id, _, _, current_version = INDEX_SLOT.unpack_from(self.mmap, position)
+                if current_file_id and current_version > version:
+                    continue
+                INDEX_SLOT.pack_into(self.mmap, position, file_id, offset, length, version)
+            self.mmap.flush()
+
+    def lookup(self, pubmed_id) -> Optional[IndexEntry]:
+        pubmed_id = int(pubmed_id)
+        with self.lock:
+            position = pubmed_id * INDEX_SLOT.size
+            if pubmed_id < 0:
+                return None
+            if self.mmap is None or position + INDEX_SLOT.size > len(self.mmap):
+                # Grown by another process?
+                if position + INDEX_SLOT.size > os.fstat(self.index_file.fileno()).st_size:
+                    return None
+                self.remap()
+            file_id, offset, length, version = INDEX_SLOT.unpack_from(self.mmap, position)
+            if not file_id:
+                return None
+            if file_id >= len(self.files):
+                self.reload_files()
+                if file_id >= len(self.files):
+                    return None
+            file_name, entry_name = self.files[file_id]
+        return IndexEntry(file_name, os.path.join(self.entries_dir, entry_name), offset, length, version)
+
+    def close(self):
+        with self.lock:
+            if self.mmap is not None:
+                self.mmap.close()
+                self.mmap = None
+            self.index_file.close()
+
+
+class ArticleCache:
+    '''
+    Parsed records of whole PubMed files, kept on disk as `<file name>.<md5 of the .gz>.mbac` so a file
+    can be pushed again without downloading or parsing it. Entries are written to a temp file and only
+    renamed into place once the whole file went through tee(). Each entry's mtime is its last use:
+    when the directory grows past `max_bytes` the least recently used entries are deleted.
+    Every finished entry is added to `index` (an ArticleIndex in `<cache_dir>/index`), so a single
+    record can be read back by PMID with find_article().
+    '''
+    def __init__(self, cache_dir: str, max_bytes: int = ARTICLE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(cache_dir, 'index'), exist_ok=True)
+        self.index = ArticleIndex(os.path.join(cache_dir, 'index'), cache_dir)
+
+    @staticmethod
+    def file_checksum(path: str, chunk_size: int = 1024 * 1024) -> str:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    def get_path(self, file_name: str, checksum: str) -> str:
+        return os.path.join(self.cache_dir, f'{os.path.basename(file_name)}.{checksum}{CACHE_SUFFIX}')
+
+    # The entry for `file_name` with `checksum`, or with no checksum (the .gz is gone), its newest entry.
+    def find(self, file_name: str, checksum: Optional[str] = None) -> Optional[str]:
+        if checksum:
+            path = self.get_path(file_name, checksum)
+            return path if os.path.exists(path) else None
+        pattern = os.path.join(glob.escape(self.cache_dir), glob.escape(os.path.basename(file_name)) + '.*' + CACHE_SUFFIX)
+        paths = glob.glob(pattern)
+        return max(paths, key=os.path.getmtime) if paths else None
+
+    def iter_articles(self, path: str) -> Iterator[Article]:
+        os.utime(path)
+        with open(path, 'rb') as f:
+            if f.read(len(HEADER)) != HEADER:
+                raise ValueError(f'{path} was written by a different cache format or Python version')
+            while True:
+                prefix = f.read(RECORD_LENGTH.size)
+                if not prefix:
+                    return
+                (length,) = RECORD_LENGTH.unpack(prefix)
+                data = f.read(length)
+                if len(data) != length:
+                    raise ValueError(f'{path} is truncated')
+                yield decode_article(data)
+
+    # Cached records of `file_name` in lists of at most `batch_size`, or None if there's no usable entry.
+    def iter_batches(self, file_name: str, batch_size: int, checksum: Optional[str] = None) -> Optional[Iterator[List[Article]]]:
+        path = self.find(file_name, checksum)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            if f.read(len(HEADER)) != HEADER:
+                Utils.print(f'Ignoring cache entry {path}: written by a different format or Python version.', color='red')
+                return None
+        return ArticleCache.batch(self.iter_articles(path), batch_size)
+
+    @staticmethod
+    def batch(articles: Iterable[Article], batch_size: int) -> Iterator[List[Article]]:
+        batch = []
+        for article in articles:
+            batch.append(article)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    # Passes `batches` through while writing their records to the entry for `file_name`. The entry only
+    # appears once the last batch went through, under the checksum `get_checksum()` returns then (see
+    # ChecksumReader); if the consumer stops early or parsing fails, the partial file is discarded.
+    # The cache is optional: if writing, indexing or evicting fails (a full disk, another process evicting
+    # the same entry), that's logged and the batches keep coming; only errors from `batches` itself propagate.
+    def tee(self, file_name: str, get_checksum: Callable[[], str], batches: Iterable[List[Article]]) -> Iterator[List[Article]]:
+        tmp_path = os.path.join(self.cache_dir, f'{os.path.basename(file_name)}.{os.getpid()}.{threading.get_ident()}.tmp')
+        path = None
+        records = []  # (pubmed_id, offset, length, version) for the index
+        f = None
+        try:
+            try:
+                f = open(tmp_path, 'wb')
+                f.write(HEADER)
+                offset = len(HEADER)
+            except Exception as e:
+                f = self.stop_caching(file_name, f, e)
+            for batch in batches:
+                if f is not None:
+                    try:
+                        for article in batch:
+                            data = encode_article(article)
+                            f.write(RECORD_LENGTH.pack(len(data)))
+                            f.write(data)
+                            offset += RECORD_LENGTH.size
+                            records.append((article.pubmed_id, offset, len(data), article.version))
+                            offset += len(data)
+                    except Exception as e:
+                        f = self.stop_caching(file_name, f, e)
+                yield batch
+            if f is not None:
+                try:
+                    f.close()
+                    path = self.get_path(file_name, get_checksum())
+                    os.replace(tmp_path, path)
+                except Exception as e:
+                    f = self.stop_caching(file_name, f, e)
+                    path = None
+        finally:
+            if f is not None and not f.closed:
+                f.close()
+            if path is None and os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+        if path is None:
+            return
+        try:
+            self.index.add(file_name, path, records)
+            self.evict(keep=path)
+        except Exception as e:
+            Utils.print(f'Error indexing cache entry {path}: {e}', color='red')
+
+    # Gives up on caching the file `f` was writing; returns the None that tee() keeps in place of `f`.
+    @staticmethod
+    def stop_caching(file_name: str, f, e: Exception):
+        Utils.print(f'Error writing {file_name} to the article cache, not caching it: {e}', color='red')
+        if f is not None:
+            try:
+                f.close()
+            except OSError:
+                pass
+        return None
+
+    # Indexes entries that were cached before the index existed (or whose index was deleted).
+    def index_existing_entries(self) -> int:
+        indexed = self.index.indexed_entries()
+        num_entries = 0
+        for name in sorted(os.listdir(self.cache_dir)):
+            if not name.endswith(CACHE_SUFFIX) or name in indexed:
+                continue
+            path = os.path.join(self.cache_dir, name)
+            with open(path, 'rb') as f:
+                if f.read(len(HEADER)) != HEADER:
+                    continue
+                records, offset = [], len(HEADER)
+                while True:
+                    prefix = f.read(RECORD_LENGTH.size)
+                    if len(prefix) < RECORD_LENGTH.size:
+                        break
+                    (length,) = RECORD_LENGTH.unpack(prefix)
+                    offset += RECORD_LENGTH.size
+                    article = decode_article(f.read(length))
+                    records.append((article.pubmed_id, offset, length, article.version))
+                    offset += length
+            # <file name>.<checksum>.mbac
+            self.index.add(name[:-len(CACHE_SUFFIX)].rsplit('.', 1)[0], path, records)
+            num_entries += 1
+        return num_entries
+
+    # The newest cached record of `pubmed_id`, read straight from its offset, or None if it was never cached
+    # or its entry has been evicted since.
+    def find_article(self, pubmed_id) -> Optional[Article]:
+        entry = self.index.lookup(pubmed_id)
+        if entry is None:
+            return None
+        try:
+            with open(entry.path, 'rb') as f:
+                if f.read(len(HEADER)) != HEADER:
+                    return None
+                f.seek(entry.offset)
+                data = f.read(entry.length)
+        except FileNotFoundError:
+            return None
+        os.utime(entry.path)
+        return decode_article(data)
+
+    # Deletes least recently used entries until the cache fits in max_bytes (`keep` is never deleted).
+    def evict(self, keep: Optional[str] = None):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(CACHE_SUFFIX):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Evicted by another process since the listing.
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                Utils.print('Evicted', path, 'from the article cache')
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
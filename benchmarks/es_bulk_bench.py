@@ -0,0 +1,82 @@
+'''
+Time to build one Elasticsearch bulk body: turn `chunk_size` articles into actions and serialize them to
+NDJSON the way helpers.streaming_bulk does (one metadata line and one source line per document).
+
+  per_doc:  two utcnow() calls and a strptime/strftime round trip of pub_date per document, stdlib JSON
+            (what generate_dict did before)
+  batched:  one timestamp per batch, pub_date passed through, stdlib JSON
+  fast:     batched, serialized with FastJsonSerializer (needs orjson)
+
+    python -m benchmarks.es_bulk_bench pubmed24n0001.xml.gz --chunk-size 15000 --repeat 5
+'''
+import argparse
+from datetime import datetime
+from itertools import cycle, islice
+import time
+
+from elastic_transport import JsonSerializer, NdjsonSerializer
+from elasticsearch.helpers import expand_action
+
+from elasticsearch_post import FAST_JSON_SERIALIZER, ElasticPush, FastNdjsonSerializer
+from parse_xml import parse_file
+
+
+# The strptime/strftime round trip generate_dict used to put every pub_date through.
+def fixed_pub_date(pub_date):
+    if pub_date:
+        try:
+            return datetime.strptime(pub_date, '%Y-%m-%d').strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    return None
+
+def per_doc_actions(ep: ElasticPush, articles):
+    for article in articles:
+        d = ep.generate_dict(article, datetime.utcnow().isoformat())
+        if not article.deleted:
+            d['@last_update'] = datetime.utcnow().isoformat()
+            d['pub_date'] = fixed_pub_date(article.pub_date)
+        yield d
+
+# Serializes actions line by line, then joins them into the request body.
+def build_body(actions, serializer, ndjson_serializer) -> bytes:
+    lines = []
+    for action in actions:
+        meta, source = expand_action(action)
+        lines.append(serializer.dumps(meta))
+        if source is not None:
+            lines.append(serializer.dumps(source))
+    return ndjson_serializer.dumps(lines)
+
+# Best-of-`repeat` milliseconds for one body, and its size.
+def time_body(make_actions, serializer, ndjson_serializer, repeat: int):
+    best, size = float('inf'), 0
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        body = build_body(make_actions(), serializer, ndjson_serializer)
+        best = min(best, time.perf_counter() - start_time)
+        size = len(body)
+    return round(best * 1000, 1), size
+
+def run(file_name: str, chunk_size: int = 15000, repeat: int = 5) -> dict:
+    articles = list(islice(cycle(parse_file(file_name)), chunk_size))
+    ep = ElasticPush(es=object())
+    json_serializer, ndjson_serializer = JsonSerializer(), NdjsonSerializer()
+    results = {'file': file_name, 'chunk_size': len(articles)}
+    results['per_doc_ms'], results['body_bytes'] = time_body(lambda: per_doc_actions(ep, articles), json_serializer, ndjson_serializer, repeat)
+    results['batched_ms'], _ = time_body(lambda: ep.iter_actions(articles), json_serializer, ndjson_serializer, repeat)
+    if FAST_JSON_SERIALIZER is not None:
+        results['fast_ms'], _ = time_body(lambda: ep.iter_actions(articles), FAST_JSON_SERIALIZER, FastNdjsonSerializer(), repeat)
+        results['speedup'] = round(results['per_doc_ms'] / results['fast_ms'], 2)
+    else:
+        results['fast_ms'] = 'orjson not installed'
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file_name', help='.xml or .xml.gz PubMed file')
+    parser.add_argument('--chunk-size', type=int, default=15000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    for key, value in run(args.file_name, args.chunk_size, args.repeat).items():
+        print(f'{key}: {value}')
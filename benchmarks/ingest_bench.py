@@ -0,0 +1,166 @@
+'''
+End-to-end ingest benchmark on a synthetic file (see benchmarks.synthetic), with no NCBI download and no
+live cluster. Times each stage over the whole file and reports records/sec and the tracemalloc peak. Every
+stage counts the same records, the file's articles plus its deleted citations, which is what the writers get:
+
+  parse:          parse_file(), whose records the write stages then consume
+  mysql:          SQLManager.push_pubmed_articles() against a local MySQL/MariaDB (only with --mysql-database)
+  elasticsearch:  ElasticPush.bulk_insert() against tests.fake_elasticsearch (serialization, chunking
+                  and the AdaptiveLimiter are real; --es-latency-ms adds a delay per bulk request)
+
+Results are written as JSON (with the commit, Python version and parameters) so runs can be compared;
+--compare prints the change against an earlier result and exits non-zero if a stage got slower by more
+than --max-regression.
+
+    python -m benchmarks.ingest_bench --articles 30000 --gzip --output before.json
+    python -m benchmarks.ingest_bench --articles 30000 --gzip --output after.json --compare before.json
+'''
+import argparse
+from datetime import datetime
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.synthetic import write_pubmed_file
+from db_manager import SQLManager
+from elasticsearch_post import ElasticPush
+from parse_xml import parse_file
+from tests.fake_elasticsearch import fake_client
+
+
+# Runs `stage` `repeat` times and once more under tracemalloc (unless `trace_memory` is off); the time is the best run.
+def measure(stage, repeat: int, trace_memory: bool) -> dict:
+    best, records, ok = float('inf'), 0, True
+    for _ in range(repeat):
+        gc.collect()
+        start_time = time.perf_counter()
+        records, ok = stage()
+        best = min(best, time.perf_counter() - start_time)
+    result = {
+        'seconds': round(best, 3),
+        'records': records,
+        'records_per_sec': round(records / best, 1) if best else 0.0,
+        'ok': ok,
+    }
+    if trace_memory:
+        gc.collect()
+        tracemalloc.start()
+        stage()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['peak_traced_mib'] = round(peak / 2**20, 1)
+    return result
+
+def get_commit() -> str:
+    try:
+        repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args) -> dict:
+    results = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'mysql_password')},
+        'stages': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # The name gives parse_xml.get_file_version() a version, like a real file's.
+        path = os.path.join(tmp_dir, 'pubmed99n0001.xml' + ('.gz' if args.gzip else ''))
+        start_time = time.perf_counter()
+        results['file'] = write_pubmed_file(path, args.articles, args.authors, args.mesh, args.grants, args.keywords,
+                                            args.deletes, seed=args.seed)
+        results['file']['generate_seconds'] = round(time.perf_counter() - start_time, 3)
+        results['file']['path'] = os.path.basename(path)
+
+        articles = None
+        def parse():
+            nonlocal articles
+            articles = None  # so the previous run's records don't count towards this one's memory
+            articles = parse_file(path)
+            return len(articles), True
+        results['stages']['parse'] = measure(parse, args.repeat, not args.no_memory)
+        num_deletes = sum(1 for article in articles if article.deleted)
+        results['records'] = {'total': len(articles), 'articles': len(articles) - num_deletes, 'deletes': num_deletes}
+
+    if args.mysql_database:
+        db = SQLManager({'host': args.mysql_host, 'port': args.mysql_port, 'user': args.mysql_user,
+                         'password': args.mysql_password, 'database': args.mysql_database})
+        results['stages']['mysql'] = measure(lambda: (len(articles), db.push_pubmed_articles(articles)), args.repeat, not args.no_memory)
+    else:
+        results['stages']['mysql'] = {'skipped': 'no --mysql-database'}
+
+    es, _ = fake_client(latency=args.es_latency_ms / 1000, record=False)
+    ep = ElasticPush(es=es)
+    results['stages']['elasticsearch'] = measure(lambda: (len(articles), ep.bulk_insert(articles)), args.repeat, not args.no_memory)
+    results['stages']['elasticsearch']['limiter'] = ep.limiter.snapshot()
+
+    # ru_maxrss is KiB on Linux, bytes on macOS.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results['max_rss_mib'] = round(max_rss / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+    return results
+
+# Per-stage change against an earlier result. Returns the stages that lost more than `max_regression` of their throughput.
+# Results saved before stages counted records (deletes included) have 'articles_per_sec' instead; those parse
+# numbers didn't count the deletes, so they compare slightly low.
+def compare(results: dict, baseline: dict, max_regression: float) -> list:
+    regressions = []
+    print(f"Compared with {baseline.get('commit')} ({baseline.get('time')}):")
+    for stage, result in results['stages'].items():
+        before = baseline.get('stages', {}).get(stage, {})
+        before_rate = before.get('records_per_sec', before.get('articles_per_sec'))
+        if 'records_per_sec' not in result or not before_rate:
+            continue
+        ratio = result['records_per_sec'] / before_rate
+        line = f"  {stage}: {before_rate} -> {result['records_per_sec']} records/s ({ratio - 1:+.1%})"
+        if 'peak_traced_mib' in result and 'peak_traced_mib' in before:
+            line += f", peak {before['peak_traced_mib']} -> {result['peak_traced_mib']} MiB"
+        print(line)
+        if ratio < 1 - max_regression:
+            regressions.append(stage)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--articles', type=int, default=10000)
+    parser.add_argument('--authors', type=float, default=6, help='mean authors per article')
+    parser.add_argument('--mesh', type=float, default=10, help='mean MeSH headings per article')
+    parser.add_argument('--grants', type=float, default=1, help='mean grants per article')
+    parser.add_argument('--keywords', type=float, default=3, help='mean keywords per article')
+    parser.add_argument('--deletes', type=int, default=100, help='PMIDs in the closing <DeleteCitation> block')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gzip', action='store_true', help='generate and parse a .xml.gz instead of plain XML')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass of each stage')
+    parser.add_argument('--es-latency-ms', type=float, default=0.0, help='simulated latency of each fake bulk request')
+    parser.add_argument('--mysql-host', default='127.0.0.1')
+    parser.add_argument('--mysql-port', type=int, default=3306)
+    parser.add_argument('--mysql-user', default='root')
+    parser.add_argument('--mysql-password', default='')
+    parser.add_argument('--mysql-database', help='local database to write to; the mysql stage is skipped without it')
+    parser.add_argument('--output', default=f"ingest-bench-{datetime.now():%Y%m%d-%H%M%S}.json")
+    parser.add_argument('--compare', help='earlier result to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.1, help='allowed throughput loss per stage with --compare')
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print('Saved to', args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        if regressions:
+            print('Regressed:', ', '.join(regressions))
+            sys.exit(1)
@@ -0,0 +1,101 @@
+'''
+Memory held by one parsed file: Article records against the parse_article() dicts articles used to be
+carried around as, measured with tracemalloc. For each representation it reports the peak while parsing
+the whole file into a list, what that list still holds afterwards, and the peak while turning it into
+Elasticsearch bulk actions one chunk at a time.
+
+    python -m benchmarks.memory_bench pubmed24n0001.xml.gz
+'''
+import argparse
+from datetime import datetime
+import gc
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+from benchmarks.es_bulk_bench import fixed_pub_date
+from elasticsearch_post import BULK_CHUNK_SIZE, ElasticPush
+from parse_xml import get_file_version, get_record_version, open_article_source, parse_article, parse_article_record
+
+
+# iter_articles() as it was before Article records: a parse_article() dict per citation, plus its version.
+def iter_article_dicts(source, file_version: int):
+    context = ET.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag == 'PubmedArticle':
+            article = parse_article(elem)
+            if article:
+                article['version'] = get_record_version(file_version, elem.find('MedlineCitation/PMID'))
+                yield article
+            root.clear()
+
+def iter_article_records(source, file_version: int):
+    context = ET.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag == 'PubmedArticle':
+            article = parse_article_record(elem, get_record_version(file_version, elem.find('MedlineCitation/PMID')))
+            if article:
+                yield article
+            root.clear()
+
+# The old ElasticPush.generate_dict(): copy the article dict and add the bulk metadata to the copy.
+def generate_dict_from_dict(index_name: str, data: dict) -> dict:
+    d = data.copy()
+    d.pop('version', None)
+    d['_op_type'] = 'index'
+    d['_index'] = index_name
+    d['_id'] = d['pubmed_id']
+    d['_version'] = data['version']
+    d['_version_type'] = 'external_gte'
+    d['@timestamp'] = datetime.utcnow().isoformat()
+    d['@last_update'] = datetime.utcnow().isoformat()
+    d['pub_date'] = fixed_pub_date(data.get('pub_date'))
+    return d
+
+def measure(file_name: str, iter_parsed, to_action) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    with open_article_source(file_name) as f:
+        articles = list(iter_parsed(f, get_file_version(file_name)))
+    parse_seconds = time.perf_counter() - start_time
+    retained, parse_peak = tracemalloc.get_traced_memory()
+
+    # Actions are built one bulk chunk at a time, the way ElasticPush streams them.
+    tracemalloc.reset_peak()
+    num_actions = 0
+    for i in range(0, len(articles), BULK_CHUNK_SIZE):
+        chunk = [to_action(article) for article in articles[i:i + BULK_CHUNK_SIZE]]
+        num_actions += len(chunk)
+        del chunk
+    _, actions_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'articles': len(articles),
+        'parse_seconds': round(parse_seconds, 2),
+        'parse_peak_mib': round(parse_peak / 2**20, 1),
+        'retained_mib': round(retained / 2**20, 1),
+        'bytes_per_article': round(retained / len(articles)) if articles else 0,
+        'actions_peak_mib': round(actions_peak / 2**20, 1),
+        'actions': num_actions,
+    }
+
+def run(file_name: str) -> dict:
+    ep = ElasticPush(es=object())
+    before = measure(file_name, iter_article_dicts, lambda article: generate_dict_from_dict(ep.index_name, article))
+    after = measure(file_name, iter_article_records, ep.generate_dict)
+    return {
+        'file': file_name,
+        'dicts': before,
+        'records': after,
+        'retained_ratio': round(before['retained_mib'] / after['retained_mib'], 2) if after['retained_mib'] else 0.0,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file_name', help='.xml or .xml.gz PubMed file')
+    args = parser.parse_args()
+    for key, value in run(args.file_name).items():
+        print(f'{key}: {value}')
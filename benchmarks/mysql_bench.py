@@ -0,0 +1,50 @@
+'''
+Upsert throughput of SQLManager.upsert_pubmed_articles() against a local MySQL/MariaDB instance that
+already has the pubmed_articles table, for a few per-statement row budgets. Each budget pins the write
+limiter's chunk size, which otherwise caps batches at UPSERT_MAX_ROWS and moves with the latency
+(--max-bytes still cuts a batch early if its rows are larger). Only the file's articles are upserted;
+its deleted citations are left out, as push_pubmed_articles() does.
+
+    python -m benchmarks.mysql_bench pubmed24n0001.xml.gz --host 127.0.0.1 --database medbrevia --max-rows 100 1000 5000
+'''
+import argparse
+import time
+
+from db_manager import UPSERT_MAX_BYTES, SQLManager
+from parse_xml import parse_file
+from throttle import AdaptiveLimiter
+
+
+def run(file_name: str, config: dict, max_rows_options, max_bytes: int = UPSERT_MAX_BYTES) -> list:
+    articles = [article for article in parse_file(file_name) if not article.deleted]
+    db = SQLManager(config)
+    results = []
+    for max_rows in max_rows_options:
+        db.write_limiter = AdaptiveLimiter(max_rows, max_rows, max_rows, step=max_rows, name='MySQL bench')
+        start_time = time.perf_counter()
+        rows = db.upsert_pubmed_articles(articles, max_rows=max_rows, max_bytes=max_bytes)
+        elapsed = time.perf_counter() - start_time
+        results.append({
+            'max_rows': max_rows,
+            'batch_rows': db.write_limiter.chunk_size,
+            'max_bytes': max_bytes,
+            'rows': rows,
+            'seconds': round(elapsed, 3),
+            'rows_per_sec': round(rows / elapsed, 1) if elapsed else 0.0,
+        })
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file_name', help='.xml or .xml.gz PubMed file')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--database', required=True)
+    parser.add_argument('--max-rows', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--max-bytes', type=int, default=UPSERT_MAX_BYTES)
+    args = parser.parse_args()
+    config = {'host': args.host, 'port': args.port, 'user': args.user, 'password': args.password, 'database': args.database}
+    for result in run(args.file_name, config, args.max_rows, args.max_bytes):
+        print(result)
@@ -0,0 +1,48 @@
+'''
+Micro-benchmark for the article extractor: parse_article_by_search() (one `.//` search per field)
+against the single-pass parse_article(), on the <PubmedArticle> elements of a sample file.
+
+    python -m benchmarks.parse_bench pubmed24n0001.xml.gz --repeat 3
+'''
+import argparse
+import time
+import xml.etree.ElementTree as ET
+
+from parse_xml import open_article_source, parse_article, parse_article_by_search
+
+
+def load_articles(file_name: str):
+    with open_article_source(file_name) as f:
+        return ET.parse(f).getroot().findall('PubmedArticle')
+
+# Best-of-`repeat` articles/sec for `parser` over `articles`.
+def time_parser(parser, articles, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for article in articles:
+            parser(article)
+        best = min(best, time.perf_counter() - start_time)
+    return len(articles) / best
+
+def run(file_name: str, repeat: int = 3) -> dict:
+    articles = load_articles(file_name)
+    mismatches = sum(1 for article in articles if parse_article(article) != parse_article_by_search(article))
+    before = time_parser(parse_article_by_search, articles, repeat)
+    after = time_parser(parse_article, articles, repeat)
+    return {
+        'file': file_name,
+        'articles': len(articles),
+        'mismatches': mismatches,
+        'by_search_articles_per_sec': round(before, 1),
+        'single_pass_articles_per_sec': round(after, 1),
+        'speedup': round(after / before, 2),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file_name', help='.xml or .xml.gz PubMed file')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    for key, value in run(args.file_name, args.repeat).items():
+        print(f'{key}: {value}')
@@ -0,0 +1,165 @@
+'''
+Synthetic PubMed files for benchmarks: a <PubmedArticleSet> shaped like NCBI's baseline/update files, with
+the elements parse_article_record() reads (history dates, authors incl. collective names, MeSH headings with
+qualifiers, keywords, grants, structured abstracts with inline markup, DOIs) plus the bulk it skips
+(affiliations, references, chemicals), and a closing <DeleteCitation> block. Fan-outs are drawn per
+article around the given means, and the same seed always writes the same file.
+
+    python -m benchmarks.synthetic pubmed99n0001.xml.gz --articles 30000 --authors 6 --mesh 10 --deletes 500
+'''
+import argparse
+import gzip
+import os
+import random
+from xml.sax.saxutils import escape
+
+# Words for titles and abstracts.
+WORDS = ('cell', 'protein', 'expression', 'patients', 'clinical', 'cancer', 'response', 'receptor', 'tissue', 'gene',
+         'analysis', 'treatment', 'mice', 'signaling', 'pathway', 'risk', 'cohort', 'outcome', 'infection', 'dose',
+         'tumor', 'human', 'model', 'inhibitor', 'activity', 'levels', 'acute', 'chronic', 'neural', 'metabolic')
+ABSTRACT_LABELS = ('BACKGROUND', 'METHODS', 'RESULTS', 'CONCLUSIONS')
+PUB_TYPES = ('Journal Article', 'Review', 'Randomized Controlled Trial', 'Case Reports', 'Comparative Study')
+AGENCIES = ('NIH HHS', 'NCI NIH HHS', 'Wellcome Trust', 'Medical Research Council', 'NSF')
+COUNTRIES = ('United States', 'United Kingdom', 'Germany', 'Japan', 'China')
+# Distinct MeSH descriptors and journals drawn from, so lookups repeat the way they do in real files.
+MESH_VOCABULARY = 5000
+JOURNALS = 2000
+
+# A count around `mean`: uniform over [0, 2 * mean], so the average fan-out is `mean`.
+def fan_out(r: random.Random, mean: float) -> int:
+    return r.randint(0, int(2 * mean)) if mean > 0 else 0
+
+def sentence(r: random.Random, num_words: int) -> str:
+    return ' '.join(r.choice(WORDS) for _ in range(num_words)).capitalize()
+
+def pub_date_xml(status: str, year: int, month: int, day: int = None) -> str:
+    day_xml = f'<Day>{day}</Day>' if day is not None else ''
+    return f'<PubMedPubDate PubStatus="{status}"><Year>{year}</Year><Month>{month}</Month>{day_xml}</PubMedPubDate>'
+
+def article_xml(r: random.Random, pmid: int, authors: float, mesh: float, grants: float, keywords: float) -> str:
+    parts = [f'<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="{1 if r.random() < 0.95 else 2}">{pmid}</PMID>']
+    journal = r.randrange(JOURNALS)
+    parts.append(f'<Article PubModel="Print-Electronic"><Journal><ISSN IssnType="Electronic">{journal:04d}-{journal % 9999:04d}</ISSN>'
+                 f'<Title>Journal of {escape(sentence(r, 3))} {journal}</Title></Journal>')
+    parts.append(f'<ArticleTitle>{escape(sentence(r, r.randint(6, 18)))} <i>in vivo</i> &amp; {pmid}.</ArticleTitle>')
+    if r.random() < 0.85:
+        parts.append('<Abstract>')
+        for label in (ABSTRACT_LABELS if r.random() < 0.5 else (None,)):
+            label_xml = f' Label="{label}"' if label else ''
+            parts.append(f'<AbstractText{label_xml}>{escape(sentence(r, r.randint(30, 80)))} <sup>2</sup> &lt;0.05.</AbstractText>')
+        parts.append('</Abstract>')
+
+    parts.append('<AuthorList CompleteYN="Y">')
+    for i in range(fan_out(r, authors)):
+        parts.append(f'<Author ValidYN="Y"><LastName>Author{r.randrange(100000)}</LastName><ForeName>F{i}</ForeName><Initials>F</Initials>'
+                     f'<AffiliationInfo><Affiliation>Department of {escape(sentence(r, 2))}, University {r.randrange(500)}.</Affiliation></AffiliationInfo></Author>')
+    if r.random() < 0.05:
+        parts.append(f'<Author ValidYN="Y"><CollectiveName>{escape(sentence(r, 3))} Study Group</CollectiveName></Author>')
+    parts.append('</AuthorList><Language>eng</Language>')
+
+    num_grants = fan_out(r, grants)
+    if num_grants:
+        parts.append('<GrantList CompleteYN="Y">')
+        for _ in range(num_grants):
+            parts.append(f'<Grant><GrantID>R01 GM{r.randrange(1000000):06d}</GrantID><Acronym>GM</Acronym>'
+                         f'<Agency>{r.choice(AGENCIES)}</Agency><Country>{r.choice(COUNTRIES)}</Country></Grant>')
+        parts.append('</GrantList>')
+    parts.append('<PublicationTypeList>')
+    for pub_type in r.sample(PUB_TYPES, r.randint(1, 2)):
+        parts.append(f'<PublicationType UI="D{r.randrange(100000):06d}">{pub_type}</PublicationType>')
+    parts.append('</PublicationTypeList></Article>')
+    parts.append(f'<MedlineJournalInfo><Country>{r.choice(COUNTRIES)}</Country><MedlineTA>J {journal}</MedlineTA>'
+                 f'<NlmUniqueID>{100000000 + journal}</NlmUniqueID></MedlineJournalInfo>')
+
+    if r.random() < 0.3:
+        parts.append('<ChemicalList>')
+        for _ in range(r.randint(1, 5)):
+            parts.append(f'<Chemical><RegistryNumber>0</RegistryNumber><NameOfSubstance UI="D{r.randrange(100000):06d}">{escape(sentence(r, 2))}</NameOfSubstance></Chemical>')
+        parts.append('</ChemicalList>')
+    num_mesh = fan_out(r, mesh)
+    if num_mesh:
+        parts.append('<MeshHeadingList>')
+        for _ in range(num_mesh):
+            descriptor = r.randrange(MESH_VOCABULARY)
+            qualifier = f'<QualifierName UI="Q{descriptor:06d}" MajorTopicYN="N">metabolism</QualifierName>' if r.random() < 0.4 else ''
+            parts.append(f'<MeshHeading><DescriptorName UI="D{descriptor:06d}" MajorTopicYN="{"Y" if r.random() < 0.2 else "N"}">'
+                         f'Descriptor {descriptor}</DescriptorName>{qualifier}</MeshHeading>')
+        parts.append('</MeshHeadingList>')
+    num_keywords = fan_out(r, keywords)
+    if num_keywords:
+        parts.append('<KeywordList Owner="NOTNLM">')
+        for _ in range(num_keywords):
+            parts.append(f'<Keyword MajorTopicYN="{"Y" if r.random() < 0.1 else "N"}">{escape(sentence(r, r.randint(1, 3)))}</Keyword>')
+        parts.append('</KeywordList>')
+    parts.append('</MedlineCitation>')
+
+    # History: received and accepted are optional (and the odd day is invalid, like NCBI's data); articles
+    # without a pubmed date are skipped by the parser, so a few of those are thrown in too.
+    year = r.randint(1990, 2024)
+    parts.append('<PubmedData><History>')
+    if r.random() < 0.6:
+        parts.append(pub_date_xml('received', year - 1, r.randint(1, 12), r.randint(1, 28) if r.random() < 0.9 else None))
+    if r.random() < 0.6:
+        parts.append(pub_date_xml('accepted', year, r.randint(1, 12), r.randint(1, 31)))
+    if r.random() < 0.99:
+        parts.append(pub_date_xml('pubmed', year, r.randint(1, 12), r.randint(1, 28)))
+    parts.append(pub_date_xml('medline', year, r.randint(1, 12), r.randint(1, 28)))
+    parts.append(f'</History><PublicationStatus>ppublish</PublicationStatus><ArticleIdList><ArticleId IdType="pubmed">{pmid}</ArticleId>')
+    if r.random() < 0.8:
+        parts.append(f'<ArticleId IdType="doi">10.{r.randint(1000, 9999)}/synthetic.{pmid}</ArticleId>')
+    parts.append('</ArticleIdList>')
+    num_references = fan_out(r, 15) if r.random() < 0.5 else 0
+    if num_references:
+        parts.append('<ReferenceList>')
+        for _ in range(num_references):
+            cited = r.randrange(1, 40000000)
+            parts.append(f'<Reference><Citation>{escape(sentence(r, 10))}.</Citation><ArticleIdList>'
+                         f'<ArticleId IdType="pubmed">{cited}</ArticleId></ArticleIdList></Reference>')
+        parts.append('</ReferenceList>')
+    parts.append('</PubmedData></PubmedArticle>\n')
+    return ''.join(parts)
+
+# Writes a synthetic file to `path` (gzipped if it ends in .gz) and returns what went into it. PMIDs run from
+# `start_pmid`; the closing <DeleteCitation> block names `deletes` of them, the way update files retract citations.
+def write_pubmed_file(path: str, articles: int = 10000, authors: float = 6, mesh: float = 10, grants: float = 1,
+                      keywords: float = 3, deletes: int = 0, start_pmid: int = 1, seed: int = 0) -> dict:
+    r = random.Random(seed)
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January 2024//EN" '
+                '"https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_240101.dtd">\n<PubmedArticleSet>\n')
+        for pmid in range(start_pmid, start_pmid + articles):
+            f.write(article_xml(r, pmid, authors, mesh, grants, keywords))
+        if deletes:
+            deleted = sorted(r.sample(range(start_pmid, start_pmid + articles), min(deletes, articles)))
+            f.write('<DeleteCitation>' + ''.join(f'<PMID Version="1">{pmid}</PMID>' for pmid in deleted) + '</DeleteCitation>\n')
+        f.write('</PubmedArticleSet>\n')
+    return {
+        'path': path,
+        'bytes': os.path.getsize(path),
+        'articles': articles,
+        'deletes': min(deletes, articles),
+        'authors': authors,
+        'mesh': mesh,
+        'grants': grants,
+        'keywords': keywords,
+        'seed': seed,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='output file; .xml.gz is gzipped, anything else is plain XML')
+    parser.add_argument('--articles', type=int, default=10000)
+    parser.add_argument('--authors', type=float, default=6, help='mean authors per article')
+    parser.add_argument('--mesh', type=float, default=10, help='mean MeSH headings per article')
+    parser.add_argument('--grants', type=float, default=1, help='mean grants per article')
+    parser.add_argument('--keywords', type=float, default=3, help='mean keywords per article')
+    parser.add_argument('--deletes', type=int, default=0, help='PMIDs in the closing <DeleteCitation> block')
+    parser.add_argument('--start-pmid', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    summary = write_pubmed_file(args.path, args.articles, args.authors, args.mesh, args.grants, args.keywords,
+                                args.deletes, args.start_pmid, args.seed)
+    for key, value in summary.items():
+        print(f'{key}: {value}')
@@ -1,49 +1,325 @@
-import mysql.connector
-from threading import Lock
+from collections import ChainMap
+from contextlib import contextmanager
+import json
+import time
+from mysql.connector import errors, pooling
+from threading import BoundedSemaphore, Lock
 
+from article import Article, Author, Grant, Keyword, MeshHeading
+from throttle import AdaptiveLimiter, jittered_backoff
 from utils import Utils
 
+ARTICLE_COLUMNS = ['pubmed_id', 'title', 'pub_date', 'doi', 'journal', 'nlm_unique_id', 'pub_types', 'abstract', 'version']
+# Only a row at least as new as the stored one is applied. MySQL applies the assignments left to right, so
+# `version` comes last and everything before it is compared against the stored version.
+ARTICLE_UPDATE_SQL = (" ON DUPLICATE KEY UPDATE "
+                      + "".join(f"{column}=IF(VALUES(version) >= version, VALUES({column}), {column}), " for column in ARTICLE_COLUMNS[1:-1])
+                      + "last_update=IF(VALUES(version) >= version, NOW(), last_update), version=GREATEST(version, VALUES(version))")
+
+# Per-statement budgets for push_pubmed_articles(). The byte budget stays well under MySQL's default
+# max_allowed_packet; the row budget keeps the placeholder count under the 65,535 prepared-statement limit.
+UPSERT_MAX_ROWS = 1000
+UPSERT_MAX_BYTES = 4 * 1024 * 1024
+# write_limiter moves the rows per upsert between UPSERT_MIN_ROWS and UPSERT_MAX_ROWS, aiming for
+# statements that take at most WRITE_TARGET_SECONDS.
+UPSERT_MIN_ROWS = 100
+WRITE_TARGET_SECONDS = 2.0
+
+# Lock wait timeout and deadlock: InnoDB rolled the transaction back and it can simply run again.
+TRANSIENT_ERRNOS = (1205, 1213)
+WRITE_MAX_RETRIES = 6
+WRITE_RETRY_BACKOFF_SECONDS = 0.5
+
+# Connections kept open by each SQLManager; mysql.connector caps a pool at 32.
+POOL_SIZE = 8
+
+# get_indexed_pubmed_files() re-reads rows this far behind the newest last_update it has seen: a name written in
+# a transaction that committed late can carry an older timestamp than rows already read.
+INDEXED_FILES_MARGIN_SECONDS = 300
+
+# Max ids per `IN (...)` lookup.
+LOOKUP_BATCH_SIZE = 1000
+
+# Tables this module owns, created on startup if they don't exist yet.
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS pubmed_article_hashes (
+        pubmed_id INT UNSIGNED NOT NULL PRIMARY KEY,
+        content_hash BINARY(16) NOT NULL,
+        version BIGINT UNSIGNED NOT NULL DEFAULT 0,
+        last_update TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    )
+    """,
+    # Lookup table: each MeSH descriptor is stored once and referenced by id. Journals are not split out the
+    # same way, since pubmed_articles keeps the journal title and nlm_unique_id next to each other anyway.
+    """
+    CREATE TABLE IF NOT EXISTS mesh_descriptors (
+        descriptor_id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        name VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+        UNIQUE KEY (name)
+    )
+    """,
+    # Child tables, replaced wholesale for every article that's written. `position` keeps the XML order.
+    """
+    CREATE TABLE IF NOT EXISTS pubmed_article_authors (
+        pubmed_id INT UNSIGNED NOT NULL,
+        position SMALLINT UNSIGNED NOT NULL,
+        name TEXT,
+        PRIMARY KEY (pubmed_id, position)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS pubmed_article_keywords (
+        pubmed_id INT UNSIGNED NOT NULL,
+        position SMALLINT UNSIGNED NOT NULL,
+        name TEXT,
+        major_topic BOOLEAN NOT NULL,
+        PRIMARY KEY (pubmed_id, position)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS pubmed_article_grants (
+        pubmed_id INT UNSIGNED NOT NULL,
+        position SMALLINT UNSIGNED NOT NULL,
+        grant_id TEXT,
+        grant_country TEXT,
+        agency TEXT,
+        PRIMARY KEY (pubmed_id, position)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS pubmed_article_mesh (
+        pubmed_id INT UNSIGNED NOT NULL,
+        position SMALLINT UNSIGNED NOT NULL,
+        descriptor_id INT UNSIGNED NOT NULL,
+        major_topic BOOLEAN NOT NULL,
+        PRIMARY KEY (pubmed_id, position),
+        KEY (descriptor_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS pubmed_article_history (
+        pubmed_id INT UNSIGNED NOT NULL PRIMARY KEY,
+        accepted_date DATE,
+        received_date DATE
+    )
+    """,
+    # Which ingest worker is working on which file; see claim_file(). A file whose lease ran out can be
+    # claimed by anyone, and 'es_done' (set by write_file_names) is final.
+    """
+    CREATE TABLE IF NOT EXISTS pubmed_file_leases (
+        file_name VARCHAR(255) NOT NULL PRIMARY KEY,
+        owner VARCHAR(255) NOT NULL,
+        status ENUM('claimed', 'parsed', 'db_done', 'es_done') NOT NULL DEFAULT 'claimed',
+        lease_expires DATETIME NOT NULL,
+        attempts INT UNSIGNED NOT NULL DEFAULT 1,
+        last_update TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        KEY (owner)
+    )
+    """,
+]
+
+LEASE_STATUSES = ('claimed', 'parsed', 'db_done', 'es_done')
+
+# Columns added to existing tables, as (table, column, definition); see migrate_columns().
+ADDED_COLUMNS = [
+    # The record version (parse_xml.get_record_version) a pubmed_articles row was written from.
+    ('pubmed_articles', 'version', 'BIGINT UNSIGNED NOT NULL DEFAULT 0'),
+]
+# Columns whose type changed since their table was first created, as (table, column, data type, definition).
+CHANGED_COLUMNS = [
+    # Was a TIMESTAMP, which MySQL (without explicit_defaults_for_timestamp) silently gives
+    # ON UPDATE CURRENT_TIMESTAMP, so every status change would have cut the lease short.
+    ('pubmed_file_leases', 'lease_expires', 'datetime', 'DATETIME NOT NULL'),
+]
+
+# Child tables holding the list fields of an article, and the columns written to each (after pubmed_id, position).
+ARTICLE_CHILD_TABLES = {
+    'pubmed_article_authors': ['name'],
+    'pubmed_article_keywords': ['name', 'major_topic'],
+    'pubmed_article_grants': ['grant_id', 'grant_country', 'agency'],
+    'pubmed_article_mesh': ['descriptor_id', 'major_topic'],
+}
+
+
+class UpsertBatchError(Exception):
+    def __init__(self, batch_index: int, first_pubmed_id, last_pubmed_id, rows_committed: int, cause: Exception):
+        self.batch_index = batch_index
+        self.first_pubmed_id = first_pubmed_id
+        self.last_pubmed_id = last_pubmed_id
+        self.rows_committed = rows_committed
+        self.cause = cause
+        super().__init__(f"Upsert batch {batch_index} (pubmed_id {first_pubmed_id}..{last_pubmed_id}) failed "
+                         f"after {rows_committed} rows were committed: {cause}")
+
 
 class SQLManager:
-    def __init__(self):
-        self.config = {
+    '''
+    Every operation checks a connection out of a pool, pings it (reconnecting if the server dropped it),
+    and returns it when done, so any number of threads can share one SQLManager.
+    Threads beyond `pool_size` wait for a free connection instead of failing.
+    '''
+    def __init__(self, config: dict = None, pool_size: int = POOL_SIZE, create_tables: bool = True):
+        self.config = config or {
             'user': 'root',
             'host': '',
             'database': '',
             'ssl_disabled': False
         }
 
-        self.connection = mysql.connector.connect(**self.config)
+        self.pool = pooling.MySQLConnectionPool(pool_name='medbrevia', pool_size=pool_size, **self.config)
+        self.pool_slots = BoundedSemaphore(pool_size)
         Utils.print("Connected to MySQL database.")
-        self.cursor = self.get_cursor()
         self.summaries_queue = []
         self.summaries_queue_batch_size = 30
-        self.lock = Lock()
+        self.upsert_statements = {}
+        # Interned descriptor ids, so each batch only touches descriptors it hasn't seen yet.
+        self.mesh_descriptor_ids = {}
+        # In-memory copy of indexed_pubmed_files; see get_indexed_pubmed_files().
+        self.indexed_files = None
+        self.indexed_files_seen_until = None
+        self.indexed_files_lock = Lock()
+        # Paces every write transaction of this manager: rows per upsert statement and how many write at once.
+        self.write_limiter = AdaptiveLimiter(UPSERT_MAX_ROWS, UPSERT_MIN_ROWS, UPSERT_MAX_ROWS, step=UPSERT_MIN_ROWS,
+                                             concurrency=pool_size, max_concurrency=pool_size,
+                                             target_seconds=WRITE_TARGET_SECONDS, name='MySQL writes')
+        if create_tables:
+            self.create_tables()
+
+    def create_tables(self):
+        with self.get_cursor() as (connection, cursor):
+            for statement in SCHEMA:
+                cursor.execute(statement)
+            SQLManager.migrate_columns(cursor)
+            connection.commit()
+
+    # MySQL has no ADD COLUMN IF NOT EXISTS, so the existing columns are read from information_schema first.
+    # Tables that don't exist (yet) are left alone.
+    @staticmethod
+    def migrate_columns(cursor):
+        def get_columns(table) -> dict:
+            cursor.execute("SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", (table,))
+            return {name: str(data_type).lower() for name, data_type in cursor.fetchall()}
+
+        for table, column, definition in ADDED_COLUMNS:
+            columns = get_columns(table)
+            if columns and column not in columns:
+                Utils.print(f'Adding {table}.{column}')
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        for table, column, data_type, definition in CHANGED_COLUMNS:
+            columns = get_columns(table)
+            if column in columns and columns[column] != data_type:
+                Utils.print(f'Changing {table}.{column} to {definition}')
+                cursor.execute(f"ALTER TABLE {table} MODIFY COLUMN {column} {definition}")
+
+    @contextmanager
+    def get_connection(self):
+        with self.pool_slots:
+            connection = self.pool.get_connection()
+            try:
+                connection.ping(reconnect=True, attempts=3, delay=1)
+                yield connection
+            finally:
+                # Returns the connection to the pool (and rolls back anything left uncommitted).
+                connection.close()
+
+    @contextmanager
+    def get_cursor(self, prepared: bool = False, **cursor_kwargs):
+        with self.get_connection() as connection:
+            cursor = connection.cursor(prepared=prepared, **cursor_kwargs)
+            try:
+                yield connection, cursor
+            finally:
+                cursor.close()
 
-    def get_cursor(self):
-        if self.connection.is_connected():
-            return self.connection.cursor()
-        self.connection.reconnect()
-        self.connection.autocommit = True
-        return self.connection.cursor()
+    @staticmethod
+    def is_transient(e: Exception) -> bool:
+        return isinstance(e, errors.Error) and e.errno in TRANSIENT_ERRNOS
+
+    # Runs one write transaction through write_limiter and reports how it went. Returns the transaction's
+    # result, or raises; a lock wait timeout or deadlock also halves the limiter.
+    def timed_write(self, write):
+        self.write_limiter.acquire()
+        start_time = time.perf_counter()
+        try:
+            result = write()
+        except Exception as e:
+            if SQLManager.is_transient(e):
+                self.write_limiter.on_overload(f'MySQL error {e.errno}')
+            raise
+        finally:
+            self.write_limiter.release()
+        self.write_limiter.on_success(time.perf_counter() - start_time)
+        return result
+
+    '''
+    Runs `write(connection, cursor)` as one transaction (committed here, rolled back on error). A lock wait
+    timeout or deadlock rolls the whole transaction back, so it is retried on a fresh cursor after a
+    jittered backoff, up to `max_retries` times; any other error is raised straight away.
+    '''
+    def run_write(self, write, max_retries: int = WRITE_MAX_RETRIES):
+        # The connection is taken before the limiter slot, in the same order as upsert_pubmed_articles.
+        def transaction():
+            with self.get_cursor() as (connection, cursor):
+                def write_and_commit():
+                    try:
+                        result = write(connection, cursor)
+                        connection.commit()
+                        return result
+                    except Exception:
+                        connection.rollback()
+                        raise
+                return self.timed_write(write_and_commit)
+
+        for attempt in range(max_retries + 1):
+            try:
+                return transaction()
+            except Exception as e:
+                if not SQLManager.is_transient(e) or attempt == max_retries:
+                    raise
+                delay = jittered_backoff(attempt, WRITE_RETRY_BACKOFF_SECONDS)
+                Utils.print(f'MySQL error {e.errno} ({e.msg}), retrying in {delay:.1f}s')
+                time.sleep(delay)
+
+    @staticmethod
+    def get_sql_row(d: dict, ordering) -> list:
+        row = []
+        for key in ordering:
+            value = d.get(key)
+            if isinstance(value, list):
+                value = json.dumps(value)
+            row.append(value if value != '' else None)
+        return row
+
+    # pubmed_articles row for an Article, in ARTICLE_COLUMNS order.
+    @staticmethod
+    def get_article_row(article: Article) -> tuple:
+        return (article.pubmed_id, article.title or None, article.pub_date or None, article.doi or None, article.journal or None,
+                article.nlm_unique_id or None, json.dumps(article.pub_types), article.abstract or None, article.version)
+
+    @staticmethod
+    def get_sql_values_string(num_rows: int, num_fields: int) -> str:
+        format_string = "(" + ",".join(["%s"] * num_fields) + ")"
+        return " VALUES " + ",".join([format_string] * num_rows)
 
     def get_sql_values_string_from_dicts(self, arr_of_dicts: list[dict], ordering):
-        base_string = " VALUES "
-        num_fields = len(ordering)
-        format_string = "(" + ("%s," * num_fields)[:-1] + "),"
         values = []
-
         for d in arr_of_dicts:
-            new_value = []
-            for key in ordering:
-                if key in d:
-                    new_value.append(d[key] if d[key] != '' else None)
-                else:
-                    new_value.append(None)
-            base_string += format_string
-            values.extend(new_value)
+            values.extend(SQLManager.get_sql_row(d, ordering))
+        return SQLManager.get_sql_values_string(len(arr_of_dicts), len(ordering)), values
 
-        return base_string[:-1], values
+    # The next batch of `rows` from `start` within `max_rows` and (approximately) `max_bytes` of parameter data.
+    # Strings are counted in UTF-8 bytes, as they go over the wire; non-Latin titles and abstracts take 2-4 per character.
+    @staticmethod
+    def take_row_batch(rows: list, start: int, max_rows: int, max_bytes: int) -> list:
+        batch, batch_bytes = [], 0
+        for row in rows[start:start + max_rows]:
+            row_bytes = sum(len(value.encode()) if isinstance(value, str) else 8 for value in row)
+            if batch and batch_bytes + row_bytes > max_bytes:
+                break
+            batch.append(row)
+            batch_bytes += row_bytes
+        return batch
     
     def pull_for_elasticsearch(self, min_pubmed_id:int, count:int=50):
         query = """
@@ -52,21 +328,260 @@ class SQLManager:
         ORDER BY pubmed_id ASC
         LIMIT %s;
         """
-        self.cursor.execute(query, (min_pubmed_id, count))
-        rows = self.cursor.fetchall()
-        
-        # Assuming you want to return a list of dictionaries
-        columns = [desc[0] for desc in self.cursor.description]
-        result = [dict(zip(columns, row)) for row in rows]
+        with self.get_connection() as connection:
+            cursor = connection.cursor(dictionary=True)
+            try:
+                cursor.execute(query, (min_pubmed_id, count))
+                result = [SQLManager.article_from_row(row) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+            self.attach_article_children(connection, result)
         return result
-    def push_pubmed_articles(self, pubmed_articles: list[dict]):
+
+    def get_pubmed_id_bounds(self):
+        with self.get_cursor() as (_, cursor):
+            cursor.execute("SELECT MIN(pubmed_id), MAX(pubmed_id) FROM pubmed_articles")
+            return cursor.fetchone()
+
+    # Turns a pubmed_articles row back into an Article (without its child rows; see attach_article_children).
+    @staticmethod
+    def article_from_row(row: dict) -> Article:
+        pub_date = row.get('pub_date')
+        if pub_date is not None:
+            pub_date = pub_date.isoformat() if hasattr(pub_date, 'isoformat') else str(pub_date)
+        pub_types = row.get('pub_types')
+        return Article(
+            pubmed_id=str(row['pubmed_id']),
+            title=row.get('title') or '',
+            pub_date=pub_date or '',
+            abstract=row.get('abstract') or '',
+            doi=row.get('doi'),
+            journal=row.get('journal') or '',
+            nlm_unique_id=row.get('nlm_unique_id'),
+            pub_types=tuple(json.loads(pub_types)) if pub_types else (),
+            version=row.get('version') or 0,
+        )
+
+    '''
+    Streams articles with pubmed_id in (after_pubmed_id, up_to_pubmed_id] in pubmed_id order, one keyset
+    page of `page_size` rows at a time. Each page is read through an unbuffered cursor (so the driver
+    never holds more than that page), completed from the child tables, and handed back after the
+    connection has returned to the pool. Yields (pubmed_id, article).
+    '''
+    def iter_articles_for_elasticsearch(self, after_pubmed_id: int, up_to_pubmed_id: int, page_size: int = 10000):
+        query = """
+        SELECT pubmed_id, title, pub_date, doi, journal, nlm_unique_id, pub_types, abstract, version FROM pubmed_articles
+        WHERE pubmed_id > %s AND pubmed_id <= %s
+        ORDER BY pubmed_id ASC
+        LIMIT %s;
+        """
+        while True:
+            with self.get_connection() as connection:
+                cursor = connection.cursor(dictionary=True, buffered=False)
+                try:
+                    cursor.execute(query, (after_pubmed_id, up_to_pubmed_id, page_size))
+                    articles = [SQLManager.article_from_row(row) for row in cursor]
+                finally:
+                    # An unbuffered cursor has to be drained before its connection goes back to the pool.
+                    cursor.fetchall()
+                    cursor.close()
+                self.attach_article_children(connection, articles)
+            for article in articles:
+                yield int(article.pubmed_id), article
+            if len(articles) < page_size:
+                return
+            after_pubmed_id = int(articles[-1].pubmed_id)
+
+    # Fills authors, keywords, grants, mesh_headings and history dates into `articles` (rebuilt from
+    # pubmed_articles rows) with one query per child table for the whole page.
+    def attach_article_children(self, connection, articles: list):
+        if not articles:
+            return
+        articles_by_id = {int(article.pubmed_id): article for article in articles}
+        pubmed_ids = list(articles_by_id)
+        id_list = ",".join(["%s"] * len(pubmed_ids))
+        queries = [
+            ('authors', f"SELECT pubmed_id, name FROM pubmed_article_authors WHERE pubmed_id IN ({id_list}) ORDER BY pubmed_id, position",
+             lambda row: Author(row[1])),
+            ('keywords', f"SELECT pubmed_id, name, major_topic FROM pubmed_article_keywords WHERE pubmed_id IN ({id_list}) ORDER BY pubmed_id, position",
+             lambda row: Keyword(row[1], bool(row[2]))),
+            ('grants', f"SELECT pubmed_id, grant_id, grant_country, agency FROM pubmed_article_grants WHERE pubmed_id IN ({id_list}) ORDER BY pubmed_id, position",
+             lambda row: Grant(row[1], row[2], row[3])),
+            ('mesh_headings', f"SELECT m.pubmed_id, d.name, m.major_topic FROM pubmed_article_mesh m JOIN mesh_descriptors d ON d.descriptor_id = m.descriptor_id WHERE m.pubmed_id IN ({id_list}) ORDER BY m.pubmed_id, m.position",
+             lambda row: MeshHeading(row[1], bool(row[2]))),
+        ]
+        cursor = connection.cursor()
+        try:
+            for key, query, to_record in queries:
+                cursor.execute(query, pubmed_ids)
+                records = {}
+                for row in cursor.fetchall():
+                    records.setdefault(row[0], []).append(to_record(row))
+                for pubmed_id, article_records in records.items():
+                    setattr(articles_by_id[pubmed_id], key, tuple(article_records))
+            cursor.execute(f"SELECT pubmed_id, accepted_date, received_date FROM pubmed_article_history WHERE pubmed_id IN ({id_list})", pubmed_ids)
+            for pubmed_id, accepted_date, received_date in cursor.fetchall():
+                if accepted_date:
+                    articles_by_id[pubmed_id].accepted_date = accepted_date.isoformat()
+                if received_date:
+                    articles_by_id[pubmed_id].received_date = received_date.isoformat()
+        finally:
+            cursor.close()
+
+    # Inserts MeSH descriptors this manager hasn't seen yet. Returns {name: descriptor_id} for the new descriptors;
+    # remember_lookups() caches them once the transaction commits, so a rolled back (and retried) transaction
+    # can't leave ids behind that were never written.
+    def intern_lookups(self, cursor, articles: list) -> dict:
+        new_descriptors = {mesh.name for article in articles for mesh in article.mesh_headings} - self.mesh_descriptor_ids.keys()
+        new_descriptor_ids = {}
+        if new_descriptors:
+            new_descriptors = list(new_descriptors)
+            cursor.executemany("INSERT IGNORE INTO mesh_descriptors (name) VALUES (%s)", [(name,) for name in new_descriptors])
+            for i in range(0, len(new_descriptors), LOOKUP_BATCH_SIZE):
+                chunk = new_descriptors[i:i + LOOKUP_BATCH_SIZE]
+                cursor.execute("SELECT name, descriptor_id FROM mesh_descriptors WHERE name IN (" + ",".join(["%s"] * len(chunk)) + ")", chunk)
+                for name, descriptor_id in cursor.fetchall():
+                    new_descriptor_ids[name] = descriptor_id
+        return new_descriptor_ids
+
+    def remember_lookups(self, descriptor_ids: dict):
+        self.mesh_descriptor_ids.update(descriptor_ids)
+
+    @staticmethod
+    def get_child_rows(article: Article, mesh_descriptor_ids: dict) -> dict:
+        pubmed_id = article.pubmed_id
+        return {
+            'pubmed_article_authors': [(pubmed_id, i) + author for i, author in enumerate(article.authors)],
+            'pubmed_article_keywords': [(pubmed_id, i) + keyword for i, keyword in enumerate(article.keywords)],
+            'pubmed_article_grants': [(pubmed_id, i) + grant for i, grant in enumerate(article.grants)],
+            'pubmed_article_mesh': [(pubmed_id, i, mesh_descriptor_ids[mesh.name], mesh.major_topic) for i, mesh in enumerate(article.mesh_headings)],
+        }
+
+    # Deletes the child rows of every article in the batch, then bulk-inserts their current ones, in one
+    # transaction. Set-based: one DELETE and one multi-row INSERT per table, however many articles there are.
+    def replace_article_children(self, articles: list):
+        articles = [article for article in articles if article]
+        for i in range(0, len(articles), LOOKUP_BATCH_SIZE):
+            chunk = articles[i:i + LOOKUP_BATCH_SIZE]
+            descriptor_ids = self.run_write(lambda connection, cursor: self.write_article_children(cursor, chunk))
+            self.remember_lookups(descriptor_ids)
+
+    # Articles that a newer version has overtaken in pubmed_articles keep that version's child rows.
+    def write_article_children(self, cursor, articles: list):
+        newer_ids = SQLManager.get_newer_ids(cursor, [(article.pubmed_id, article.version) for article in articles])
+        articles = [article for article in articles if article.pubmed_id not in newer_ids]
+        if not articles:
+            return {}
+        new_descriptor_ids = self.intern_lookups(cursor, articles)
+        mesh_descriptor_ids = ChainMap(new_descriptor_ids, self.mesh_descriptor_ids)
+        self.delete_article_children(cursor, [article.pubmed_id for article in articles])
+        rows_by_table = {table: [] for table in ARTICLE_CHILD_TABLES}
+        for article in articles:
+            for table, rows in SQLManager.get_child_rows(article, mesh_descriptor_ids).items():
+                rows_by_table[table].extend(rows)
+        for table, columns in ARTICLE_CHILD_TABLES.items():
+            if rows_by_table[table]:
+                insert_sql = (f"INSERT INTO {table} (pubmed_id, position, {', '.join(columns)}) "
+                              f"VALUES ({','.join(['%s'] * (len(columns) + 2))})")
+                cursor.executemany(insert_sql, rows_by_table[table])
+        history_rows = [(article.pubmed_id, article.accepted_date or None, article.received_date or None)
+                        for article in articles if article.accepted_date or article.received_date]
+        if history_rows:
+            cursor.executemany("INSERT INTO pubmed_article_history (pubmed_id, accepted_date, received_date) VALUES (%s, %s, %s)", history_rows)
+        return new_descriptor_ids
+
+    # The ids among `records` ([(pubmed_id, version)]) whose pubmed_articles row has a newer version. The rows
+    # are locked until the transaction ends, so the answer holds for the rest of it.
+    @staticmethod
+    def get_newer_ids(cursor, records: list) -> set:
+        versions = {str(pubmed_id): version for pubmed_id, version in records}
+        if not versions:
+            return set()
+        cursor.execute("SELECT pubmed_id, version FROM pubmed_articles WHERE pubmed_id IN (" + ",".join(["%s"] * len(versions)) + ") FOR UPDATE",
+                       list(versions))
+        return {str(pubmed_id) for pubmed_id, version in cursor.fetchall() if version > versions[str(pubmed_id)]}
+
+    @staticmethod
+    def delete_article_children(cursor, pubmed_ids: list):
+        id_list = ",".join(["%s"] * len(pubmed_ids))
+        for table in list(ARTICLE_CHILD_TABLES) + ['pubmed_article_history']:
+            cursor.execute(f"DELETE FROM {table} WHERE pubmed_id IN ({id_list})", pubmed_ids)
+    def get_upsert_statement(self, num_rows: int) -> str:
+        statement = self.upsert_statements.get(num_rows)
+        if statement is None:
+            statement = ("INSERT INTO pubmed_articles (" + ", ".join(ARTICLE_COLUMNS) + ")"
+                         + SQLManager.get_sql_values_string(num_rows, len(ARTICLE_COLUMNS)) + ARTICLE_UPDATE_SQL)
+            self.upsert_statements[num_rows] = statement
+        return statement
+
+    '''
+    Upserts in batches of at most `max_rows` rows (fewer while write_limiter has shrunk its chunk size) /
+    `max_bytes` bytes, each committed (or rolled back) on its own. A batch that hits a lock wait timeout or
+    deadlock is retried after a jittered backoff, re-cut to the limiter's new size, up to WRITE_MAX_RETRIES
+    times. Returns the number of rows written; raises UpsertBatchError naming the first batch that failed.
+    '''
+    def upsert_pubmed_articles(self, pubmed_articles: list[Article], max_rows: int = UPSERT_MAX_ROWS, max_bytes: int = UPSERT_MAX_BYTES) -> int:
+        rows = [SQLManager.get_article_row(article) for article in pubmed_articles if article]
+        rows_committed, batch_index, attempt = 0, 0, 0
+        # One prepared cursor for the whole call; it only re-prepares when the batch size changes.
+        with self.get_cursor(prepared=True) as (connection, cursor):
+            def write_batch(values, num_rows):
+                try:
+                    cursor.execute(self.get_upsert_statement(num_rows), values)
+                    connection.commit()
+                except Exception:
+                    try:
+                        connection.rollback()
+                    except Exception:
+                        pass
+                    raise
+
+            while rows_committed < len(rows):
+                batch = SQLManager.take_row_batch(rows, rows_committed, min(max_rows, self.write_limiter.chunk_size), max_bytes)
+                values = [value for row in batch for value in row]
+                try:
+                    self.timed_write(lambda: write_batch(values, len(batch)))
+                except Exception as e:
+                    if SQLManager.is_transient(e) and attempt < WRITE_MAX_RETRIES:
+                        delay = jittered_backoff(attempt, WRITE_RETRY_BACKOFF_SECONDS)
+                        Utils.print(f'MySQL error {e.errno} on upsert batch {batch_index}, retrying in {delay:.1f}s')
+                        time.sleep(delay)
+                        attempt += 1
+                        continue
+                    raise UpsertBatchError(batch_index, batch[0][0], batch[-1][0], rows_committed, e) from e
+                rows_committed += len(batch)
+                batch_index += 1
+                attempt = 0
+        return rows_committed
+
+    # `deletions` is [(pubmed_id, version)]. A citation stored with a newer version than its deletion (a later
+    # file brought it back) is kept.
+    def delete_pubmed_articles(self, deletions: list) -> int:
+        def delete(connection, cursor):
+            num_deleted = 0
+            for i in range(0, len(deletions), LOOKUP_BATCH_SIZE):
+                records = deletions[i:i + LOOKUP_BATCH_SIZE]
+                newer_ids = SQLManager.get_newer_ids(cursor, records)
+                chunk = [pubmed_id for pubmed_id, _ in records if str(pubmed_id) not in newer_ids]
+                if not chunk:
+                    continue
+                SQLManager.delete_article_children(cursor, chunk)
+                cursor.execute("DELETE FROM pubmed_articles WHERE pubmed_id IN (" + ",".join(["%s"] * len(chunk)) + ")", chunk)
+                num_deleted += cursor.rowcount
+            return num_deleted
+
+        return self.run_write(delete)
+
+    # Takes iter_articles() records: articles are upserted along with their child rows, then deleted
+    # citations are removed.
+    def push_pubmed_articles(self, pubmed_articles: list[Article]):
         try:
-            article_sql, values = self.get_sql_values_string_from_dicts(pubmed_articles, ['pubmed_id', 'title', 'pub_date', 'doi', 'journal', 'nlm_unique_id', 'pub_types', 'abstract'])
-            insert_sql = "INSERT INTO pubmed_articles (pubmed_id, title, pub_date, doi, journal, nlm_unique_id, pub_types, abstract)" + article_sql
-            update_sql = " ON DUPLICATE KEY UPDATE title=VALUES(title), pub_date=VALUES(pub_date), doi=VALUES(doi), journal=VALUES(journal), nlm_unique_id=VALUES(nlm_unique_id), pub_types=VALUES(pub_types), abstract=VALUES(abstract), last_update=NOW()"
-            insert_sql += update_sql
-            self.cursor.execute(insert_sql, values)
-            self.connection.commit()
+            upserts = [article for article in pubmed_articles if article and not article.deleted]
+            self.upsert_pubmed_articles(upserts)
+            self.replace_article_children(upserts)
+            deletions = [(article.pubmed_id, article.version) for article in pubmed_articles if article.deleted]
+            if deletions:
+                self.delete_pubmed_articles(deletions)
             return True
         except Exception as e:
             Utils.print(f"Error in push_pubmed_articles: {e}")
@@ -76,8 +591,15 @@ class SQLManager:
         try:
             values = [(name,) for name in file_names]
             insert_sql = "INSERT INTO indexed_pubmed_files (file_name) VALUES (%s) ON DUPLICATE KEY UPDATE last_update=NOW()"
-            self.cursor.executemany(insert_sql, values)
-            self.connection.commit()
+            def write(connection, cursor):
+                cursor.executemany(insert_sql, values)
+                # A recorded file is finished for every worker, whoever held its lease.
+                cursor.executemany("UPDATE pubmed_file_leases SET status='es_done' WHERE file_name=%s", values)
+
+            self.run_write(write)
+            with self.indexed_files_lock:
+                if self.indexed_files is not None:
+                    self.indexed_files.update(file_names)
             return True
         except Exception as e:
             Utils.print(f"Error in write_file_names: {e}")
@@ -85,9 +607,125 @@ class SQLManager:
         
     def write_file_name(self, file_name: str) -> bool:
         return self.write_file_names([file_name])
+
+    '''
+    Claims `file_name` for `owner` for `lease_seconds`, in one statement so two workers can't both win.
+    The claim succeeds if nobody holds the file, its lease has expired, or `owner` already holds it
+    (which renews it); never once the file is 'es_done'. MySQL applies the assignments left to right, so
+    `owner` is updated after everything that tests its old value, and `lease_expires` follows whoever
+    owns the row after that.
+    '''
+    def claim_file(self, file_name: str, owner: str, lease_seconds: int) -> bool:
+        claimable = "(status <> 'es_done' AND (lease_expires < NOW() OR owner = VALUES(owner)))"
+        claim_sql = ("INSERT INTO pubmed_file_leases (file_name, owner, lease_expires) VALUES (%s, %s, NOW() + INTERVAL %s SECOND) "
+                     f"ON DUPLICATE KEY UPDATE attempts=IF({claimable} AND owner <> VALUES(owner), attempts + 1, attempts), "
+                     f"status=IF({claimable} AND owner <> VALUES(owner), 'claimed', status), "
+                     f"owner=IF({claimable}, VALUES(owner), owner), "
+                     f"lease_expires=IF(status <> 'es_done' AND owner = VALUES(owner), VALUES(lease_expires), lease_expires)")
+        with self.get_cursor() as (connection, cursor):
+            cursor.execute(claim_sql, (file_name, owner, lease_seconds))
+            connection.commit()
+            cursor.execute("SELECT owner, status FROM pubmed_file_leases WHERE file_name=%s", (file_name,))
+            row = cursor.fetchone()
+        return row is not None and row[0] == owner and row[1] != 'es_done'
+
+    # Claims up to `limit` of `file_names` in order, skipping the ones another worker holds. Returns the claimed names.
+    def claim_files(self, file_names, owner: str, lease_seconds: int, limit: int = None) -> list:
+        # One read of the live leases first, so a poll doesn't try (and fail) to claim every file in progress elsewhere.
+        with self.get_cursor() as (_, cursor):
+            cursor.execute("SELECT file_name FROM pubmed_file_leases WHERE owner <> %s AND (status = 'es_done' OR lease_expires >= NOW())", (owner,))
+            taken = {row[0] for row in cursor.fetchall()}
+        claimed = []
+        for file_name in file_names:
+            if file_name in taken:
+                continue
+            if limit is not None and len(claimed) >= limit:
+                break
+            if self.claim_file(file_name, owner, lease_seconds):
+                claimed.append(file_name)
+        return claimed
+
+    # Pushes the leases `owner` still holds on `file_names` out by `lease_seconds`. Returns the names it
+    # still holds; anything missing was taken over after the lease expired.
+    def renew_leases(self, file_names, owner: str, lease_seconds: int) -> set:
+        file_names = list(file_names)
+        if not file_names:
+            return set()
+        id_list = ",".join(["%s"] * len(file_names))
+        with self.get_cursor() as (connection, cursor):
+            cursor.execute(f"UPDATE pubmed_file_leases SET lease_expires = NOW() + INTERVAL %s SECOND "
+                           f"WHERE owner=%s AND status <> 'es_done' AND file_name IN ({id_list})", [lease_seconds, owner] + file_names)
+            connection.commit()
+            cursor.execute(f"SELECT file_name FROM pubmed_file_leases WHERE owner=%s AND file_name IN ({id_list})", [owner] + file_names)
+            return {row[0] for row in cursor.fetchall()}
+
+    # Moves a held file to `status` (one of LEASE_STATUSES). False if `owner` no longer holds it.
+    def set_lease_status(self, file_name: str, owner: str, status: str) -> bool:
+        with self.get_cursor() as (connection, cursor):
+            cursor.execute("UPDATE pubmed_file_leases SET status=%s WHERE file_name=%s AND owner=%s AND status <> 'es_done'",
+                           (status, file_name, owner))
+            connection.commit()
+            # rowcount would be 0 for a status the row already had, so check the owner instead.
+            cursor.execute("SELECT owner FROM pubmed_file_leases WHERE file_name=%s", (file_name,))
+            row = cursor.fetchone()
+        return row is not None and row[0] == owner
+
+    # Expires `owner`'s unfinished leases on `file_names` right away, so another worker can retry them.
+    def release_leases(self, file_names, owner: str):
+        file_names = list(file_names)
+        if not file_names:
+            return
+        id_list = ",".join(["%s"] * len(file_names))
+        with self.get_cursor() as (connection, cursor):
+            cursor.execute(f"UPDATE pubmed_file_leases SET lease_expires = NOW() - INTERVAL 1 SECOND "
+                           f"WHERE owner=%s AND status <> 'es_done' AND file_name IN ({id_list})", [owner] + file_names)
+            connection.commit()
         
-    def get_indexed_pubmed_files(self):
-        query = "SELECT file_name FROM indexed_pubmed_files"
-        self.cursor.execute(query)
-        result = [item[0] for item in self.cursor.fetchall()]
-        return result
\ No newline at end of file
+    # Returns {pubmed_id (str): (content_hash (bytes), version)} for the ids that have a stored fingerprint.
+    def get_content_hashes(self, pubmed_ids) -> dict:
+        pubmed_ids = list(pubmed_ids)
+        result = {}
+        with self.get_cursor() as (_, cursor):
+            for i in range(0, len(pubmed_ids), LOOKUP_BATCH_SIZE):
+                chunk = pubmed_ids[i:i + LOOKUP_BATCH_SIZE]
+                query = "SELECT pubmed_id, content_hash, version FROM pubmed_article_hashes WHERE pubmed_id IN (" + ",".join(["%s"] * len(chunk)) + ")"
+                cursor.execute(query, chunk)
+                for pubmed_id, content_hash, version in cursor.fetchall():
+                    result[str(pubmed_id)] = (bytes(content_hash), version)
+        return result
+
+    # `content_hashes` is {pubmed_id: (content_hash, version)}. A stored row with a newer version is left alone.
+    def write_content_hashes(self, content_hashes: dict) -> bool:
+        try:
+            # MySQL applies the assignments left to right, so content_hash is compared against the old version.
+            insert_sql = ("INSERT INTO pubmed_article_hashes (pubmed_id, content_hash, version) VALUES (%s, %s, %s) "
+                          "ON DUPLICATE KEY UPDATE content_hash=IF(VALUES(version) >= version, VALUES(content_hash), content_hash), "
+                          "version=GREATEST(version, VALUES(version))")
+            values = [(pubmed_id, content_hash, version) for pubmed_id, (content_hash, version) in content_hashes.items()]
+            self.run_write(lambda connection, cursor: cursor.executemany(insert_sql, values))
+            return True
+        except Exception as e:
+            Utils.print(f"Error in write_content_hashes: {e}")
+            return False
+
+    # Set of recorded file names. The table is read in full once; after that only rows whose last_update
+    # is at or past the newest one seen (less INDEXED_FILES_MARGIN_SECONDS) are fetched, which picks up names
+    # recorded by other processes, and write_file_names() adds this process's own names directly.
+    def get_indexed_pubmed_files(self) -> frozenset:
+        with self.indexed_files_lock:
+            with self.get_cursor() as (_, cursor):
+                if self.indexed_files is None or self.indexed_files_seen_until is None:
+                    # First call, or the table was empty last time (a tiny read either way).
+                    cursor.execute("SELECT file_name, last_update FROM indexed_pubmed_files")
+                    self.indexed_files = self.indexed_files or set()
+                else:
+                    cursor.execute("SELECT file_name, last_update FROM indexed_pubmed_files WHERE last_update >= %s - INTERVAL %s SECOND",
+                                   (self.indexed_files_seen_until, INDEXED_FILES_MARGIN_SECONDS))
+                for file_name, last_update in cursor.fetchall():
+                    self.indexed_files.add(file_name)
+                    # Rows from before last_update existed have none; they're only picked up by the full read.
+                    if last_update is None:
+                        continue
+                    if self.indexed_files_seen_until is None or last_update > self.indexed_files_seen_until:
+                        self.indexed_files_seen_until = last_update
+            return frozenset(self.indexed_files)
\ No newline at end of file
@@ -0,0 +1,147 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bs4 import BeautifulSoup
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import IngestMetrics, StageSample
+from utils import Utils
+
+
+class GzDownloader:
+    '''
+    Downloads NCBI files over a pooled session, `max_workers` at a time.
+    Each file is written to `<save_path>.part`, resumed with a Range request if a previous attempt left
+    a partial file, checked against the `.md5` sidecar NCBI publishes next to it, and only then moved to
+    `save_path` with os.replace(). A truncated or corrupt download never shows up under its real name.
+    Each download() is recorded as a 'download' sample in `metrics`, and the verified md5 of every file it
+    saved is kept in `checksums` ({save_path: md5}), so nobody has to read the file again to get it.
+    '''
+    PART_SUFFIX = '.part'
+
+    def __init__(self, max_workers: int = 4, chunk_size: int = 1024 * 1024, max_retries: int = 3, timeout: int = 60,
+                 metrics: IngestMetrics = None):
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.metrics = metrics or IngestMetrics()
+        # url -> (ETag, Last-Modified, .gz names) from the last full fetch of that listing.
+        self.listings = {}
+        self.checksums = {}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    # NCBI sidecars look like "MD5(pubmed24n0001.xml.gz)= 0123...", but a bare hex digest works too.
+    @staticmethod
+    def parse_md5(text: str) -> Optional[str]:
+        match = re.search(r'\b([0-9a-fA-F]{32})\b', text)
+        if match:
+            return match.group(1).lower()
+        return None
+
+    def fetch_md5(self, url: str) -> Optional[str]:
+        response = self.session.get(url + '.md5', timeout=self.timeout)
+        response.raise_for_status()
+        return GzDownloader.parse_md5(response.text)
+
+    # The .gz names linked from an NCBI directory listing. Repeat calls send the listing's ETag /
+    # Last-Modified back, and a 304 reuses the names parsed last time without downloading or parsing the page.
+    def list_gz_files(self, url: str) -> List[str]:
+        etag, last_modified, gz_files = self.listings.get(url, (None, None, None))
+        headers = {}
+        if gz_files is not None:
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304:
+            return gz_files
+        response.raise_for_status()
+
+        soup = BeautifulSoup(response.text, "html.parser")
+        file_names = [link.get("href") for link in soup.find_all('a')]
+        gz_files = [f for f in file_names if f and f.endswith('.gz')]
+        self.listings[url] = (response.headers.get('ETag'), response.headers.get('Last-Modified'), gz_files)
+        return gz_files
+
+    def hash_existing(self, path: str):
+        md5 = hashlib.md5()
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                    md5.update(chunk)
+        return md5
+
+    # Downloads (or resumes) `url` into `part_path`, returning the md5 of the complete part file.
+    def fetch_part(self, url: str, part_path: str) -> str:
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+        with self.session.get(url, stream=True, headers=headers, timeout=self.timeout) as response:
+            if response.status_code == 416:
+                # The part file already holds every byte the server has.
+                return self.hash_existing(part_path).hexdigest()
+            response.raise_for_status()
+
+            if response.status_code == 206:
+                md5 = self.hash_existing(part_path)
+                mode = 'ab'
+            else:
+                # The server ignored the Range header; start over.
+                md5 = hashlib.md5()
+                mode = 'wb'
+
+            with open(part_path, mode) as out_file:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    out_file.write(chunk)
+                    md5.update(chunk)
+        return md5.hexdigest()
+
+    def download(self, url: str, save_path: str) -> bool:
+        with self.metrics.timer('download', save_path) as sample:
+            sample.ok = self.download_with_retries(url, save_path, sample)
+            if sample.ok:
+                sample.bytes = os.path.getsize(save_path)
+        return sample.ok
+
+    def download_with_retries(self, url: str, save_path: str, sample: StageSample) -> bool:
+        part_path = save_path + GzDownloader.PART_SUFFIX
+        for attempt in range(self.max_retries):
+            sample.retries = attempt
+            try:
+                expected_md5 = self.fetch_md5(url)
+                if not expected_md5:
+                    Utils.print(f"No checksum found in {url}.md5", color='red')
+                    continue
+
+                actual_md5 = self.fetch_part(url, part_path)
+                if actual_md5 != expected_md5:
+                    Utils.print(f"Checksum mismatch for {save_path} on attempt {attempt+1}: expected {expected_md5}, got {actual_md5}", color='red')
+                    os.remove(part_path)
+                    continue
+
+                os.replace(part_path, save_path)
+                self.checksums[save_path] = actual_md5
+                Utils.print('Downloaded and verified', save_path, color='green')
+                return True
+            except Exception as e:
+                # Leave the part file in place so the next attempt resumes from where this one stopped.
+                Utils.print(f"Error downloading {url} on attempt {attempt+1}: {e}", color='red')
+        Utils.print(f"Failed to download {url} after {self.max_retries} attempts.", color='red')
+        return False
+
+    # Downloads every (url, save_path) pair concurrently. Returns {save_path: success}.
+    def download_all(self, urls_and_paths: Iterable[Tuple[str, str]]) -> Dict[str, bool]:
+        urls_and_paths = list(urls_and_paths)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(lambda pair: self.download(*pair), urls_and_paths)
+            return {save_path: success for (_, save_path), success in zip(urls_and_paths, results)}
@@ -1,67 +1,377 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import datetime
-from elasticsearch import Elasticsearch
+import heapq
+from itertools import count
+import logging
+import time
+from typing import List, Optional
+from elasticsearch import ApiError, ConnectionError, ConnectionTimeout, Elasticsearch
 from elasticsearch import helpers
+from elastic_transport import JsonSerializer, NdjsonSerializer
 
-from db_manager import SQLManager
+from article import Article
+from throttle import AdaptiveLimiter, jittered_backoff
+from utils import Utils
+
+# Optional: with orjson installed, bulk bodies are serialized by FastJsonSerializer instead of the stdlib.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 MEDBREVIA_NEW_INDEX_BACKEND_KEY = ""
 
+# Bulk defaults: requests are cut at whichever of the limiter's chunk size / BULK_MAX_CHUNK_BYTES comes first.
+# BULK_CHUNK_SIZE and BULK_THREAD_COUNT are where the AdaptiveLimiter starts; it moves chunk size between
+# BULK_MIN_CHUNK_SIZE and BULK_MAX_CHUNK_SIZE and concurrency up to BULK_MAX_THREAD_COUNT, aiming for bulk
+# requests that take at most BULK_TARGET_SECONDS.
+BULK_CHUNK_SIZE = 1000
+BULK_MIN_CHUNK_SIZE = 100
+BULK_MAX_CHUNK_SIZE = 5000
+BULK_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+BULK_THREAD_COUNT = 4
+BULK_MAX_THREAD_COUNT = 16
+BULK_TARGET_SECONDS = 2.0
+# Per-document retries, BULK_RETRY_BACKOFF_SECONDS * 2**attempt apart at most (jittered).
+BULK_MAX_RETRIES = 8
+BULK_RETRY_BACKOFF_SECONDS = 1.0
+BULK_RETRY_MAX_BACKOFF_SECONDS = 60.0
+# Statuses that mean "cluster is busy, try this document again later".
+RETRYABLE_STATUSES = (429,)
+# Whole-request statuses after which every document of the request is tried again.
+RETRYABLE_REQUEST_STATUSES = (429, 502, 503, 504)
+# A 409 means the index already holds a newer version of the document (external versioning), and a 404
+# on a delete means there was nothing to delete; both leave the index correct, so they count as done.
+NOOP_STATUSES = {'index': (409,), 'delete': (404, 409)}
+# Documents that failed for good are logged at ERROR up to this many per send_actions() call, the rest at DEBUG.
+BULK_ERRORS_LOGGED = 5
+# Index settings swapped out by bulk_load() and put back afterwards.
+BULK_LOAD_SETTINGS = {'index.refresh_interval': '-1', 'index.number_of_replicas': '0'}
+# Key in the index's mapping _meta where bulk_load() keeps the settings it swapped out until they're back, so a
+# run killed in between can still restore them (see restore_bulk_load_settings).
+BULK_LOAD_MARKER = 'bulk_load_original_settings'
+
+class FastJsonSerializer(JsonSerializer):
+    '''
+    JsonSerializer on top of orjson, which produces the same compact UTF-8 output several times faster.
+    Anything orjson refuses (lone surrogates, non-str keys, ints past 64 bits) goes through the stdlib path.
+    '''
+    def dumps(self, data) -> bytes:
+        if isinstance(data, (str, bytes)):
+            return super().dumps(data)
+        try:
+            return orjson.dumps(data, default=self.default)
+        except TypeError:
+            return super().dumps(data)
+
+    def loads(self, data: bytes):
+        if data == b'':
+            return None
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return super().loads(data)
+
+
+class FastNdjsonSerializer(NdjsonSerializer):
+    def dumps(self, data) -> bytes:
+        if not isinstance(data, (str, bytes)):
+            data = [line if isinstance(line, (str, bytes)) else FAST_JSON_SERIALIZER.dumps(line) for line in data]
+        return super().dumps(data)
+
+
+FAST_JSON_SERIALIZER = FastJsonSerializer() if orjson else None
+
+# `serializers` for Elasticsearch(): the orjson ones when available, the client's defaults otherwise.
+def get_serializers() -> dict:
+    if orjson is None:
+        return {}
+    return {FastJsonSerializer.mimetype: FAST_JSON_SERIALIZER, FastNdjsonSerializer.mimetype: FastNdjsonSerializer()}
+
+
 class ElasticPush:
-    def __init__(self,index_name="search-medbrevia-pubmed-articles",timeout=3600):
+    '''
+    Holds one long-lived Elasticsearch client. Pass `es` to use an existing client (e.g. one pointed at a
+    local container or a fake transport) instead of the cloud deployment; only a client built here
+    (`owns_client`) is ever rebuilt by refresh_connection() callers. Bulk requests are paced by
+    `limiter` (see AdaptiveLimiter), which every thread using this ElasticPush shares; `thread_count` and
+    `chunk_size` are its starting point.
+    '''
+    def __init__(self,index_name="search-medbrevia-pubmed-articles",timeout=3600, es=None,
+                 thread_count=BULK_THREAD_COUNT, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_CHUNK_BYTES,
+                 max_retries=BULK_MAX_RETRIES, limiter: AdaptiveLimiter = None):
         self.index_name = index_name
         self.es_ip = ""
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.bulk_loading = False
+        self.serializer = FAST_JSON_SERIALIZER or JsonSerializer()
+        self.limiter = limiter or AdaptiveLimiter(chunk_size, BULK_MIN_CHUNK_SIZE, BULK_MAX_CHUNK_SIZE, step=BULK_MIN_CHUNK_SIZE,
+                                                  concurrency=thread_count, max_concurrency=max(BULK_MAX_THREAD_COUNT, thread_count),
+                                                  target_seconds=BULK_TARGET_SECONDS, name='Elasticsearch bulk')
+
+        self.owns_client = es is None
+        if es is None:
+            self.refresh_connection()
+        else:
+            self.es = es
 
-        self.refresh_connection()
-        
 
     def refresh_connection(self):
         self.es = Elasticsearch(cloud_id="", 
-                                     api_key=MEDBREVIA_NEW_INDEX_BACKEND_KEY)
+                                     api_key=MEDBREVIA_NEW_INDEX_BACKEND_KEY,
+                                     serializers=get_serializers())
         
 
-    def get_fixed_pub_date(pub_date):
-        if pub_date:
-            try:
-                # Parse the date using strptime and then reformat using strftime
-                # This will ensure the date is in 'YYYY-MM-DD' format
-                parsed_date = datetime.strptime(pub_date, '%Y-%m-%d')
-                return parsed_date.strftime('%Y-%m-%d')
-            except ValueError:
-                pass
-        return None
-     
-    def generate_dict(self, data: dict) -> dict:
-        d = data.copy()
-        d['_op_type'] = 'index'
-        d['_index'] = self.index_name
-        d['_id'] = d['pubmed_id']
-        d['@timestamp'] = datetime.utcnow().isoformat()  # Ensure the timestamp is in ISO format
-        d['@last_update'] = datetime.utcnow().isoformat()
-        d['pub_date'] = ElasticPush.get_fixed_pub_date(data.get('pub_date'))
+    # Builds the bulk action straight from the Article's slots. Records carrying a version (see
+    # parse_xml.iter_articles) are written with external versioning, so ES itself refuses to let an older
+    # version of a citation overwrite a newer one. `timestamp` is shared by every action of a batch.
+    def generate_dict(self, article: Article, timestamp: str = None) -> dict:
+        version = article.version
+        if article.deleted:
+            d = {'_op_type': 'delete', '_index': self.index_name, '_id': article.pubmed_id}
+            if version:
+                d['_version'] = version
+                d['_version_type'] = 'external_gte'
+            return d
+
+        d = {'_op_type': 'index', '_index': self.index_name, '_id': article.pubmed_id}
+        if version:
+            d['_version'] = version
+            d['_version_type'] = 'external_gte'
+        article.to_dict(d)
+
+        if timestamp is None:
+            timestamp = datetime.utcnow().isoformat()
+        d['@timestamp'] = timestamp
+        d['@last_update'] = timestamp
+        # Already YYYY-MM-DD: format_pub_date() wrote it, or MySQL's DATE did.
+        d['pub_date'] = article.pub_date or None
         return d
 
-    def bulk_insert(self, data_list):
-        self.refresh_connection()
+    def iter_actions(self, data_iterable):
+        timestamp = datetime.utcnow().isoformat()
+        for data in data_iterable:
+            if data:
+                yield self.generate_dict(data, timestamp)
+
+    @staticmethod
+    def is_noop(info) -> bool:
+        op_type, item = next(iter(info.items()))
+        return item.get('status') in NOOP_STATUSES.get(op_type, ())
 
-        # Function to perform bulk insert
-        def insert_chunk(chunk):
-            documents = [self.generate_dict(data) for data in chunk if data]
-            num_success, num_failed = helpers.bulk(self.es, documents, stats_only=True)
-            return num_success, num_failed
+    @staticmethod
+    def is_retryable_error(e: Exception) -> bool:
+        if isinstance(e, (ConnectionError, ConnectionTimeout)):
+            return True
+        return isinstance(e, ApiError) and e.status_code in RETRYABLE_REQUEST_STATUSES
 
-        # Split data list into chunks of 15,000 documents each
-        chunk_size = 15000
-        chunks = [data_list[i:i + chunk_size] for i in range(0, len(data_list), chunk_size)]
+    # An action as its NDJSON lines, serialized once however often it's retried: (lines, size in bytes, _id).
+    def serialize_action(self, action) -> tuple:
+        meta, source = helpers.expand_action(action)
+        lines = [self.serializer.dumps(meta)]
+        if source is not None:
+            lines.append(self.serializer.dumps(source))
+        return lines, sum(len(line) + 1 for line in lines), action.get('_id')
 
-        total_success, total_failed = 0, 0
-        for chunk in chunks:
-            num_success, num_failed = insert_chunk(chunk)
-            total_success += num_success
-            total_failed += num_failed
+    # A failed document for the log: its _id, status and the error's type and reason.
+    @staticmethod
+    def describe_failure(doc_id, status, error) -> dict:
+        if isinstance(error, dict):
+            error = {'type': error.get('type'), 'reason': error.get('reason')}
+        return {'_id': doc_id, 'status': status, 'error': error}
 
+    @staticmethod
+    def log_failures(failures: list):
+        if not failures:
+            return
+        Utils.print(f'Elasticsearch: {len(failures)} documents failed. First errors:', failures[:BULK_ERRORS_LOGGED], color='red')
+        if len(failures) > BULK_ERRORS_LOGGED:
+            Utils.print('All failed documents:', failures, level=logging.DEBUG)
+
+    # Fills the next request with (attempt, lines, size, _id) documents, due retries first, up to the limiter's
+    # current chunk size and max_chunk_bytes.
+    def next_chunk(self, actions, retries: list) -> list:
+        chunk, chunk_bytes = [], 0
+        chunk_size = self.limiter.chunk_size
+        now = time.monotonic()
+        while retries and retries[0][0] <= now and len(chunk) < chunk_size:
+            _, _, doc = heapq.heappop(retries)
+            chunk.append(doc)
+            chunk_bytes += doc[2]
+        while len(chunk) < chunk_size and chunk_bytes < self.max_chunk_bytes:
+            action = next(actions, None)
+            if action is None:
+                break
+            lines, size, doc_id = self.serialize_action(action)
+            chunk.append((0, lines, size, doc_id))
+            chunk_bytes += size
+        return chunk
+
+    # One bulk request, in a pool thread. Returns (response items, or the exception, and the seconds it took).
+    # The client's own retries are off so 429s reach the limiter instead of being re-sent straight away.
+    def send_chunk(self, chunk: list) -> tuple:
+        start_time = time.perf_counter()
+        try:
+            response = self.es.options(max_retries=0).bulk(operations=[line for _, lines, _, _ in chunk for line in lines])
+            return response['items'], time.perf_counter() - start_time
+        except Exception as e:
+            return e, time.perf_counter() - start_time
+        finally:
+            self.limiter.release()
+
+    '''
+    Sends a stream of actions as bulk requests sized and parallelized by self.limiter. Documents rejected
+    with a 429 (or caught in a request that failed with a 429/5xx or a connection error) go back into the
+    stream after a jittered backoff, up to max_retries times each; everything else that fails counts as
+    failed. Actions are only pulled from `actions` as requests go out, so a generator is never drained
+    ahead of time. Failed documents are logged (see log_failures) and, if `failures` is given, appended to
+    it as describe_failure() dicts. Returns (num_success, num_failed).
+    '''
+    def send_actions(self, actions, failures: list = None):
+        actions = iter(actions)
+        retries, sequence = [], count()  # heap of (due time, tiebreak, (attempt, lines, size, _id))
+        in_flight = {}
+        num_success = 0
+        failed = []
+
+        def retry_later(doc, status, error):
+            attempt, lines, size, doc_id = doc
+            if attempt >= self.max_retries:
+                failed.append(ElasticPush.describe_failure(doc_id, status, error))
+                return
+            delay = jittered_backoff(attempt, BULK_RETRY_BACKOFF_SECONDS, BULK_RETRY_MAX_BACKOFF_SECONDS)
+            heapq.heappush(retries, (time.monotonic() + delay, next(sequence), (attempt + 1, lines, size, doc_id)))
+
+        with ThreadPoolExecutor(max_workers=self.limiter.max_concurrency, thread_name_prefix='es-bulk') as executor:
+            while True:
+                chunk = self.next_chunk(actions, retries)
+                if chunk:
+                    self.limiter.acquire()
+                    in_flight[executor.submit(self.send_chunk, chunk)] = chunk
+                    # Keep filling free slots; only collect results that are already in.
+                    timeout = 0
+                elif in_flight:
+                    timeout = max(retries[0][0] - time.monotonic(), 0) if retries else None
+                elif retries:
+                    time.sleep(max(retries[0][0] - time.monotonic(), 0))
+                    continue
+                else:
+                    break
+
+                done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk = in_flight.pop(future)
+                    result, seconds = future.result()
+                    if isinstance(result, Exception):
+                        status = getattr(result, 'status_code', None)
+                        if not ElasticPush.is_retryable_error(result):
+                            Utils.print(f'Bulk request of {len(chunk)} documents failed: {result}', color='red')
+                            failed.extend(ElasticPush.describe_failure(doc[3], status, str(result)) for doc in chunk)
+                            continue
+                        self.limiter.on_overload(f'{type(result).__name__}: {result}')
+                        for doc in chunk:
+                            retry_later(doc, status, str(result))
+                        continue
+                    rejected = 0
+                    for doc, info in zip(chunk, result):
+                        _, item = next(iter(info.items()))
+                        status = item.get('status', 500)
+                        if 200 <= status < 300 or ElasticPush.is_noop(info):
+                            num_success += 1
+                        elif status in RETRYABLE_STATUSES:
+                            rejected += 1
+                            retry_later(doc, status, item.get('error'))
+                        else:
+                            failed.append(ElasticPush.describe_failure(item.get('_id', doc[3]), status, item.get('error')))
+                    if rejected:
+                        self.limiter.on_overload(f'{rejected} of {len(chunk)} documents rejected')
+                    else:
+                        self.limiter.on_success(seconds)
+        ElasticPush.log_failures(failed)
+        if failures is not None:
+            failures.extend(failed)
+        return num_success, len(failed)
+
+    # Accepts any iterable of parsed articles (a list, or a generator straight out of the parser).
+    # Returns (num_success, num_failed).
+    # Returns (num_success, num_failed); `failures` (if given) collects the failed documents, see send_actions().
+    def bulk_index(self, data_iterable, failures: list = None):
+        return self.send_actions(self.iter_actions(data_iterable), failures)
+
+    def bulk_insert(self, data_iterable):
+        _, total_failed = self.bulk_index(data_iterable)
         return total_failed == 0
 
+    # Like bulk_insert(), but returns the articles that failed (none if all made it), so only those are sent again.
+    def insert_articles(self, articles: List[Article]) -> List[Article]:
+        failures = []
+        self.send_actions(self.iter_actions(articles), failures)
+        failed_ids = {str(failure['_id']) for failure in failures}
+        return [article for article in articles if str(article.pubmed_id) in failed_ids]
+
 
+    # Explicit refreshes are skipped while bulk_load() is active; it runs a single one on exit.
     def refresh(self):
-        self.refresh_connection()
-        return self.es.indices.refresh(index=self.index_name)
\ No newline at end of file
+        if self.bulk_loading:
+            return None
+        return self.es.indices.refresh(index=self.index_name)
+
+    def get_index_settings(self, names) -> dict:
+        response = self.es.indices.get_settings(index=self.index_name, name=list(names), flat_settings=True)
+        # Keyed by the concrete index name, which differs from index_name when that's an alias.
+        settings = next(iter(response.values()), {}).get('settings', {})
+        return {name: settings.get(name) for name in names}
+
+    def get_index_meta(self) -> dict:
+        response = self.es.indices.get_mapping(index=self.index_name)
+        return next(iter(response.values()), {}).get('mappings', {}).get('_meta') or {}
+
+    # Stores `original_settings` as the bulk-load marker, or removes the marker for None. put_mapping replaces
+    # _meta as a whole, so its other keys are written back along with it.
+    def set_bulk_load_marker(self, original_settings: Optional[dict]):
+        meta = self.get_index_meta()
+        meta.pop(BULK_LOAD_MARKER, None)
+        if original_settings is not None:
+            meta[BULK_LOAD_MARKER] = original_settings
+        self.es.indices.put_mapping(index=self.index_name, meta=meta)
+
+    # Puts back the settings a bulk load killed before its end had swapped out, from the marker it left.
+    # An index without the marker is left alone, whatever its settings: an operator may have set them on
+    # purpose. Returns True if it had to.
+    def restore_bulk_load_settings(self) -> bool:
+        original_settings = self.get_index_meta().get(BULK_LOAD_MARKER)
+        if original_settings is None:
+            return False
+        Utils.print(self.index_name, 'was left in bulk-load mode; restoring', original_settings, color='red')
+        self.es.indices.put_settings(index=self.index_name, settings=original_settings)
+        self.set_bulk_load_marker(None)
+        return True
+
+    '''
+    For backfills: turns off refreshes and replicas for the duration of the block so segments aren't
+    refreshed and every document isn't written twice. The original settings are saved in the index's
+    _meta first (BULK_LOAD_MARKER); on exit they are restored (None resets a setting that was never set
+    explicitly), the marker is removed, the index is refreshed once and, if asked, force-merged. If the
+    marker is already there (an earlier bulk load crashed), the settings it saved are the ones restored.
+    '''
+    @contextmanager
+    def bulk_load(self, force_merge: bool = False):
+        original_settings = self.get_index_meta().get(BULK_LOAD_MARKER)
+        if original_settings is None:
+            original_settings = self.get_index_settings(BULK_LOAD_SETTINGS)
+            self.set_bulk_load_marker(original_settings)
+        Utils.print('Entering bulk-load mode for', self.index_name, original_settings)
+        self.es.indices.put_settings(index=self.index_name, settings=BULK_LOAD_SETTINGS)
+        self.bulk_loading = True
+        try:
+            yield self
+        finally:
+            self.bulk_loading = False
+            self.es.indices.put_settings(index=self.index_name, settings=original_settings)
+            self.set_bulk_load_marker(None)
+            self.refresh()
+            if force_merge:
+                self.es.options(request_timeout=None).indices.forcemerge(index=self.index_name)
+            Utils.print('Left bulk-load mode for', self.index_name, color='green')
@@ -0,0 +1,92 @@
+import os
+import socket
+import threading
+from typing import Iterable, List
+
+from db_manager import SQLManager
+from utils import Utils
+
+# A worker that stops heartbeating loses its files to other workers after this long.
+LEASE_SECONDS = 10 * 60
+
+
+class LeaseKeeper:
+    '''
+    Holds one ingest worker's file leases (see SQLManager.claim_file) and renews them from a background
+    thread every `lease_seconds / 3`, so a file stays claimed for as long as the worker is alive and
+    falls back to the other workers once it's not. Files whose lease was taken over anyway (e.g. the
+    worker stalled past its lease) end up in `lost`, and the pipeline stops writing them.
+    '''
+    def __init__(self, db: SQLManager, owner: str = None, lease_seconds: int = LEASE_SECONDS):
+        self.db = db
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+        self.lease_seconds = lease_seconds
+        self.lock = threading.Lock()
+        self.held = set()
+        self.lost = set()
+        self.stop_event = threading.Event()
+        self.heartbeat_thread = None
+
+    def claim(self, file_names: Iterable[str], limit: int = None) -> List[str]:
+        claimed = self.db.claim_files(file_names, self.owner, self.lease_seconds, limit)
+        with self.lock:
+            self.held.update(claimed)
+            self.lost.difference_update(claimed)
+        if claimed:
+            Utils.print(f'{self.owner} claimed', claimed)
+        self.start()
+        return claimed
+
+    def is_lost(self, file_name: str) -> bool:
+        with self.lock:
+            return file_name in self.lost
+
+    def mark(self, file_name: str, status: str):
+        if not self.db.set_lease_status(file_name, self.owner, status):
+            self.lose([file_name])
+
+    # The file was recorded in indexed_pubmed_files, which finishes its lease.
+    def finish(self, file_name: str):
+        with self.lock:
+            self.held.discard(file_name)
+
+    def release(self, file_names: Iterable[str]):
+        file_names = list(file_names)
+        with self.lock:
+            self.held.difference_update(file_names)
+        self.db.release_leases(file_names, self.owner)
+
+    def lose(self, file_names: Iterable[str]):
+        file_names = list(file_names)
+        if not file_names:
+            return
+        Utils.print(f'{self.owner} lost its lease on', file_names, color='red')
+        with self.lock:
+            self.held.difference_update(file_names)
+            self.lost.update(file_names)
+
+    def heartbeat(self):
+        with self.lock:
+            held = set(self.held)
+        if held:
+            still_held = self.db.renew_leases(held, self.owner, self.lease_seconds)
+            self.lose(held - still_held)
+
+    def run_heartbeats(self):
+        while not self.stop_event.wait(self.lease_seconds / 3):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                # Keep trying: the lease only lapses if this keeps failing for lease_seconds.
+                Utils.print(f'Lease heartbeat failed: {e}', color='red')
+
+    def start(self):
+        if self.heartbeat_thread is None or not self.heartbeat_thread.is_alive():
+            self.stop_event.clear()
+            self.heartbeat_thread = threading.Thread(target=self.run_heartbeats, name='lease-heartbeat', daemon=True)
+            self.heartbeat_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
@@ -0,0 +1,182 @@
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+from typing import Iterable, Iterator, Optional
+
+# Stages of a file's trip through the ingest, in order.
+# 'hashes' is storing the content hashes of the written articles; 'record' is recording the finished file.
+STAGES = ('download', 'gunzip', 'parse', 'mysql', 'elasticsearch', 'hashes', 'record')
+
+
+class StageSample:
+    '''
+    One timed run of a stage over (part of) a file. `bytes` is what the stage read or wrote: the .gz for
+    download, inflated XML for gunzip and parse. `retries` counts attempts after the first.
+    '''
+    def __init__(self, stage: str, file_name: str, seconds: float = 0.0, bytes: int = 0, articles: int = 0,
+                 retries: int = 0, ok: bool = True):
+        self.stage = stage
+        self.file_name = file_name
+        self.seconds = seconds
+        self.bytes = bytes
+        self.articles = articles
+        self.retries = retries
+        self.ok = ok
+
+    def to_dict(self) -> dict:
+        return {
+            'time': round(time.time(), 3),
+            'stage': self.stage,
+            'file': self.file_name,
+            'seconds': round(self.seconds, 4),
+            'bytes': self.bytes,
+            'articles': self.articles,
+            'retries': self.retries,
+            'ok': self.ok,
+        }
+
+
+class MeteredReader:
+    '''
+    Wraps a binary file object and adds up the time and bytes spent in read(). Around a gzip stream that
+    is the decompression cost, which is otherwise hidden inside the XML parser's reads.
+    '''
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def read(self, size: int = -1) -> bytes:
+        start_time = time.perf_counter()
+        data = self.fileobj.read(size)
+        self.seconds += time.perf_counter() - start_time
+        self.bytes += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+# Yields from `iterable`, adding to sample.seconds only the time spent producing each item (not the time
+# the consumer holds on to it), and each item's length to sample.articles.
+def timed_iter(iterable: Iterable, sample: StageSample) -> Iterator:
+    iterator = iter(iterable)
+    while True:
+        start_time = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            sample.seconds += time.perf_counter() - start_time
+            return
+        sample.seconds += time.perf_counter() - start_time
+        sample.articles += len(item)
+        yield item
+
+
+class IngestMetrics:
+    '''
+    Thread-safe per-stage totals for the ingest. Every sample is appended to `jsonl_path` as one JSON line
+    (if set), and flush() rewrites `prometheus_path` (if set) in the node_exporter textfile format with the
+    running totals and the throughput of the last sample of each stage.
+    '''
+    def __init__(self, jsonl_path: Optional[str] = None, prometheus_path: Optional[str] = None, prefix: str = 'medbrevia_ingest'):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.totals = {stage: IngestMetrics.new_totals() for stage in STAGES}
+        self.last_samples = {}
+
+    @staticmethod
+    def new_totals() -> dict:
+        return {'samples': 0, 'seconds': 0.0, 'bytes': 0, 'articles': 0, 'retries': 0, 'failures': 0}
+
+    # Times the block as one `stage` sample; the block fills in bytes/articles/retries/ok on the sample.
+    # An exception escaping the block marks the sample failed.
+    @contextmanager
+    def timer(self, stage: str, file_name: str):
+        sample = StageSample(stage, file_name)
+        start_time = time.perf_counter()
+        try:
+            yield sample
+        except Exception:
+            sample.ok = False
+            raise
+        finally:
+            sample.seconds += time.perf_counter() - start_time
+            self.record(sample)
+
+    def record(self, sample: StageSample):
+        with self.lock:
+            totals = self.totals.setdefault(sample.stage, IngestMetrics.new_totals())
+            totals['samples'] += 1
+            totals['seconds'] += sample.seconds
+            totals['bytes'] += sample.bytes
+            totals['articles'] += sample.articles
+            totals['retries'] += sample.retries
+            totals['failures'] += 0 if sample.ok else 1
+            self.last_samples[sample.stage] = sample
+            if self.jsonl_path:
+                with open(self.jsonl_path, 'a') as f:
+                    f.write(json.dumps(sample.to_dict()) + '\n')
+
+    # Splits one file's parse into 'gunzip' (time/bytes inside the MeteredReader, .gz files only) and
+    # 'parse' (the rest of `seconds`).
+    def record_parse(self, file_name: str, seconds: float, articles: int, read_seconds: float = 0.0, read_bytes: int = 0, ok: bool = True):
+        if file_name.endswith('.gz'):
+            self.record(StageSample('gunzip', file_name, seconds=read_seconds, bytes=read_bytes, ok=ok))
+            seconds -= read_seconds
+        self.record(StageSample('parse', file_name, seconds=max(seconds, 0.0), bytes=read_bytes, articles=articles, ok=ok))
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {stage: dict(totals) for stage, totals in self.totals.items()}
+
+    def get_prometheus_text(self) -> str:
+        with self.lock:
+            totals = {stage: dict(stage_totals) for stage, stage_totals in self.totals.items()}
+            last_samples = dict(self.last_samples)
+
+        lines = []
+        counters = [
+            ('samples', 'Timed runs of each ingest stage.'),
+            ('seconds', 'Seconds spent in each ingest stage.'),
+            ('bytes', 'Bytes read or written by each ingest stage.'),
+            ('articles', 'Articles handled by each ingest stage.'),
+            ('retries', 'Retried attempts in each ingest stage.'),
+            ('failures', 'Failed runs of each ingest stage.'),
+        ]
+        for key, help_text in counters:
+            name = f'{self.prefix}_stage_{key}_total'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for stage, stage_totals in totals.items():
+                lines.append(f'{name}{{stage="{stage}"}} {stage_totals[key]}')
+
+        gauges = [
+            ('last_articles_per_second', 'Articles per second in the most recent run of each stage.', 'articles'),
+            ('last_bytes_per_second', 'Bytes per second in the most recent run of each stage.', 'bytes'),
+        ]
+        for key, help_text, field in gauges:
+            name = f'{self.prefix}_stage_{key}'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for stage, sample in last_samples.items():
+                rate = getattr(sample, field) / sample.seconds if sample.seconds else 0.0
+                lines.append(f'{name}{{stage="{stage}"}} {rate:.3f}')
+
+        name = f'{self.prefix}_last_flush_timestamp_seconds'
+        lines.append(f'# HELP {name} When these metrics were last written.')
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {time.time():.3f}')
+        return '\n'.join(lines) + '\n'
+
+    # The textfile collector may read the file at any moment, so it is swapped in whole.
+    def flush(self):
+        if not self.prometheus_path:
+            return
+        tmp_file = self.prometheus_path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(self.get_prometheus_text())
+        os.replace(tmp_file, self.prometheus_path)
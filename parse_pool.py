@@ -0,0 +1,68 @@
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import os
+import time
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from article import Article
+from metrics import IngestMetrics, MeteredReader
+from parse_xml import get_file_version, iter_articles, open_article_source
+from utils import Utils
+
+# parse_file() for the workers: also returns the parse time and the time/bytes spent reading (inflating)
+# the file, for IngestMetrics.record_parse() in the parent. `keep_xml` is passed on to iter_articles().
+def parse_file_metered(file_name: str, keep_xml: bool = False):
+    start_time = time.perf_counter()
+    with open_article_source(file_name) as f:
+        reader = MeteredReader(f)
+        articles = list(iter_articles(reader, get_file_version(file_name), keep_xml))
+    return articles, time.perf_counter() - start_time, reader.seconds, reader.bytes
+
+
+class ParsePool:
+    '''
+    Parses whole .xml/.xml.gz files in worker processes and hands the article lists back in submission order.
+    At most `max_pending` files are submitted but not yet consumed, so a slow writer stalls the pool
+    instead of letting parsed files pile up in memory. Each of those is a whole file's articles (with their
+    XML, for the article cache), so peak memory is about `max_pending` parsed files; the default of
+    `max_workers + 1` keeps every worker busy with one file queued behind them.
+    '''
+    def __init__(self, max_workers: Optional[int] = None, max_pending: Optional[int] = None, metrics: IngestMetrics = None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.max_workers + 1
+        self.metrics = metrics or IngestMetrics()
+
+    # Yields (file_name, articles); articles is None if the file couldn't be parsed. `load_cached(file_name)`
+    # may return a file's articles from a cache instead; those files never go to a worker, but still come
+    # back in submission order. `keep_xml` is passed on to iter_articles().
+    def imap(self, file_names: Iterable[str], load_cached: Callable[[str], Optional[List[Article]]] = None,
+             keep_xml: bool = False) -> Iterator[Tuple[str, Optional[List[Article]]]]:
+        pending = deque()
+        executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        try:
+            for file_name in file_names:
+                articles = load_cached(file_name) if load_cached else None
+                if articles is None:
+                    future = executor.submit(parse_file_metered, file_name, keep_xml)
+                else:
+                    future = Future()
+                    future.set_result((articles, None, 0.0, 0))
+                pending.append((file_name, future))
+                if len(pending) >= self.max_pending:
+                    yield self.collect(*pending.popleft())
+            while pending:
+                yield self.collect(*pending.popleft())
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def collect(self, file_name, future):
+        try:
+            articles, seconds, read_seconds, read_bytes = future.result()
+        except Exception as e:
+            Utils.print(f"Error parsing {file_name}: {e}", color='red')
+            self.metrics.record_parse(file_name, 0.0, 0, ok=False)
+            return file_name, None
+        # No parse time: the articles came from load_cached().
+        if seconds is not None:
+            self.metrics.record_parse(file_name, seconds, len(articles), read_seconds, read_bytes)
+        return file_name, articles
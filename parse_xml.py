@@ -1,7 +1,14 @@
 import calendar
-from typing import List
+import gzip
+import hashlib
+import json
+import os
+import re
+from typing import Iterable, Iterator, List, Optional
 import xml.etree.ElementTree as ET
 
+from article import Article, Author, Grant, Keyword, MeshHeading
+
 # In case there are sub-texts (e.g. <x>y</x>) within the <AbstractText> xml.
 def get_all_text(elem):
     text = elem.text or ""
@@ -10,11 +17,19 @@ def get_all_text(elem):
     text += elem.tail or ""
     return text
 
+# Text of the first `tag` child, or '' if there isn't one.
+def get_child_text(elem, tag):
+    child = elem.find(tag)
+    return child.text if child is not None else ''
+
 # date_type='pubmed' -> publish date
 # date_type='accepted' -> accepted date
 def get_date(pubmed_article, date_type='pubmed'):
     pubmed_date_element = pubmed_article.find(f".//PubMedPubDate[@PubStatus='{date_type}']")
-    
+    return format_pub_date(pubmed_date_element)
+
+# Formats a <PubMedPubDate> element as YYYY-MM-DD, or '' if it's missing or has no year.
+def format_pub_date(pubmed_date_element):
     try:
         year = int(pubmed_date_element.find('Year').text)
     except:
@@ -40,44 +55,78 @@ def get_date(pubmed_article, date_type='pubmed'):
 def get_authors(pubmed_article):
     authors = []
     for author in pubmed_article.findall('.//Author'):
-        # Extracting author's name
-        last_name = author.find('LastName').text if author.find('LastName') is not None else ''
-        fore_name = author.find('ForeName').text if author.find('ForeName') is not None else ''
-        name = f"{fore_name} {last_name}".strip()
+        authors.append(get_author(author))
+    return authors
 
-        # Extracting author's affiliations
-        # affiliations = [aff.text for aff in author.findall('.//AffiliationInfo/Affiliation')]
+def get_author(author):
+    return get_author_record(author).to_dict()
 
-        authors.append({'name': name, 'affiliations': []})
-    return authors
+def get_author_record(author):
+    # Extracting author's name
+    last_name = get_child_text(author, 'LastName')
+    fore_name = get_child_text(author, 'ForeName')
+    name = f"{fore_name} {last_name}".strip()
+
+    # Extracting author's affiliations
+    # affiliations = [aff.text for aff in author.findall('.//AffiliationInfo/Affiliation')]
+
+    return Author(name)
 
 def get_keywords(pubmed_article):
     keywords = []
     for keyword in pubmed_article.findall('.//KeywordList/Keyword'):
-        keyword_text = keyword.text
-        major_topic = keyword.attrib.get('MajorTopicYN', 'N') == 'Y'
-        keywords.append({'majorTopic': major_topic, 'name': keyword_text})
+        keywords.append(get_keyword(keyword))
     return keywords
 
+def get_keyword(keyword):
+    return get_keyword_record(keyword).to_dict()
+
+def get_keyword_record(keyword):
+    major_topic = keyword.attrib.get('MajorTopicYN', 'N') == 'Y'
+    return Keyword(keyword.text, major_topic)
+
 def get_grants(pubmed_article):
     grants = []
     for grant in pubmed_article.findall('.//GrantList/Grant'):
-        grant_id = grant.find('GrantID').text if grant.find('GrantID') is not None else ''
-        country = grant.find('Country').text if grant.find('Country') is not None else ''
-        agency = grant.find('Agency').text if grant.find('Agency') is not None else ''
-        if grant_id or country or agency:
-            grants.append({'grant_id': grant_id, 'grant_country': country, 'agency': agency})
+        grant = get_grant(grant)
+        if grant:
+            grants.append(grant)
     return grants
 
+def get_grant(grant):
+    grant = get_grant_record(grant)
+    return grant.to_dict() if grant else None
+
+# Returns None if the grant has no id, country or agency.
+def get_grant_record(grant):
+    grant_id = get_child_text(grant, 'GrantID')
+    country = get_child_text(grant, 'Country')
+    agency = get_child_text(grant, 'Agency')
+    if grant_id or country or agency:
+        return Grant(grant_id, country, agency)
+    return None
+
 def get_mesh_headings(pubmed_article):
     mesh_headings = []
     for mesh_heading in pubmed_article.findall('.//MeshHeadingList/MeshHeading'):
-        heading_name = mesh_heading.find('DescriptorName').text
-        major_topic = mesh_heading.find('DescriptorName').attrib.get('MajorTopicYN', 'N') == 'Y'
-        if heading_name:
-            mesh_headings.append({'majorTopic': major_topic, 'name': heading_name})
+        mesh_heading = get_mesh_heading(mesh_heading)
+        if mesh_heading:
+            mesh_headings.append(mesh_heading)
     return mesh_headings
 
+def get_mesh_heading(mesh_heading):
+    mesh_heading = get_mesh_heading_record(mesh_heading)
+    return mesh_heading.to_dict() if mesh_heading else None
+
+# Returns None if the descriptor has no name.
+def get_mesh_heading_record(mesh_heading):
+    descriptor = mesh_heading.find('DescriptorName')
+    heading_name = descriptor.text
+    if heading_name:
+        major_topic = descriptor.attrib.get('MajorTopicYN', 'N') == 'Y'
+        return MeshHeading(heading_name, major_topic)
+    return None
+
 def get_references(pubmed_article):
     references = []
     for reference in pubmed_article.findall('.//ReferenceList/Reference'):
@@ -96,7 +145,8 @@ def get_chemicals(pubmed_article):
     return chemicals
 
 
-def parse_article(pubmed_article):
+# Reference implementation built from one `.//` search per field; parse_article() must match its output.
+def parse_article_by_search(pubmed_article):
     try: 
         d = {
             'pubmed_id': pubmed_article.find('.//PMID').text,
@@ -154,19 +204,185 @@ def parse_article(pubmed_article):
     d['pub_types'] = publication_types
     return d
 
-def process_xml_to_article_list(xml_file: str) -> List[dict]:
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
-
-    article_list = []
-
-    ct_passed = 0
-    ct = 0
-    for pubmed_article in root.findall('PubmedArticle'):
-        article = parse_article(pubmed_article)
-        if article:
-            ct += 1
-        else:
-            ct_passed += 1
-        article_list.append(article)
-    return article_list
\ No newline at end of file
+# Tags parse_article() cares about; everything else is skipped with a single set lookup.
+ARTICLE_TAGS = frozenset([
+    'PMID', 'ArticleTitle', 'PubMedPubDate', 'Author', 'KeywordList', 'GrantList', 'MeshHeadingList',
+    'AbstractText', 'ArticleId', 'Journal', 'NlmUniqueID', 'PublicationType',
+])
+ARTICLE_DATE_TYPES = ('pubmed', 'accepted', 'received')
+
+# Same output as parse_article_by_search(), built from parse_article_record().
+def parse_article(pubmed_article):
+    record = parse_article_record(pubmed_article)
+    return record.to_dict() if record else {}
+
+# Walks the <PubmedArticle> subtree once, dispatching on tag, into an Article (None if the citation
+# has no PMID, title or pubmed date). The first match in document order wins for single-valued fields,
+# which is what `.find('.//...')` returned in parse_article_by_search().
+def parse_article_record(pubmed_article, version: int = 0):
+    pmid = article_title = doi = journal_title = nlm_unique_id = None
+    date_elements = {}
+    authors, keywords, grants, mesh_headings, abstract_texts, publication_types = [], [], [], [], [], []
+
+    for elem in pubmed_article.iter():
+        tag = elem.tag
+        if tag not in ARTICLE_TAGS:
+            continue
+        if tag == 'Author':
+            authors.append(get_author_record(elem))
+        elif tag == 'MeshHeadingList':
+            for mesh_heading in elem:
+                if mesh_heading.tag == 'MeshHeading':
+                    mesh_heading = get_mesh_heading_record(mesh_heading)
+                    if mesh_heading:
+                        mesh_headings.append(mesh_heading)
+        elif tag == 'PubMedPubDate':
+            date_type = elem.get('PubStatus')
+            if date_type in ARTICLE_DATE_TYPES and date_type not in date_elements:
+                date_elements[date_type] = elem
+        elif tag == 'KeywordList':
+            for keyword in elem:
+                if keyword.tag == 'Keyword':
+                    keywords.append(get_keyword_record(keyword))
+        elif tag == 'GrantList':
+            for grant in elem:
+                if grant.tag == 'Grant':
+                    grant = get_grant_record(grant)
+                    if grant:
+                        grants.append(grant)
+        elif tag == 'AbstractText':
+            abstract_texts.append(elem)
+        elif tag == 'PublicationType':
+            publication_types.append(elem.text)
+        elif tag == 'ArticleId':
+            if doi is None and elem.get('IdType') == 'doi':
+                doi = elem
+        elif tag == 'PMID':
+            if pmid is None:
+                pmid = elem
+        elif tag == 'ArticleTitle':
+            if article_title is None:
+                article_title = elem
+        elif tag == 'Journal':
+            if journal_title is None:
+                journal_title = elem.find('Title')
+        elif tag == 'NlmUniqueID':
+            if nlm_unique_id is None:
+                nlm_unique_id = elem
+
+    if pmid is None or article_title is None:
+        return None
+    pub_date = format_pub_date(date_elements.get('pubmed'))
+    if not pub_date:
+        return None
+
+    return Article(
+        pubmed_id=pmid.text,
+        title=get_all_text(article_title).strip(),
+        pub_date=pub_date,
+        accepted_date=format_pub_date(date_elements.get('accepted')),
+        received_date=format_pub_date(date_elements.get('received')),
+        authors=tuple(authors),
+        keywords=tuple(keywords),
+        grants=tuple(grants),
+        mesh_headings=tuple(mesh_headings),
+        # Sometimes, there are multiple <AbstractText>
+        abstract=' '.join([get_all_text(x).strip() for x in abstract_texts]),
+        doi=doi.text if doi is not None else None,
+        journal=get_all_text(journal_title).strip(),
+        nlm_unique_id=nlm_unique_id.text,
+        pub_types=tuple(publication_types),
+        version=version,
+    )
+
+# Parses a <PubmedArticle> kept by iter_articles(keep_xml=True) again, e.g. with a parser that was fixed since.
+def parse_article_xml(xml: bytes, version: int = 0) -> Optional[Article]:
+    article = parse_article_record(ET.fromstring(xml), version)
+    if article:
+        article.xml = xml
+    return article
+
+# pubmed24n1234.xml.gz -> 241234. Update files continue the baseline's numbering and every new baseline
+# bumps the year prefix, so a later file always gets a larger number. 0 if the name doesn't match.
+def get_file_version(file_name: str) -> int:
+    match = re.search(r'(\d+)n(\d+)', os.path.basename(file_name))
+    if match:
+        return int(match.group(1)) * 10000 + int(match.group(2))
+    return 0
+
+# Version of one record: the file's version, with the <PMID Version="..."> attribute as a tiebreak.
+def get_record_version(file_version: int, pmid_elem) -> int:
+    try:
+        pmid_version = int(pmid_elem.get('Version', 1))
+    except (AttributeError, ValueError):
+        pmid_version = 1
+    return file_version * 100 + min(pmid_version, 99)
+
+# Streams parsed records out of `source` (a path or a binary file object) without building the whole tree.
+# Each finished top-level element is dropped from the root as soon as it's parsed, so memory stays flat.
+# Records are Articles carrying a version (see get_record_version); every PMID in a <DeleteCitation>
+# block comes out as an Article.deleted_record(). With `keep_xml`, each article also gets its
+# <PubmedArticle> element as UTF-8 bytes, for the article cache (see parse_article_xml).
+def iter_articles(source, file_version: int = 0, keep_xml: bool = False) -> Iterator[Article]:
+    context = ET.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event != 'end':
+            continue
+        if elem.tag == 'PubmedArticle':
+            article = parse_article_record(elem, get_record_version(file_version, elem.find('MedlineCitation/PMID')))
+            if article:
+                if keep_xml:
+                    elem.tail = None
+                    article.xml = ET.tostring(elem, encoding='utf-8', xml_declaration=False)
+                yield article
+            root.clear()
+        elif elem.tag == 'DeleteCitation':
+            for pmid in elem.findall('PMID'):
+                yield Article.deleted_record(pmid.text, get_record_version(file_version, pmid))
+            root.clear()
+
+# Groups iter_articles() output into lists of at most `batch_size` records.
+def iter_article_batches(source, batch_size: int, file_version: int = 0, keep_xml: bool = False) -> Iterator[List[Article]]:
+    batch = []
+    for article in iter_articles(source, file_version, keep_xml):
+        batch.append(article)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Content hash stored for a deleted citation.
+DELETED_HASH = bytes(16)
+
+# Fingerprint of everything that ends up in MySQL/ES for an article, used to skip re-sent citations that didn't change.
+# Computed over the to_dict() shape so hashes stored before articles became Article records stay valid.
+def get_content_hash(article: Article) -> bytes:
+    if article.deleted:
+        return DELETED_HASH
+    canonical = json.dumps(article.to_dict(), sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.md5(canonical.encode('utf-8')).digest()
+
+# One record per PMID: the highest version, and of records with the same version the later one, since a
+# file can carry a <PubmedArticle> and a <DeleteCitation> for the same PMID. Records stay in document order.
+def latest_records(articles: Iterable[Article]) -> List[Article]:
+    latest = {}
+    for i, article in enumerate(articles):
+        current = latest.get(article.pubmed_id)
+        if current is None or article.version >= current[1].version:
+            latest[article.pubmed_id] = (i, article)
+    return [article for _, article in sorted(latest.values(), key=lambda entry: entry[0])]
+
+def process_xml_to_article_list(xml_file: str) -> List[Article]:
+    return [article for article in iter_articles(xml_file, get_file_version(xml_file)) if not article.deleted]
+
+# Opens a .xml or .xml.gz file as a binary stream for iter_articles().
+def open_article_source(file_name: str):
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, 'rb')
+    return open(file_name, 'rb')
+
+def parse_file(file_name: str) -> List[Article]:
+    with open_article_source(file_name) as f:
+        return list(iter_articles(f, get_file_version(file_name)))
@@ -0,0 +1,330 @@
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import os
+import queue
+import threading
+import time
+from typing import Iterable, Iterator, List, Optional
+
+from article import Article
+from metrics import MeteredReader, StageSample, timed_iter
+from parse_xml import get_file_version, iter_article_batches
+from utils import Utils
+
+# One batch of parsed articles from `file_name`; `last` marks the final batch of that file.
+# `content_hashes` ({pubmed_id: hash}) are stored once the batch's articles reached both writers.
+FileBatch = namedtuple('FileBatch', ['file_name', 'articles', 'last', 'content_hashes'], defaults=[None])
+
+# Marks the end of a stage's input.
+STOP = object()
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.articles = 0
+        self.wait_time = 0.0
+        self.elapsed = 0.0
+        self.depth_total = 0
+        self.depth_samples = 0
+        self.max_depth = 0
+
+    def record_depth(self, depth: int):
+        self.depth_total += depth
+        self.depth_samples += 1
+        self.max_depth = max(self.max_depth, depth)
+
+    def summary(self) -> dict:
+        busy_time = max(self.elapsed - self.wait_time, 0.0)
+        return {
+            'stage': self.name,
+            'items': self.items,
+            'articles': self.articles,
+            'busy_seconds': round(busy_time, 2),
+            'utilization': round(busy_time / self.elapsed, 2) if self.elapsed else 0.0,
+            'articles_per_busy_second': round(self.articles / busy_time, 1) if busy_time else 0.0,
+            'avg_queue_depth': round(self.depth_total / self.depth_samples, 2) if self.depth_samples else 0.0,
+            'max_queue_depth': self.max_depth,
+        }
+
+
+class Stage(threading.Thread):
+    '''
+    Runs `transform` over the items of `in_queue` in its own thread, putting each output on `out_queue`.
+    Time blocked on either queue counts as waiting, the rest as busy. If the transform raises, the stage
+    keeps draining its input so upstream stages never block on a full queue.
+    '''
+    def __init__(self, name: str, transform, in_queue: queue.Queue, out_queue: Optional[queue.Queue]):
+        super().__init__(name=f'pipeline-{name}', daemon=True)
+        self.transform = transform
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.stats = StageStats(name)
+
+    def iter_input(self) -> Iterator:
+        while True:
+            start_time = time.perf_counter()
+            item = self.in_queue.get()
+            self.stats.wait_time += time.perf_counter() - start_time
+            if item is STOP:
+                return
+            self.stats.record_depth(self.in_queue.qsize())
+            yield item
+
+    def run(self):
+        start_time = time.perf_counter()
+        input_items = self.iter_input()
+        try:
+            for item in self.transform(input_items):
+                self.stats.items += 1
+                if isinstance(item, FileBatch):
+                    self.stats.articles += len(item.articles)
+                if self.out_queue is not None:
+                    put_start = time.perf_counter()
+                    self.out_queue.put(item)
+                    self.stats.wait_time += time.perf_counter() - put_start
+        except Exception as e:
+            Utils.print(f"Pipeline stage {self.stats.name} failed: {e}", color='red')
+            for _ in input_items:
+                pass
+        finally:
+            if self.out_queue is not None:
+                self.out_queue.put(STOP)
+            self.stats.elapsed = time.perf_counter() - start_time
+
+
+class IngestPipeline:
+    '''
+    download -> parse -> diff -> MySQL -> Elasticsearch -> record, each stage in its own thread with a
+    bounded queue in front of it, so file N+1 downloads while file N parses and file N-1 is written.
+    The download stage fetches up to `queue_size` files at once on the downloader's workers, but hands
+    them on in the order given, since update files have to be applied in sequence.
+    The diff stage drops articles whose content hash hasn't changed. Hashes are only stored by the record
+    stage, so until then the diff stage compares later files against `pending_hashes` instead of the DB;
+    a file compared against another file's pending hashes is dropped if that file fails.
+    A file is only recorded in indexed_pubmed_files (and its .gz removed) once every batch made it through
+    both writers.
+    With file leases (PubmedUpdate.lease_files), each file's lease is marked 'parsed' and 'db_done' as
+    its last batch passes those stages, and a file whose lease was taken over is dropped like a failed one.
+    '''
+    def __init__(self, update, queue_size: int = 4, batch_size: int = 5000):
+        self.update = update
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        # Where the files of the current run() are downloaded from (pubmed_load.BASELINE_FILES / UPDATE_FILES).
+        self.location = None
+        self.failed_files = set()
+        # {pubmed_id: (content_hash, version, file_name)} of changed records the diff stage passed on and the
+        # record stage hasn't stored yet.
+        self.pending_hashes = {}
+        # {file_name: files whose pending hashes its diff used}.
+        self.dependencies = {}
+        # Every stage thread adds to failed_files; the diff, record and failing stages touch pending_hashes.
+        self.failed_lock = threading.Lock()
+        self.skipped_articles = 0
+
+    # A failed file's hashes will never be stored, so later files are compared against the DB again.
+    def fail(self, file_name: str):
+        with self.failed_lock:
+            self.failed_files.add(file_name)
+            self.pending_hashes = {pubmed_id: pending for pubmed_id, pending in self.pending_hashes.items()
+                                   if pending[2] != file_name}
+
+    def get_pending_hashes(self, file_name: str, articles: List[Article]) -> dict:
+        with self.failed_lock:
+            pending = {article.pubmed_id: self.pending_hashes[article.pubmed_id] for article in articles
+                       if article.pubmed_id in self.pending_hashes}
+            sources = {entry[2] for entry in pending.values()} - {file_name}
+            if sources:
+                self.dependencies.setdefault(file_name, set()).update(sources)
+            return {pubmed_id: entry[:2] for pubmed_id, entry in pending.items()}
+
+    def add_pending_hashes(self, file_name: str, content_hashes: dict):
+        with self.failed_lock:
+            if file_name in self.failed_files:
+                return
+            for pubmed_id, (content_hash, version) in content_hashes.items():
+                self.pending_hashes[pubmed_id] = (content_hash, version, file_name)
+
+    # Only entries still from `file_name`: a later file may have replaced one in the meantime.
+    def remove_pending_hashes(self, file_name: str, content_hashes: dict):
+        with self.failed_lock:
+            for pubmed_id, (content_hash, version) in content_hashes.items():
+                if self.pending_hashes.get(pubmed_id) == (content_hash, version, file_name):
+                    del self.pending_hashes[pubmed_id]
+
+    def fetch(self, file_name: str) -> bool:
+        if os.path.exists(file_name):
+            return True
+        return self.update.downloader.download(self.location + file_name, file_name)
+
+    def download(self, file_names: Iterable[str]) -> Iterator[str]:
+        max_workers = min(self.update.downloader.max_workers, self.queue_size)
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pipeline-download') as executor:
+            pending = deque()
+            for file_name in file_names:
+                pending.append((file_name, executor.submit(self.fetch, file_name)))
+                # Stay at most queue_size files ahead of the parse stage.
+                while len(pending) >= self.queue_size:
+                    yield from self.downloaded(*pending.popleft())
+            while pending:
+                yield from self.downloaded(*pending.popleft())
+
+    def downloaded(self, file_name: str, future) -> Iterator[str]:
+        if future.result():
+            yield file_name
+        else:
+            self.fail(file_name)
+
+    @staticmethod
+    def split_batches(file_name: str, article_batches: Iterable[List[Article]]) -> Iterator[FileBatch]:
+        previous = None
+        for batch in article_batches:
+            if previous is not None:
+                yield FileBatch(file_name, previous, False)
+            previous = batch
+        yield FileBatch(file_name, previous or [], True)
+
+    def parse(self, file_names: Iterable[str]) -> Iterator[FileBatch]:
+        if self.update.parse_pool:
+            for file_name, article_batches in self.update.parse_in_pool(file_names, self.batch_size):
+                if article_batches is None:
+                    self.fail(file_name)
+                    continue
+                yield from IngestPipeline.split_batches(file_name, article_batches)
+            return
+
+        for file_name in file_names:
+            try:
+                cached_batches, checksum = self.update.open_cached(file_name, self.batch_size)
+                if cached_batches is not None:
+                    yield from IngestPipeline.split_batches(file_name, cached_batches)
+                    continue
+            except Exception as e:
+                Utils.print(f"Error reading cached articles of {file_name}: {e}", color='red')
+                self.fail(file_name)
+                continue
+
+            # Only the time spent producing batches counts, not the time spent waiting on the diff stage.
+            sample = StageSample('parse', file_name)
+            reader = None
+            try:
+                with self.update.open_gz(file_name, checksum) as (f, get_checksum):
+                    reader = MeteredReader(f)
+                    article_batches = timed_iter(iter_article_batches(reader, self.batch_size, get_file_version(file_name),
+                                                                      self.update.article_cache is not None), sample)
+                    yield from IngestPipeline.split_batches(file_name, self.update.cache_batches(file_name, article_batches, get_checksum))
+            except Exception as e:
+                Utils.print(f"Error parsing {file_name}: {e}", color='red')
+                self.fail(file_name)
+                sample.ok = False
+            self.update.metrics.record_parse(file_name, sample.seconds, sample.articles, reader.seconds if reader else 0.0,
+                                             reader.bytes if reader else 0, sample.ok)
+
+    # True (and the file counts as failed) if the file failed in an earlier stage, its lease was lost or a
+    # file whose pending hashes it was compared against failed (what it skipped may never have been written).
+    def is_dropped(self, file_name: str) -> bool:
+        if self.update.lease_lost(file_name):
+            self.fail(file_name)
+        with self.failed_lock:
+            if file_name in self.failed_files:
+                return True
+            failed_dependencies = self.dependencies.get(file_name, set()) & self.failed_files
+        if failed_dependencies:
+            Utils.print(f'Dropping {file_name}: it was compared against hashes of failed files', sorted(failed_dependencies), color='red')
+            self.fail(file_name)
+            return True
+        return False
+
+    def diff(self, batches: Iterable[FileBatch]) -> Iterator[FileBatch]:
+        for batch in batches:
+            if self.is_dropped(batch.file_name):
+                continue
+            if batch.last:
+                self.update.mark_file(batch.file_name, 'parsed')
+            changed_articles, content_hashes = self.update.filter_changed_articles(
+                batch.articles, pending_hashes=self.get_pending_hashes(batch.file_name, batch.articles))
+            self.add_pending_hashes(batch.file_name, content_hashes)
+            self.skipped_articles += len(batch.articles) - len(changed_articles)
+            yield batch._replace(articles=changed_articles, content_hashes=content_hashes)
+
+    # Passes batches through `push` (one of PubmedUpdate's writers), dropping the rest of a file once it fails.
+    # `done_status` is the lease status a file reaches once its last batch is written.
+    def write(self, batches: Iterable[FileBatch], push, done_status: str = None) -> Iterator[FileBatch]:
+        for batch in batches:
+            if self.is_dropped(batch.file_name):
+                continue
+            if batch.articles and not push(batch.articles, batch.file_name):
+                self.fail(batch.file_name)
+                continue
+            if batch.last and done_status:
+                self.update.mark_file(batch.file_name, done_status)
+            yield batch
+
+    def push_to_db(self, batches: Iterable[FileBatch]) -> Iterator[FileBatch]:
+        return self.write(batches, self.update.push_articles_to_db, 'db_done')
+
+    def push_to_elastic(self, batches: Iterable[FileBatch]) -> Iterator[FileBatch]:
+        return self.write(batches, self.update.push_articles_to_elastic)
+
+    # Recording the file also completes its lease ('es_done', see SQLManager.write_file_names).
+    def record(self, batches: Iterable[FileBatch]) -> Iterator[str]:
+        for batch in batches:
+            if self.is_dropped(batch.file_name):
+                continue
+            if batch.content_hashes:
+                if not self.update.write_content_hashes(batch.content_hashes, batch.file_name):
+                    self.fail(batch.file_name)
+                    continue
+                self.remove_pending_hashes(batch.file_name, batch.content_hashes)
+            if not batch.last:
+                continue
+            if self.update.record_file_name(batch.file_name):
+                try:
+                    os.remove(batch.file_name)
+                except FileNotFoundError:
+                    # Another worker sharing the directory cleaned it up once it was recorded.
+                    pass
+                yield batch.file_name
+
+    def run(self, file_names: List[str], location: str) -> List[dict]:
+        self.location = location
+        self.failed_files = set()
+        self.pending_hashes = {}
+        self.dependencies = {}
+        self.skipped_articles = 0
+        transforms = [
+            ('download', self.download),
+            ('parse', self.parse),
+            ('diff', self.diff),
+            ('mysql', self.push_to_db),
+            ('elasticsearch', self.push_to_elastic),
+            ('record', self.record),
+        ]
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in transforms]
+        stages = []
+        for i, (name, transform) in enumerate(transforms):
+            out_queue = queues[i + 1] if i + 1 < len(queues) else None
+            stages.append(Stage(name, transform, queues[i], out_queue))
+
+        start_time = time.perf_counter()
+        for stage in stages:
+            stage.start()
+        for file_name in file_names:
+            queues[0].put(file_name)
+        queues[0].put(STOP)
+        for stage in stages:
+            stage.join()
+        elapsed = time.perf_counter() - start_time
+        self.update.metrics.flush()
+
+        summary = [stage.stats.summary() for stage in stages]
+        Utils.print(f'Pipeline finished {len(file_names)} files in {elapsed:.1f}s, skipped {self.skipped_articles} unchanged articles. '
+                    'Failed files:', sorted(self.failed_files))
+        for s in summary:
+            Utils.print(f"  {s['stage']}: {s['items']} items, {s['articles']} articles, busy {s['busy_seconds']}s "
+                        f"({s['utilization']:.0%}), {s['articles_per_busy_second']} articles/s, "
+                        f"queue depth avg {s['avg_queue_depth']} max {s['max_queue_depth']}")
+        Utils.print('  Writer limits: mysql', self.update.db.write_limiter.snapshot(), 'elasticsearch', self.update.ep.limiter.snapshot())
+        return summary
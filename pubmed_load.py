@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from enum import Enum
 import gzip
 import os
@@ -5,26 +6,75 @@ import re
 import shutil
 import time
 import traceback
-from typing import Dict, Tuple
-from bs4 import BeautifulSoup
-import requests
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional, Tuple
+from article import Article
+from article_cache import ARTICLE_CACHE_MAX_BYTES, ArticleCache, ChecksumReader
 from db_manager import SQLManager
+from downloader import GzDownloader
 from elasticsearch_post import ElasticPush
-from elasticsearch.helpers import BulkIndexError
-
-from parse_xml import process_xml_to_article_list
+from lease import LEASE_SECONDS, LeaseKeeper
+from metrics import IngestMetrics, MeteredReader, StageSample, timed_iter
+from parse_pool import ParsePool
+from pipeline import IngestPipeline
+from parse_xml import get_content_hash, get_file_version, iter_article_batches, latest_records, parse_article_xml
+from throttle import jittered_backoff
 from utils import Utils
 
 
 UPDATE_FILES = "https://ftp.ncbi.nlm.nih.gov/pubmed/updatefiles/"
 BASELINE_FILES = "https://ftp.ncbi.nlm.nih.gov/pubmed/baseline/"
 
-class PubmedUpdate:
-    current_location = BASELINE_FILES
+# Max number of parsed articles held in memory (and sent per DB/ES push) while streaming a file.
+ARTICLE_BATCH_SIZE = 5000
+
+# Pause between whole-batch attempts of a writer: jittered, RETRY_BACKOFF_SECONDS * 2**attempt at most.
+# Throttling and transient errors are retried inside ElasticPush / SQLManager first, so this is for outages.
+RETRY_BACKOFF_SECONDS = 15
+RETRY_MAX_BACKOFF_SECONDS = 300
+
+# Coarsest directory mtime step on the filesystems we run on. A directory scan taken within this long of the
+# directory's mtime isn't reused, since a file added in the same step wouldn't move the mtime.
+DATA_FILES_MTIME_GRANULARITY_SECONDS = 2
 
-    def __init__(self):
+class PubmedUpdate:
+    # stream_gz=True parses the downloaded .gz files directly instead of unpacking them to .xml first.
+    # parse_workers > 1 parses that many .gz files in parallel worker processes (stream_gz mode only).
+    # parse_max_pending caps the parsed files held in memory at once (see ParsePool); parse_workers + 1 by default.
+    # download_workers sets how many files are fetched at once; download_batch_size caps the files fetched per round.
+    # pipelined=True overlaps download, parse, MySQL and ES work in an IngestPipeline instead of one state at a time.
+    # bulk_load_baseline=True runs baseline backfills inside ElasticPush.bulk_load (no refreshes or replicas until done).
+    # skip_unchanged=True only writes articles whose content hash differs from the one stored in pubmed_article_hashes.
+    # metrics_jsonl_path / metrics_prometheus_path export per-stage timings (see IngestMetrics); both are off by default.
+    # article_cache_dir keeps each file's parsed records on disk (see ArticleCache) for replay() and, through its
+    # PMID index, reprocess(); off by default.
+    # lease_files=True lets several workers (on any number of machines) share the ingest: each run of the pipeline
+    # only takes files this worker claimed in pubmed_file_leases, at most lease_batch_size at a time (see LeaseKeeper),
+    # and only recorded files are deleted, so workers can share a directory. Needs pipelined=True (ValueError
+    # otherwise). worker_id defaults to host:pid.
+    def __init__(self, stream_gz: bool = True, parse_workers: int = 1, download_workers: int = 4, download_batch_size: int = 5,
+                 pipelined: bool = True, bulk_load_baseline: bool = True, skip_unchanged: bool = True,
+                 metrics_jsonl_path: str = None, metrics_prometheus_path: str = None,
+                 article_cache_dir: str = None, article_cache_max_bytes: int = ARTICLE_CACHE_MAX_BYTES,
+                 lease_files: bool = False, worker_id: str = None, lease_batch_size: int = 4, lease_seconds: int = LEASE_SECONDS,
+                 parse_max_pending: int = None):
+        self.stream_gz = stream_gz
+        self.article_cache = ArticleCache(article_cache_dir, article_cache_max_bytes) if article_cache_dir else None
+        self.metrics = IngestMetrics(jsonl_path=metrics_jsonl_path, prometheus_path=metrics_prometheus_path)
+        self.parse_pool = (ParsePool(max_workers=parse_workers, max_pending=parse_max_pending, metrics=self.metrics)
+                           if parse_workers > 1 else None)
+        self.downloader = GzDownloader(max_workers=download_workers, metrics=self.metrics)
+        self.download_batch_size = download_batch_size
+        self.pipeline = IngestPipeline(self, batch_size=ARTICLE_BATCH_SIZE) if pipelined else None
+        self.bulk_load_baseline = bulk_load_baseline
+        self.skip_unchanged = skip_unchanged
         self.db = SQLManager()
         self.ep = ElasticPush()
+        self.data_files = None
+        if lease_files and not pipelined:
+            raise ValueError('lease_files=True needs pipelined=True')
+        self.lease_keeper = LeaseKeeper(self.db, worker_id, lease_seconds) if lease_files else None
+        self.lease_batch_size = lease_batch_size
 
     @staticmethod
     def extract_number_from_filename(filename):
@@ -34,39 +84,37 @@ class PubmedUpdate:
             return int(match.group(1))
         return 0  # return 0 if no match is found
     
-    @staticmethod 
-    def locate_files(url: str, previously_seen_files):
-        response = requests.get(url)
-        soup = BeautifulSoup(response.text, "html.parser")
-        file_names = [link.get("href") for link in soup.find_all('a')]
-        gz_files = [f for f in file_names if f.endswith('.gz') and f not in previously_seen_files]
-        return gz_files
+    # `previously_seen_files` is a set. The listing itself is only re-downloaded when NCBI says it changed.
+    def locate_files(self, url: str, previously_seen_files):
+        return [f for f in self.downloader.list_gz_files(url) if f not in previously_seen_files]
 
-    @staticmethod
-    def find_unread_web_files(previously_seen_files):
-        unread_web_files = PubmedUpdate.locate_files(BASELINE_FILES, previously_seen_files)
+    # (location, unread files): the baseline is read before any update file.
+    def find_unread_web_files(self, previously_seen_files):
+        unread_web_files = self.locate_files(BASELINE_FILES, previously_seen_files)
         if len(unread_web_files) > 0:
-            PubmedUpdate.current_location = BASELINE_FILES
-            return unread_web_files
+            return BASELINE_FILES, unread_web_files
+        return UPDATE_FILES, self.locate_files(UPDATE_FILES, previously_seen_files)
 
-        unread_web_files = PubmedUpdate.locate_files(UPDATE_FILES, previously_seen_files)
-        PubmedUpdate.current_location = UPDATE_FILES
-        return unread_web_files
+    # BASELINE_FILES if every one of `file_names` is in the baseline listing, else UPDATE_FILES. For files
+    # already on disk, which may have been downloaded by an earlier run. If the listing can't be read the
+    # files count as updates, which keeps bulk-load mode off.
+    def get_location(self, file_names) -> str:
+        try:
+            baseline_files = set(self.downloader.list_gz_files(BASELINE_FILES))
+        except Exception as e:
+            Utils.print(f"Error listing {BASELINE_FILES}: {e}", color='red')
+            return UPDATE_FILES
+        return BASELINE_FILES if all(f in baseline_files for f in file_names) else UPDATE_FILES
 
-    @staticmethod
-    def download_file(url: str, save_path: str):
-        with requests.get(url, stream=True) as response:
-            with open(save_path, 'wb') as out_file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    out_file.write(chunk)
-
-    @staticmethod
-    def download_all_gz_files(gz_file_names):
+    # Files only appear under their .gz name once their md5 checks out; see GzDownloader.
+    def download_all_gz_files(self, gz_file_names, location: str):
+        to_download = []
         for file_name in gz_file_names:
             if not os.path.exists(file_name) and not os.path.exists(file_name[:-3]):
-                full_url = PubmedUpdate.current_location + file_name
+                full_url = location + file_name
                 Utils.print('Attempting download for', file_name)
-                PubmedUpdate.download_file(full_url, file_name)
+                to_download.append((full_url, file_name))
+        return self.downloader.download_all(to_download)
 
     @staticmethod
     def get_gz_files():
@@ -80,6 +128,19 @@ class PubmedUpdate:
         xml_files = sorted(xml_files, key=PubmedUpdate.extract_number_from_filename)
         return xml_files
 
+    # (gz_files, xml_files) from one directory scan, reused for as long as the directory's mtime (which
+    # moves on every create, delete or rename in it) stays the same, and was old enough at the scan to trust.
+    def get_data_files(self):
+        mtime = os.stat('.').st_mtime_ns
+        if self.data_files is None or self.data_files[0] != mtime:
+            scan_time = time.time_ns()
+            file_names = os.listdir()
+            gz_files = sorted((f for f in file_names if f.endswith('.gz')), key=PubmedUpdate.extract_number_from_filename)
+            xml_files = sorted((f for f in file_names if f.endswith('.xml')), key=PubmedUpdate.extract_number_from_filename)
+            trusted = scan_time - mtime > DATA_FILES_MTIME_GRANULARITY_SECONDS * 10**9
+            self.data_files = (mtime if trusted else None, gz_files, xml_files)
+        return self.data_files[1], self.data_files[2]
+
     @staticmethod
     def write_xml_file_from_gz(gz_file: str, max_retries: int = 2):
         backoff_time = 2
@@ -96,89 +157,383 @@ class PubmedUpdate:
         Utils.print(f"Failed to unpack {gz_file} after {max_retries} attempts.", color='red')
         return False
 
-    def reset_state(self, sleep_time:int=60, update_elastic=True):
-        if update_db:
-            self.db = SQLManager()
-        if update_elastic:
-            self.ep = ElasticPush()
-        Utils.print(f'Sleeping for {sleep_time} seconds')
+    # MySQL connections heal themselves in SQLManager's pool, so only the ES client gets rebuilt here (on the
+    # same ElasticPush, which keeps its limiter), and only if ElasticPush built it: a client passed in is the
+    # caller's to manage. Without `sleep_time`, sleeps a jittered backoff for `attempt`.
+    def reset_state(self, sleep_time: float = None, update_elastic=True, attempt: int = 0):
+        if update_elastic and self.ep.owns_client:
+            self.ep.refresh_connection()
+        if sleep_time is None:
+            sleep_time = jittered_backoff(attempt, RETRY_BACKOFF_SECONDS, RETRY_MAX_BACKOFF_SECONDS)
+        Utils.print(f'Sleeping for {sleep_time:.0f} seconds')
         time.sleep(sleep_time)
 
-    def push_xml_file(self, xml_file: str, max_retries:int=2):
-        list_of_articles = process_xml_to_article_list(xml_file)
+    def push_articles_to_db(self, list_of_articles, file_name: str, max_retries:int=2):
+        with self.metrics.timer('mysql', file_name) as sample:
+            sample.articles = len(list_of_articles)
+            sample.ok = self.push_articles_to_db_with_retries(list_of_articles, file_name, max_retries, sample)
+        return sample.ok
+
+    def push_articles_to_db_with_retries(self, list_of_articles, file_name: str, max_retries: int, sample: StageSample):
         for attempt in range(max_retries):
+            sample.retries = attempt
             try:
                 if self.db.push_pubmed_articles(list_of_articles):
-                    Utils.print('Successfully pushed', xml_file, 'to database.', color='green')
-                    break
+                    Utils.print('Successfully pushed', len(list_of_articles), 'articles from', file_name, 'to database.', color='green')
+                    return True
             except Exception as e:
                 Utils.print(f"Error pushing to DB on attempt {attempt+1}: {e}", color='red')
-            self.reset_state(update_elastic=False, sleep_time=60*(attempt + 1))
-        else:
-            Utils.print(f"Failed to push to db after {max_retries} attempts.", color='red')
-            return False
+            self.reset_state(update_elastic=False, attempt=attempt)
+        Utils.print(f"Failed to push to db after {max_retries} attempts.", color='red')
+        return False
+
+    def push_articles_to_elastic(self, list_of_articles, file_name: str, max_retries:int=2):
+        with self.metrics.timer('elasticsearch', file_name) as sample:
+            sample.articles = len(list_of_articles)
+            sample.ok = self.push_articles_to_elastic_with_retries(list_of_articles, file_name, max_retries, sample)
+        return sample.ok
 
+    # Each attempt after the first only sends the documents that failed in the one before (ElasticPush logs why).
+    def push_articles_to_elastic_with_retries(self, list_of_articles, file_name: str, max_retries: int, sample: StageSample):
+        remaining = list_of_articles
         for attempt in range(max_retries):
+            sample.retries = attempt
             try:
-                if self.ep.bulk_insert(list_of_articles):
-                    Utils.print('Successfully pushed', xml_file, 'to ElasticSearch.', color='green')
-                    break
-            except BulkIndexError as bie:
-                Utils.print('ElasticSearch BulkIndexError. Successful inserts: {bie.successful}. Failed inserts: {bie.failed}', color='red')
-                for error in bie.errors:
-                    Utils.print(error)
-                raise bie
+                remaining = self.ep.insert_articles(remaining)
+                if not remaining:
+                    Utils.print('Successfully pushed', len(list_of_articles), 'articles from', file_name, 'to ElasticSearch.', color='green')
+                    return True
+                Utils.print(f'{len(remaining)} of {len(list_of_articles)} documents from {file_name} failed on attempt {attempt+1}', color='red')
             except Exception as e:
                 Utils.print(f"Error pushing to Elasticsearch on attempt {attempt+1}: {e}", color='red')
-                error_context = f"Context: Attempt {attempt + 1}, XML File: {xml_file}"
+                error_context = f"Context: Attempt {attempt + 1}, File: {file_name}"
                 Utils.print(error_context, color='red')
                 Utils.print("Traceback:", color='red')
                 Utils.print(traceback.format_exc(), color='red')
 
-                self.reset_state(sleep_time=60*(attempt + 1))
-        else:
-            Utils.print(f"Failed to push to Elasticsearch after {max_retries} attempts.", color='red')
-            return False
-        
-        for attempt in range(max_retries):
-            try:
-                # This should alter db.get_indexed_pubmed_files(), and trigger a deletion of the logged files.
-                if self.db.write_file_name(xml_file + '.gz'): # Write the name of the .gz file for easy-checking when reading DB.
-                    Utils.print('Successfully wrote file name', xml_file, "to database.", color='green')
-                    break
-            except:
-                Utils.print(f"Error writing file name '{xml_file}' to database {attempt+1}: {e}", color='red')
-            time.sleep(5)
+                self.reset_state(attempt=attempt)
+        Utils.print(f"Failed to push to Elasticsearch after {max_retries} attempts.", color='red')
+        return False
+
+    # Returns the records that are new or changed since they were last written, and their
+    # {pubmed_id: (content_hash, version)}, which should only be stored once those records made it to
+    # both MySQL and ES. A record older than the stored version is dropped, so an out-of-order update
+    # file can't roll an article back. Only the latest record of each PMID is kept (see latest_records),
+    # so a batch never sends the writers two records of one PMID. `pending_hashes` ({pubmed_id: (content_hash,
+    # version)}) are those of records on their way to the writers but not stored yet; they win over the DB's.
+    def filter_changed_articles(self, list_of_articles, skip_unchanged: bool = None, pending_hashes: dict = None):
+        if skip_unchanged is None:
+            skip_unchanged = self.skip_unchanged
+        hashed_articles = [(article, get_content_hash(article)) for article in latest_records(list_of_articles)]
+        content_hashes = {article.pubmed_id: (content_hash, article.version) for article, content_hash in hashed_articles}
+        if not skip_unchanged:
+            return [article for article, _ in hashed_articles], content_hashes
+        try:
+            stored_hashes = self.db.get_content_hashes(content_hashes.keys())
+        except Exception as e:
+            Utils.print(f"Error loading content hashes, writing every article: {e}", color='red')
+            return [article for article, _ in hashed_articles], content_hashes
+        if pending_hashes:
+            stored_hashes.update(pending_hashes)
+
+        changed = []
+        for article, content_hash in hashed_articles:
+            stored = stored_hashes.get(article.pubmed_id)
+            if stored is None:
+                changed.append(article)
+                continue
+            stored_hash, stored_version = stored
+            if article.version >= stored_version and content_hash != stored_hash:
+                changed.append(article)
+        return changed, {article.pubmed_id: content_hashes[article.pubmed_id] for article in changed}
+
+    # `gz_file_name` is the name recorded in indexed_pubmed_files once every batch has been pushed.
+    def push_article_batches(self, article_batches, gz_file_name: str, max_retries:int=2, skip_unchanged: bool = None):
+        num_skipped = 0
+        for list_of_articles in article_batches:
+            changed_articles, content_hashes = self.filter_changed_articles(list_of_articles, skip_unchanged)
+            num_skipped += len(list_of_articles) - len(changed_articles)
+            if not changed_articles:
+                continue
+            if not self.push_articles_to_db(changed_articles, gz_file_name, max_retries):
+                return False
+            if not self.push_articles_to_elastic(changed_articles, gz_file_name, max_retries):
+                return False
+            if not self.write_content_hashes(content_hashes, gz_file_name):
+                return False
+
+        Utils.print('Skipped', num_skipped, 'unchanged articles in', gz_file_name)
+        self.record_file_name(gz_file_name, max_retries)
         return True
 
+    # A file whose hashes weren't stored must not be recorded either: the stale hashes could later match an
+    # older version of an article and make skip_unchanged drop a write that was needed.
+    def write_content_hashes(self, content_hashes, file_name: str) -> bool:
+        with self.metrics.timer('hashes', file_name) as sample:
+            sample.articles = len(content_hashes)
+            sample.ok = self.db.write_content_hashes(content_hashes)
+        return sample.ok
+
+    # Also the end of a file's trip through the ingest, so the Prometheus textfile is refreshed here.
+    def record_file_name(self, gz_file_name: str, max_retries:int=2):
+        with self.metrics.timer('record', gz_file_name) as sample:
+            sample.ok = False
+            for attempt in range(max_retries):
+                sample.retries = attempt
+                try:
+                    # This should alter db.get_indexed_pubmed_files(), and trigger a deletion of the logged files.
+                    if self.db.write_file_name(gz_file_name): # Write the name of the .gz file for easy-checking when reading DB.
+                        Utils.print('Successfully wrote file name', gz_file_name, "to database.", color='green')
+                        sample.ok = True
+                        if self.lease_keeper:
+                            self.lease_keeper.finish(gz_file_name)
+                        break
+                except Exception as e:
+                    Utils.print(f"Error writing file name '{gz_file_name}' to database {attempt+1}: {e}", color='red')
+                time.sleep(5)
+        self.metrics.flush()
+        return sample.ok
+
+    # `source` is a binary stream (e.g. a gzip file object) for ET.iterparse.
+    # `get_checksum` is passed on to cache_batches().
+    def push_article_source(self, source, gz_file_name: str, max_retries:int=2, batch_size:int=ARTICLE_BATCH_SIZE, get_checksum=None):
+        # Stream the source in bounded batches so only `batch_size` parsed articles are alive at once.
+        reader = MeteredReader(source)
+        sample = StageSample('parse', gz_file_name)
+        article_batches = iter_article_batches(reader, batch_size, get_file_version(gz_file_name), self.article_cache is not None)
+        article_batches = timed_iter(article_batches, sample)
+        article_batches = self.cache_batches(gz_file_name, article_batches, get_checksum)
+        try:
+            return self.push_article_batches(article_batches, gz_file_name, max_retries)
+        finally:
+            # GzipFile.name is the .gz path, so only real decompression is reported as 'gunzip'.
+            self.metrics.record_parse(getattr(source, 'name', gz_file_name), sample.seconds, sample.articles, reader.seconds, reader.bytes)
+
+    def push_article_list(self, list_of_articles, gz_file_name: str, max_retries:int=2, batch_size:int=ARTICLE_BATCH_SIZE):
+        article_batches = (list_of_articles[i:i + batch_size] for i in range(0, len(list_of_articles), batch_size))
+        return self.push_article_batches(article_batches, gz_file_name, max_retries)
+
+    def push_xml_file(self, xml_file: str, max_retries:int=2, batch_size:int=ARTICLE_BATCH_SIZE):
+        with open(xml_file, 'rb') as f:
+            return self.push_article_source(f, xml_file + '.gz', max_retries, batch_size)
+
+    # Parses straight out of the gzip stream, so the inflated .xml never touches the disk.
+    def push_gz_file(self, gz_file: str, max_retries:int=2, batch_size:int=ARTICLE_BATCH_SIZE):
+        cached_batches, checksum = self.open_cached(gz_file, batch_size)
+        if cached_batches is not None:
+            return self.push_article_batches(cached_batches, gz_file, max_retries)
+        try:
+            with self.open_gz(gz_file, checksum) as (f_in, get_checksum):
+                return self.push_article_source(f_in, gz_file, max_retries, batch_size, get_checksum)
+        except (OSError, EOFError) as e:
+            Utils.print(f"Error reading {gz_file}: {e}", color='red')
+            return False
+
+    # Opens a local .gz for parsing: (gzip stream, function returning the .gz's md5 for cache_batches()). With the
+    # article cache on and the md5 not known yet, it is computed from the compressed bytes as gzip reads them.
+    @contextmanager
+    def open_gz(self, gz_file: str, checksum: str = None):
+        with open(gz_file, 'rb') as raw:
+            reader = ChecksumReader(raw) if self.article_cache is not None and checksum is None else None
+            with gzip.GzipFile(fileobj=reader or raw, mode='rb') as source:
+                yield source, reader.hexdigest if reader else (lambda: checksum)
+
+    # (cached batches, checksum of the local .gz). The batches are None when there is no cache or no entry
+    # matching the .gz. The checksum is the one the downloader verified; a .gz downloaded by an earlier run is
+    # only md5'd here if the cache has an entry under its name at all, and otherwise left to open_gz().
+    def open_cached(self, gz_file: str, batch_size: int = ARTICLE_BATCH_SIZE):
+        if self.article_cache is None or not os.path.exists(gz_file):
+            return None, None
+        checksum = self.downloader.checksums.get(gz_file)
+        if checksum is None:
+            if self.article_cache.find(gz_file) is None:
+                return None, None
+            checksum = ArticleCache.file_checksum(gz_file)
+        return self.article_cache.iter_batches(gz_file, batch_size, checksum), checksum
+
+    # A local .gz's cached articles as one list, for ParsePool.imap(); None if there is no usable entry.
+    def load_cached(self, gz_file: str) -> Optional[List[Article]]:
+        try:
+            cached_batches, _ = self.open_cached(gz_file)
+            if cached_batches is None:
+                return None
+            return [article for batch in cached_batches for article in batch]
+        except Exception as e:
+            Utils.print(f"Error reading cached articles of {gz_file}, parsing it instead: {e}", color='red')
+            return None
+
+    # Writes `article_batches` of a local .gz to the article cache as they pass through. `get_checksum`
+    # gives the .gz's md5 once the last batch is through (see open_gz); by default the file is read again then.
+    def cache_batches(self, gz_file: str, article_batches, get_checksum=None):
+        if self.article_cache is None or not os.path.exists(gz_file):
+            return article_batches
+        return self.article_cache.tee(gz_file, get_checksum or (lambda: ArticleCache.file_checksum(gz_file)), article_batches)
+
+    # Parses `gz_files` in the ParsePool, reading the ones the article cache has from there instead. Yields
+    # (file_name, article batches), in order; the batches are None if the file couldn't be parsed. Parsed
+    # files are added to the cache as their batches are consumed.
+    def parse_in_pool(self, gz_files, batch_size: int = ARTICLE_BATCH_SIZE):
+        cached_files = set()
+        def load_cached(gz_file):
+            articles = self.load_cached(gz_file)
+            if articles is not None:
+                cached_files.add(gz_file)
+            return articles
+
+        for gz_file, list_of_articles in self.parse_pool.imap(gz_files, load_cached if self.article_cache else None, self.article_cache is not None):
+            if list_of_articles is None:
+                yield gz_file, None
+                continue
+            article_batches = (list_of_articles[i:i + batch_size] for i in range(0, len(list_of_articles), batch_size))
+            if gz_file in cached_files:
+                cached_files.discard(gz_file)
+                yield gz_file, article_batches
+            else:
+                yield gz_file, self.cache_batches(gz_file, article_batches)
+
+    # Pushes files straight from the article cache, e.g. after an ES outage or into a fresh index, at
+    # disk-read speed. The .gz files don't have to exist any more. Content hashes are not checked,
+    # since they describe what was written before. Returns {file_name: success}.
+    def replay(self, file_names, max_retries:int=2, batch_size:int=ARTICLE_BATCH_SIZE) -> Dict[str, bool]:
+        results = {}
+        for file_name in file_names:
+            article_batches = self.article_cache.iter_batches(file_name, batch_size) if self.article_cache else None
+            if article_batches is None:
+                Utils.print('No cached articles for', file_name, color='red')
+                results[file_name] = False
+                continue
+            Utils.print('Replaying cached articles of', file_name, '...')
+            results[file_name] = self.push_article_batches(article_batches, file_name, max_retries, skip_unchanged=False)
+        return results
+
+    '''
+    Re-pushes single articles by PMID, e.g. after a failed ES document or a bad record was flagged. Each
+    one's <PubmedArticle> XML is read from its offset in the article cache through the cache's PMID index
+    and parsed again, so parser fixes apply without downloading the file. Content hashes are not checked,
+    but a record older than the version stored in pubmed_article_hashes is dropped (MySQL and ES would
+    refuse it as well). Returns {pubmed_id: success}; PMIDs that were never cached (or whose entry has
+    been evicted), no longer parse or are older than what's stored are False.
+    '''
+    def reprocess(self, pubmed_ids, max_retries:int=2) -> Dict[str, bool]:
+        pubmed_ids = [str(pubmed_id) for pubmed_id in pubmed_ids]
+        if self.article_cache is None:
+            Utils.print('reprocess() needs the article cache (article_cache_dir).', color='red')
+            return {pubmed_id: False for pubmed_id in pubmed_ids}
+        if not self.article_cache.index.indexed_entries():
+            self.article_cache.index_existing_entries()
+
+        results, articles = {}, []
+        for pubmed_id in pubmed_ids:
+            article = self.article_cache.find_article(pubmed_id)
+            if article is None:
+                Utils.print('No cached record of', pubmed_id, color='red')
+            elif not article.deleted:
+                try:
+                    article = parse_article_xml(article.xml, article.version) if article.xml else None
+                    if article is None:
+                        Utils.print('Cached record of', pubmed_id, "doesn't parse to an article", color='red')
+                except ET.ParseError as e:
+                    Utils.print(f'Cached XML of {pubmed_id} is invalid: {e}', color='red')
+                    article = None
+            results[pubmed_id] = article is not None
+            if article is not None:
+                articles.append(article)
+        if not articles:
+            return results
+
+        try:
+            stored_hashes = self.db.get_content_hashes(article.pubmed_id for article in articles)
+        except Exception as e:
+            # The writers' own version checks still keep older records out.
+            Utils.print(f"Error loading stored versions, reprocessing every record: {e}", color='red')
+            stored_hashes = {}
+        current_articles = []
+        for article in articles:
+            stored = stored_hashes.get(article.pubmed_id)
+            if stored is not None and article.version < stored[1]:
+                Utils.print(f'Cached record of {article.pubmed_id} (version {article.version}) is older than the stored version {stored[1]}',
+                            color='red')
+                results[article.pubmed_id] = False
+            else:
+                current_articles.append(article)
+
+        changed_articles, content_hashes = self.filter_changed_articles(current_articles, skip_unchanged=False)
+        label = 'reprocess'
+        if changed_articles:
+            ok = (self.push_articles_to_db(changed_articles, label, max_retries)
+                  and self.push_articles_to_elastic(changed_articles, label, max_retries))
+            if ok:
+                self.write_content_hashes(content_hashes, label)
+            else:
+                for article in changed_articles:
+                    results[article.pubmed_id] = False
+        return results
+
+    # Records a leased file's progress (one of db_manager.LEASE_STATUSES); no-op without leases.
+    def mark_file(self, file_name: str, status: str):
+        if self.lease_keeper:
+            self.lease_keeper.mark(file_name, status)
+
+    # True if another worker took `file_name` over, in which case this one must stop writing it.
+    def lease_lost(self, file_name: str) -> bool:
+        return self.lease_keeper is not None and self.lease_keeper.is_lost(file_name)
+
     class State(Enum):
         SLEEP = 1
         DOWNLOAD_WEB_FILES = 2
         DELETE_DATA_FILES = 3
         PROCESS_GZ_TO_XML = 4
         PROCESS_XML_TO_DB = 5
+        PROCESS_GZ_TO_DB = 6
+        RUN_PIPELINE = 7
 
+    # Polled on every loop, so each input is cached: the directory scan (get_data_files), the recorded
+    # files (a set SQLManager keeps up to date) and the NCBI listings (conditional GETs).
     def get_state(self) -> Tuple[int, Dict]:
-        gz_files = PubmedUpdate.get_gz_files()
+        gz_files, xml_files = self.get_data_files()
         files_recorded_from_db = self.db.get_indexed_pubmed_files()
         unread_local_gz_files = [f for f in gz_files if f not in files_recorded_from_db]
-        xml_files = PubmedUpdate.get_xml_files()
 
         if len(unread_local_gz_files) > 0:
             if len(xml_files) > 0:
                 Utils.print('Discovered xml files', xml_files)
                 return PubmedUpdate.State.PROCESS_XML_TO_DB, {'xml_files': xml_files}
             Utils.print('Discovered unread gz files', unread_local_gz_files)
-            return PubmedUpdate.State.PROCESS_GZ_TO_XML, {'gz_files': gz_files}
+            if self.lease_keeper:
+                # Left behind by an earlier run of this worker, or in progress on another worker sharing this
+                # directory; those stay where they are (see below).
+                claimed = self.lease_keeper.claim(unread_local_gz_files, self.lease_batch_size)
+                if claimed:
+                    return PubmedUpdate.State.RUN_PIPELINE, {'gz_files': claimed, 'location': self.get_location(claimed)}
+            elif self.pipeline:
+                return PubmedUpdate.State.RUN_PIPELINE, {'gz_files': unread_local_gz_files, 'location': self.get_location(unread_local_gz_files)}
+            elif self.stream_gz:
+                return PubmedUpdate.State.PROCESS_GZ_TO_DB, {'gz_files': unread_local_gz_files}
+            else:
+                return PubmedUpdate.State.PROCESS_GZ_TO_XML, {'gz_files': gz_files}
 
-        if len(gz_files) > 0 or len(xml_files) > 0:
-            return PubmedUpdate.State.DELETE_DATA_FILES, {'gz_files': gz_files}
+        if self.lease_keeper:
+            # Only recorded files are finished for every worker; any other local file is someone's work in progress.
+            recorded_gz_files = [f for f in gz_files if f in files_recorded_from_db]
+            if len(recorded_gz_files) > 0:
+                return PubmedUpdate.State.DELETE_DATA_FILES, {'gz_files': recorded_gz_files, 'xml_files': []}
+        elif len(gz_files) > 0 or len(xml_files) > 0:
+            return PubmedUpdate.State.DELETE_DATA_FILES, {'gz_files': gz_files, 'xml_files': xml_files}
 
-        unread_web_files = PubmedUpdate.find_unread_web_files(files_recorded_from_db)
+        location, unread_web_files = self.find_unread_web_files(files_recorded_from_db)
         if len(unread_web_files) > 0:
-            if len(unread_web_files) > 5:
-                unread_web_files = unread_web_files[0:5]
-            return PubmedUpdate.State.DOWNLOAD_WEB_FILES, {'unread_web_files': unread_web_files}
+            if self.lease_keeper:
+                claimed = self.lease_keeper.claim(unread_web_files, self.lease_batch_size)
+                if claimed:
+                    return PubmedUpdate.State.RUN_PIPELINE, {'gz_files': claimed, 'location': location}
+                # Everything left is in progress on other workers; check back before their leases could lapse.
+                return PubmedUpdate.State.SLEEP, {'duration': min(60, self.lease_keeper.lease_seconds)}
+            if self.pipeline:
+                # The pipeline only runs a few files ahead of the writers, so it can take the whole listing.
+                return PubmedUpdate.State.RUN_PIPELINE, {'gz_files': unread_web_files, 'location': location}
+            if len(unread_web_files) > self.download_batch_size:
+                unread_web_files = unread_web_files[0:self.download_batch_size]
+            return PubmedUpdate.State.DOWNLOAD_WEB_FILES, {'unread_web_files': unread_web_files, 'location': location}
 
         return PubmedUpdate.State.SLEEP, {'duration': 60*60} # 1 hour
 
@@ -191,7 +546,8 @@ class PubmedUpdate:
         if state == PubmedUpdate.State.DOWNLOAD_WEB_FILES:
             unread_web_files = data['unread_web_files']
             Utils.print('Found unread web files. Downloading...', unread_web_files)
-            self.download_all_gz_files(unread_web_files)
+            self.download_all_gz_files(unread_web_files, data['location'])
+            self.metrics.flush()
             time.sleep(5)
             return
         if state == PubmedUpdate.State.PROCESS_GZ_TO_XML:
@@ -202,21 +558,57 @@ class PubmedUpdate:
                 time.sleep(1)
             time.sleep(5)
             return
+        if state == PubmedUpdate.State.PROCESS_GZ_TO_DB:
+            gz_files = data['gz_files']
+            if self.parse_pool:
+                # Workers parse ahead while the main process writes; results arrive in file order.
+                for gz_file, article_batches in self.parse_in_pool(gz_files):
+                    if article_batches is None:
+                        continue
+                    Utils.print('Pushing parsed gz file', gz_file, '...')
+                    self.push_article_batches(article_batches, gz_file)
+            else:
+                for gz_file in gz_files:
+                    Utils.print('Pushing gz file', gz_file, '...')
+                    self.push_gz_file(gz_file)
+                    time.sleep(5)
+            Utils.print('Refreshing ElasticSearch index...')
+            self.ep.refresh()
+            time.sleep(5)
+            return
+        if state == PubmedUpdate.State.RUN_PIPELINE:
+            gz_files, location = data['gz_files'], data['location']
+            Utils.print('Running ingest pipeline over', len(gz_files), 'files from', location, '...')
+            # bulk_load() changes index-wide settings, so it stays off when other workers share the index.
+            if self.bulk_load_baseline and location == BASELINE_FILES and not self.lease_keeper:
+                # bulk_load() refreshes once on exit.
+                with self.ep.bulk_load():
+                    self.pipeline.run(gz_files, location)
+                return
+            self.pipeline.run(gz_files, location)
+            if self.lease_keeper:
+                # Let any worker (this one included) retry the failed files straight away.
+                self.lease_keeper.release(self.pipeline.failed_files)
+            Utils.print('Refreshing ElasticSearch index...')
+            self.ep.refresh()
+            return
         if state == PubmedUpdate.State.DELETE_DATA_FILES:
-            Utils.print('Removing all .gz and .xml files...')
+            Utils.print('Removing .gz and .xml files...')
             deleted_gz_list = []
             deleted_xml_list = []
-            for file_name in os.listdir():
-                if file_name.endswith('.gz') or file_name.endswith('.xml'):
-                    try:
-                        os.remove(file_name)
-                        if file_name.endswith('.gz'):
-                            deleted_gz_list.append(file_name)
-                        else:
-                            deleted_xml_list.append(file_name)
-                    except Exception as e:
-                        Utils.print(f'Failed to remove {file_name}: {e}', color='red')
-                        continue
+            for file_name in data['gz_files'] + data['xml_files']:
+                try:
+                    os.remove(file_name)
+                    if file_name.endswith('.gz'):
+                        deleted_gz_list.append(file_name)
+                    else:
+                        deleted_xml_list.append(file_name)
+                except FileNotFoundError:
+                    # Removed by whoever recorded it (another worker in this directory).
+                    continue
+                except Exception as e:
+                    Utils.print(f'Failed to remove {file_name}: {e}', color='red')
+                    continue
             Utils.print('Deleted gz files', deleted_gz_list, color='green')
             Utils.print('Deleted xml files', deleted_xml_list, color='green')
             time.sleep(10)
@@ -233,7 +625,17 @@ class PubmedUpdate:
         self.ep.refresh()
         time.sleep(5)
 
+    # An index left in bulk-load mode by a crashed run (it still carries bulk_load()'s marker) would stay without
+    # refreshes and replicas through every update file, so that is undone first. Other workers never bulk-load
+    # while leases are on.
+    def restore_index_settings(self):
+        try:
+            self.ep.restore_bulk_load_settings()
+        except Exception as e:
+            Utils.print(f"Error checking the index settings: {e}", color='red')
+
     def run(self):
+        self.restore_index_settings()
         state, data = self.get_state()
         # while state != PubmedUpdate.State.SLEEP:
         while True:
@@ -0,0 +1,174 @@
+'''
+Rebuilds the Elasticsearch index from MySQL without re-downloading or re-parsing PubMed.
+
+    python reindex.py --partitions 8 --page-size 10000 --checkpoint reindex_checkpoint.json
+
+The pubmed_id range is split into `partitions` contiguous slices that are streamed in parallel. After
+every page a partition records the last pubmed_id it indexed in the checkpoint file, so an interrupted
+run started again with the same checkpoint picks up where each slice stopped (the partitioning stored in
+the checkpoint wins over --partitions). Documents Elasticsearch rejected are recorded in the checkpoint too,
+as the id span of each page they were in; the checkpoint is only deleted once none failed, and running
+again with it sends those spans first.
+'''
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import json
+import os
+import threading
+import time
+
+from db_manager import SQLManager
+from elasticsearch_post import ElasticPush
+from utils import Utils
+
+REINDEX_PAGE_SIZE = 10000
+REINDEX_PARTITIONS = 4
+
+
+class Reindexer:
+    def __init__(self, db: SQLManager, ep: ElasticPush, checkpoint_file: str = 'reindex_checkpoint.json',
+                 partitions: int = REINDEX_PARTITIONS, page_size: int = REINDEX_PAGE_SIZE):
+        self.db = db
+        self.ep = ep
+        self.checkpoint_file = checkpoint_file
+        self.partitions = partitions
+        self.page_size = page_size
+        self.checkpoint_lock = threading.Lock()
+        self.checkpoint = {}
+        self.docs_indexed = 0
+        self.docs_failed = 0
+
+    # Splits (min_id - 1, max_id] into `partitions` (after, up_to] slices.
+    @staticmethod
+    def split_range(min_id: int, max_id: int, partitions: int) -> list:
+        span = max_id - min_id + 1
+        step = -(-span // partitions)
+        ranges = []
+        after = min_id - 1
+        while after < max_id:
+            up_to = min(after + step, max_id)
+            ranges.append({'after': after, 'up_to': up_to, 'last_id': after, 'done': False})
+            after = up_to
+        return ranges
+
+    def load_checkpoint(self) -> bool:
+        if not os.path.exists(self.checkpoint_file):
+            return False
+        with open(self.checkpoint_file) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('index_name') != self.ep.index_name:
+            Utils.print(f'Ignoring checkpoint {self.checkpoint_file}: it belongs to index {checkpoint.get("index_name")}.', color='red')
+            return False
+        self.checkpoint = checkpoint
+        return True
+
+    def save_checkpoint(self):
+        tmp_file = self.checkpoint_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.checkpoint, f)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    # Streams (after, up_to] into the index a page at a time. The span of the documents rejected in each page
+    # goes into id_range['failed']; `on_page(last pubmed_id)` moves the caller's position on, under the
+    # checkpoint lock, before each save.
+    def index_ids(self, id_range: dict, after: int, up_to: int, on_page):
+        page = []
+
+        def flush():
+            # The checkpoint moves on even if some docs were rejected, so a doc the mapping refuses
+            # can't wedge the partition; those show up in docs_failed and id_range['failed'].
+            failures = []
+            num_success, num_failed = self.ep.bulk_index((article for _, article in page), failures)
+            with self.checkpoint_lock:
+                self.docs_indexed += num_success
+                self.docs_failed += num_failed
+                if failures:
+                    failed_ids = [int(failure['_id']) for failure in failures]
+                    id_range.setdefault('failed', []).append([min(failed_ids) - 1, max(failed_ids)])
+                on_page(page[-1][0])
+                self.save_checkpoint()
+            page.clear()
+
+        for pubmed_id, article in self.db.iter_articles_for_elasticsearch(after, up_to, self.page_size):
+            page.append((pubmed_id, article))
+            if len(page) >= self.page_size:
+                flush()
+        if page:
+            flush()
+
+    def index_range(self, range_index: int):
+        id_range = self.checkpoint['ranges'][range_index]
+        # Spans with documents rejected on an earlier run go first.
+        while id_range.get('retry'):
+            span = id_range['retry'][0]
+
+            def retried_up_to(last_id):
+                span[0] = last_id
+            self.index_ids(id_range, span[0], span[1], retried_up_to)
+            with self.checkpoint_lock:
+                id_range['retry'].pop(0)
+                self.save_checkpoint()
+        if id_range['done']:
+            return
+
+        def indexed_up_to(last_id):
+            id_range['last_id'] = last_id
+        self.index_ids(id_range, id_range['last_id'], id_range['up_to'], indexed_up_to)
+        with self.checkpoint_lock:
+            id_range['done'] = True
+            self.save_checkpoint()
+
+    def run(self, bulk_load: bool = False) -> dict:
+        if not self.load_checkpoint():
+            min_id, max_id = self.db.get_pubmed_id_bounds()
+            if min_id is None:
+                Utils.print('pubmed_articles is empty; nothing to reindex.')
+                return {}
+            self.checkpoint = {
+                'index_name': self.ep.index_name,
+                'ranges': Reindexer.split_range(int(min_id), int(max_id), self.partitions),
+            }
+            self.save_checkpoint()
+        else:
+            # This run sends what the last one had rejected again.
+            for id_range in self.checkpoint['ranges']:
+                id_range['retry'] = id_range.get('retry', []) + id_range.pop('failed', [])
+            self.save_checkpoint()
+        ranges = self.checkpoint['ranges']
+        Utils.print(f'Reindexing into {self.ep.index_name} over {len(ranges)} partitions...')
+        Utils.print(ranges)
+
+        start_time = time.perf_counter()
+        context = self.ep.bulk_load() if bulk_load else contextlib.nullcontext()
+        with context, ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            # list() so an exception in any partition surfaces here.
+            list(executor.map(self.index_range, range(len(ranges))))
+        elapsed = time.perf_counter() - start_time
+
+        summary = {
+            'docs_indexed': self.docs_indexed,
+            'docs_failed': self.docs_failed,
+            'seconds': round(elapsed, 1),
+            'docs_per_sec': round(self.docs_indexed / elapsed, 1) if elapsed else 0.0,
+        }
+        if self.docs_failed:
+            failed_spans = sum(len(id_range.get('failed', [])) for id_range in ranges)
+            Utils.print(f'Reindex finished with {self.docs_failed} failed documents in {failed_spans} spans; run again with '
+                        f'checkpoint {self.checkpoint_file} to retry them', summary, color='red')
+        else:
+            Utils.print('Reindex finished', summary, color='green')
+            os.remove(self.checkpoint_file)
+        return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--index', default='search-medbrevia-pubmed-articles')
+    parser.add_argument('--partitions', type=int, default=REINDEX_PARTITIONS)
+    parser.add_argument('--page-size', type=int, default=REINDEX_PAGE_SIZE)
+    parser.add_argument('--checkpoint', default='reindex_checkpoint.json')
+    parser.add_argument('--bulk-load', action='store_true', help='disable refreshes and replicas while reindexing')
+    args = parser.parse_args()
+    reindexer = Reindexer(SQLManager(), ElasticPush(index_name=args.index), checkpoint_file=args.checkpoint,
+                          partitions=args.partitions, page_size=args.page_size)
+    reindexer.run(bulk_load=args.bulk_load)
@@ -0,0 +1,117 @@
+'''
+An Elasticsearch client that answers bulk requests in-process, for the tests and benchmarks.ingest_bench:
+
+    es, node = fake_client(statuses={'3': [429, 201]})
+    ElasticPush(es=es).bulk_index(articles)
+    node.bulk_requests  # the _ids sent in each bulk request
+'''
+import json
+import threading
+import time
+
+from elasticsearch import Elasticsearch
+from elastic_transport import ApiResponseMeta, BaseNode, HttpHeaders
+from elastic_transport._node import NodeApiResponse
+
+# Default per-document statuses.
+OK_STATUSES = {'index': 201, 'create': 201, 'update': 200, 'delete': 200}
+# error.type of a failed document, by status.
+ERROR_TYPES = {400: 'mapper_parsing_exception', 409: 'version_conflict_engine_exception', 429: 'es_rejected_execution_exception'}
+
+
+class FakeBulkNode(BaseNode):
+    '''
+    Elasticsearch node that answers in-process after `latency` seconds. Bulk requests succeed document by
+    document unless `statuses` says otherwise: {_id: [status of the 1st attempt, 2nd, ...]}, the last status
+    repeating. `request_statuses` fails whole bulk requests, in order, before any document is looked at.
+    The index's flat settings and mapping _meta are kept in `index_settings` / `index_meta` for the
+    _settings and _mapping requests; any other request gets an empty 200. Configure a subclass per client
+    (fake_client() does), since the
+    transport creates the node instances itself. With `record` off (benchmarks) nothing is kept per request.
+    '''
+    latency = 0.0
+    record = True
+    statuses = {}
+    request_statuses = []
+    bulk_requests = []
+    attempts = {}
+    index_settings = {}
+    index_meta = {}
+    lock = threading.Lock()
+
+    def perform_request(self, method, target, body=None, headers=None, request_timeout=None):
+        if self.latency:
+            time.sleep(self.latency)
+        path = target.split('?')[0]
+        if '/_settings' in path or path.endswith('/_mapping'):
+            return self.index_request(method, path, body)
+        if not path.endswith('/_bulk'):
+            return FakeBulkNode.response(self.config, 200, {})
+
+        # Meta lines are the only ones starting with an op type; documents never have one as their first key.
+        meta_lines = [json.loads(line) for line in (body or b'').splitlines() if line.startswith((b'{"index"', b'{"delete"', b'{"create"', b'{"update"'))]
+        with self.lock:
+            if self.request_statuses:
+                status = self.request_statuses.pop(0)
+                return FakeBulkNode.response(self.config, status, {'error': {'type': 'fake'}, 'status': status})
+            items, errors = [], False
+            for meta in meta_lines:
+                op_type, info = next(iter(meta.items()))
+                doc_id = str(info.get('_id'))
+                status = OK_STATUSES[op_type]
+                if self.record:
+                    attempt = self.attempts.get(doc_id, 0)
+                    self.attempts[doc_id] = attempt + 1
+                    statuses = self.statuses.get(doc_id)
+                    if statuses:
+                        status = statuses[min(attempt, len(statuses) - 1)]
+                item = {'_id': doc_id, 'status': status}
+                if not 200 <= status < 300:
+                    errors = True
+                    item['error'] = {'type': ERROR_TYPES.get(status, 'exception'), 'reason': f'fake {status} for {doc_id}'}
+                items.append({op_type: item})
+            if self.record:
+                self.bulk_requests.append([next(iter(item.values()))['_id'] for item in items])
+        return FakeBulkNode.response(self.config, 200, {'took': 0, 'errors': errors, 'items': items})
+
+    # GET/PUT of the index's settings (put: None removes a setting) or mapping _meta (put replaces it).
+    def index_request(self, method, path, body):
+        index = path.strip('/').split('/')[0]
+        with self.lock:
+            if '/_settings' in path:
+                if method == 'PUT':
+                    for name, value in json.loads(body).items():
+                        if value is None:
+                            self.index_settings.pop(name, None)
+                        else:
+                            self.index_settings[name] = value
+                    return FakeBulkNode.response(self.config, 200, {'acknowledged': True})
+                return FakeBulkNode.response(self.config, 200, {index: {'settings': dict(self.index_settings)}})
+            if method == 'PUT':
+                self.index_meta.clear()
+                self.index_meta.update(json.loads(body).get('_meta', {}))
+                return FakeBulkNode.response(self.config, 200, {'acknowledged': True})
+            return FakeBulkNode.response(self.config, 200, {index: {'mappings': {'_meta': dict(self.index_meta)} if self.index_meta else {}}})
+
+    @staticmethod
+    def response(config, status: int, data: dict) -> NodeApiResponse:
+        meta = ApiResponseMeta(status=status, http_version='1.1', duration=0.0, node=config,
+                               headers=HttpHeaders({'content-type': 'application/json', 'x-elastic-product': 'Elasticsearch'}))
+        return NodeApiResponse(meta, json.dumps(data).encode())
+
+
+# A client on a fresh FakeBulkNode subclass, and that subclass (for its bulk_requests and attempts).
+def fake_client(latency: float = 0.0, statuses: dict = None, request_statuses: list = None, record: bool = True,
+                index_settings: dict = None, index_meta: dict = None):
+    node_class = type('FakeBulkNode', (FakeBulkNode,), {
+        'latency': latency,
+        'record': record,
+        'statuses': {str(doc_id): list(s) for doc_id, s in (statuses or {}).items()},
+        'request_statuses': list(request_statuses or []),
+        'bulk_requests': [],
+        'attempts': {},
+        'index_settings': dict(index_settings or {}),
+        'index_meta': dict(index_meta or {}),
+        'lock': threading.Lock(),
+    })
+    return Elasticsearch('http://fake-es:9200', node_class=node_class), node_class
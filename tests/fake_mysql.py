@@ -0,0 +1,221 @@
+'''
+In-memory stand-ins for mysql.connector's pool, connection and cursor, for testing SQLManager without MySQL.
+Statements are logged rather than run, except the ones on pubmed_file_leases and indexed_pubmed_files: those
+are evaluated against a FakeTable, so their SQL conditions (and MySQL's left-to-right ON DUPLICATE KEY UPDATE
+assignments) are exercised as written:
+
+    monkeypatch.setattr(db_manager.pooling, 'MySQLConnectionPool', FakePool)
+    db = SQLManager({}, create_tables=False)
+    db.claim_file('pubmed24n0001.xml.gz', 'worker-1', 600)
+    db.pool.leases.rows  # {file_name: {'file_name': ..., 'owner': ..., 'status': ..., 'lease_expires': ..., 'attempts': ...}}
+'''
+import re
+import threading
+
+from mysql.connector import errors
+
+
+class FakeTable:
+    '''
+    One table keyed on `key`, understanding just the INSERT ... [ON DUPLICATE KEY UPDATE], UPDATE ... SET ... WHERE
+    and SELECT ... [WHERE] statements SQLManager issues on it. `defaults` are {column: SQL expression} for the
+    columns an INSERT leaves out. Times are plain seconds from `clock()`, which is the settable `now` unless
+    a test swaps in a real clock.
+    '''
+    TOKEN = re.compile(r"\s*('[^']*'|%s|\d+|\w+|<>|<=|>=|[=<>+\-(),*])")
+
+    def __init__(self, name: str, key: str, defaults: dict):
+        self.name = name
+        self.key = key
+        self.defaults = defaults
+        self.insert_sql = re.compile(rf"INSERT INTO {name} \((.*?)\) VALUES \((.*?)\)(?: ON DUPLICATE KEY UPDATE (.*))?$", re.S)
+        self.update_sql = re.compile(rf"UPDATE {name} SET (.*?) WHERE (.*)$", re.S)
+        self.select_sql = re.compile(rf"SELECT (.*?) FROM {name}(?: WHERE (.*))?$", re.S)
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.now = 0
+        self.clock = lambda: self.now
+
+    # Splits `sql` on the commas outside parentheses.
+    @staticmethod
+    def split(sql: str) -> list:
+        parts, depth, start = [], 0, 0
+        for i, c in enumerate(sql):
+            depth += {'(': 1, ')': -1}.get(c, 0)
+            if c == ',' and depth == 0:
+                parts.append(sql[start:i])
+                start = i + 1
+        return parts + [sql[start:]]
+
+    # Turns one SQL expression into Python over `row`, `new` (the VALUES() of an insert), `now` and `params`.
+    # `counter` numbers the %s placeholders across the whole statement.
+    def compile(self, sql: str, counter: list) -> str:
+        tokens = self.TOKEN.findall(sql)
+        assert ''.join(tokens).replace(' ', '') == sql.replace(' ', '').replace('\n', ''), sql
+        out, closers, i = [], [], 0
+        while i < len(tokens):
+            token, upper = tokens[i], tokens[i].upper()
+            if token == '%s':
+                out.append(f'params[{counter[0]}]')
+                counter[0] += 1
+            elif upper == 'NOW':
+                out.append('now')
+                i += 2
+            elif upper in ('INTERVAL', 'SECOND'):
+                pass
+            elif upper == 'VALUES':
+                out.append(f'new[{tokens[i + 2]!r}]')
+                i += 3
+            elif upper == 'IF':
+                out.append('if_')
+            elif upper in ('AND', 'OR', 'NOT'):
+                out.append(upper.lower())
+            elif upper == 'IN':
+                out.append('in [')
+                closers.append(']')
+                i += 1
+            elif token == '(':
+                out.append('(')
+                closers.append(')')
+            elif token == ')':
+                out.append(closers.pop())
+            elif token in ('<>', '='):
+                out.append({'<>': '!=', '=': '=='}[token])
+            elif token[0] == "'" or token.isdigit() or not (token[0].isalpha() or token[0] == '_'):
+                out.append(token)
+            else:
+                out.append(f'row[{token!r}]')
+            i += 1
+        return ' '.join(out)
+
+    def evaluate(self, code: str, row: dict, params, new: dict = None):
+        return eval(code, {'if_': lambda condition, a, b: a if condition else b},
+                    {'row': row, 'new': new or {}, 'now': self.clock(), 'params': params})
+
+    # Applies `col=expr, ...` to `row` one assignment at a time, as MySQL does.
+    def assign(self, assignments: list, row: dict, params, new: dict = None):
+        for column, code in assignments:
+            row[column] = self.evaluate(code, row, params, new)
+
+    def compile_assignments(self, sql: str, counter: list) -> list:
+        assignments = []
+        for assignment in self.split(sql):
+            column, expression = assignment.split('=', 1)
+            assignments.append((column.strip(), self.compile(expression, counter)))
+        return assignments
+
+    # Runs one statement. Returns the selected rows, as tuples.
+    def execute(self, sql: str, params) -> list:
+        sql = ' '.join(sql.split())
+        counter = [0]
+        with self.lock:
+            match = self.insert_sql.match(sql)
+            if match:
+                columns = [column.strip() for column in match.group(1).split(',')]
+                values = [self.compile(expression, counter) for expression in self.split(match.group(2))]
+                updates = self.compile_assignments(match.group(3), counter) if match.group(3) else None
+                new = {column: self.evaluate(self.compile(expression, [0]), {}, ()) for column, expression in self.defaults.items()}
+                new.update((column, self.evaluate(code, {}, params)) for column, code in zip(columns, values))
+                row = self.rows.get(new[self.key])
+                if row is None:
+                    self.rows[new[self.key]] = new
+                elif updates is None:
+                    raise errors.IntegrityError(msg=f"Duplicate entry '{new[self.key]}'", errno=1062)
+                else:
+                    self.assign(updates, row, params, new)
+                return []
+            match = self.update_sql.match(sql)
+            if match:
+                updates = self.compile_assignments(match.group(1), counter)
+                condition = self.compile(match.group(2), counter)
+                for row in self.rows.values():
+                    if self.evaluate(condition, row, params):
+                        self.assign(updates, row, params)
+                return []
+            match = self.select_sql.match(sql)
+            if match:
+                columns = [column.strip() for column in match.group(1).split(',')]
+                condition = self.compile(match.group(2), counter) if match.group(2) else 'True'
+                return [tuple(row[column] for column in columns) for row in self.rows.values() if self.evaluate(condition, row, params)]
+            raise NotImplementedError(sql)
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = 0
+        self.results = []
+
+    def execute(self, sql, params=()):
+        self.results = self.connection.run(sql, params)
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        if self.connection.pool.table_for(sql):
+            for params in rows:
+                self.execute(sql, params)
+        else:
+            self.connection.run(sql, rows)
+
+    def fetchall(self):
+        results, self.results = self.results, []
+        return results
+
+    def fetchone(self):
+        return self.results.pop(0) if self.results else None
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    '''
+    Logs statements instead of running them. `pool.failures` is a list of (SQL fragment, errno): the
+    first statement containing the fragment raises a MySQL error with that errno, once per entry.
+    Statements only count as written once committed; statements on the pool's tables also take effect right away.
+    '''
+    def __init__(self, pool):
+        self.pool = pool
+        self.pending = []
+
+    def run(self, sql, params) -> list:
+        for i, (fragment, errno) in enumerate(self.pool.failures):
+            if fragment in sql:
+                del self.pool.failures[i]
+                raise errors.DatabaseError(msg=f'fake error {errno}', errno=errno)
+        self.pending.append((sql, params))
+        table = self.pool.table_for(sql)
+        return table.execute(sql, params) if table else []
+
+    def cursor(self, prepared=False, **kwargs):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.pool.committed.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pool.rollbacks += 1
+        self.pending = []
+
+    def ping(self, **kwargs):
+        pass
+
+    def close(self):
+        self.pending = []
+
+
+class FakePool:
+    def __init__(self, **kwargs):
+        self.failures = []
+        self.committed = []
+        self.rollbacks = 0
+        self.leases = FakeTable('pubmed_file_leases', 'file_name', {'status': "'claimed'", 'attempts': '1'})
+        self.indexed_files = FakeTable('indexed_pubmed_files', 'file_name', {'last_update': 'NOW()'})
+        self.tables = [self.leases, self.indexed_files]
+
+    def table_for(self, sql: str):
+        return next((table for table in self.tables if re.search(rf'\b{table.name}\b', sql)), None)
+
+    def get_connection(self):
+        return FakeConnection(self)
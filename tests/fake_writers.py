@@ -0,0 +1,109 @@
+'''
+In-memory stand-ins for SQLManager and ElasticPush, for testing PubmedUpdate and IngestPipeline without
+MySQL or Elasticsearch. Both keep the latest record per PMID the way the real writers' version checks do
+(an older version never replaces a newer one), so a test can look at what each store ends up holding:
+
+    update = PubmedUpdate(pipelined=False)  # with pubmed_load.SQLManager/ElasticPush patched to these
+    update.push_article_batches(batches, 'pubmed24n0001.xml.gz')
+    update.db.rows, update.ep.documents  # {pubmed_id: Article} of the live articles
+'''
+import threading
+import time
+
+from throttle import AdaptiveLimiter
+
+
+# Keeps `article` in `store` ({pubmed_id: Article}) unless the stored record is newer; a deletion removes it.
+def apply_versioned(store: dict, versions: dict, article):
+    if versions.get(article.pubmed_id, -1) > article.version:
+        return
+    versions[article.pubmed_id] = article.version
+    if article.deleted:
+        store.pop(article.pubmed_id, None)
+    else:
+        store[article.pubmed_id] = article
+
+
+class FakeDB:
+    '''`fail_pushes` / `fail_hashes` make the next that many push_pubmed_articles() / write_content_hashes() calls fail.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pushed = []
+        self.rows = {}
+        self.row_versions = {}
+        self.stored_hashes = {}
+        self.written_hashes = {}
+        self.recorded_files = []
+        self.fail_pushes = 0
+        self.fail_hashes = 0
+        self.write_limiter = AdaptiveLimiter(1000, 100, 1000, 100, name='fake mysql')
+
+    def push_pubmed_articles(self, articles) -> bool:
+        with self.lock:
+            if self.fail_pushes:
+                self.fail_pushes -= 1
+                return False
+            self.pushed.extend(articles)
+            for article in articles:
+                apply_versioned(self.rows, self.row_versions, article)
+            return True
+
+    def get_content_hashes(self, pubmed_ids) -> dict:
+        with self.lock:
+            return {pubmed_id: self.stored_hashes[pubmed_id] for pubmed_id in pubmed_ids if pubmed_id in self.stored_hashes}
+
+    def write_content_hashes(self, content_hashes: dict) -> bool:
+        with self.lock:
+            if self.fail_hashes:
+                self.fail_hashes -= 1
+                return False
+            self.written_hashes.update(content_hashes)
+            for pubmed_id, (content_hash, version) in content_hashes.items():
+                stored = self.stored_hashes.get(pubmed_id)
+                if stored is None or version >= stored[1]:
+                    self.stored_hashes[pubmed_id] = (content_hash, version)
+            return True
+
+    def write_file_name(self, file_name: str) -> bool:
+        with self.lock:
+            self.recorded_files.append(file_name)
+            return True
+
+    def get_indexed_pubmed_files(self) -> frozenset:
+        with self.lock:
+            return frozenset(self.recorded_files)
+
+
+class FakeElasticPush:
+    '''
+    `fail_inserts` makes the next that many calls fail for every document, `failing_ids` fails those PMIDs
+    on every call; `delay` slows every call down.
+    '''
+    owns_client = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pushed = []
+        self.documents = {}
+        self.document_versions = {}
+        self.fail_inserts = 0
+        self.failing_ids = set()
+        self.delay = 0.0
+        self.limiter = AdaptiveLimiter(1000, 100, 1000, 100, name='fake elasticsearch')
+
+    # Returns the articles that failed, like ElasticPush.insert_articles().
+    def insert_articles(self, articles) -> list:
+        time.sleep(self.delay)
+        with self.lock:
+            if self.fail_inserts:
+                self.fail_inserts -= 1
+                return list(articles)
+            failed = [article for article in articles if article.pubmed_id in self.failing_ids]
+            for article in articles:
+                if article.pubmed_id not in self.failing_ids:
+                    self.pushed.append(article)
+                    apply_versioned(self.documents, self.document_versions, article)
+            return failed
+
+    def bulk_insert(self, articles) -> bool:
+        return not self.insert_articles(articles)
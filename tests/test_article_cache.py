@@ -0,0 +1,129 @@
+import os
+
+import pytest
+
+import article_cache
+from article_cache import INDEX_GROW_SLOTS, ArticleCache, ArticleIndex
+from benchmarks.synthetic import write_pubmed_file
+import parse_xml
+from parse_xml import get_file_version, iter_article_batches, open_article_source, parse_article_xml
+import pubmed_load
+from pubmed_load import PubmedUpdate
+from tests.fake_writers import FakeDB, FakeElasticPush
+
+
+@pytest.fixture
+def gz_file(tmp_path):
+    path = str(tmp_path / 'pubmed24n0001.xml.gz')
+    write_pubmed_file(path, articles=50, deletes=5)
+    return path
+
+# Parses `gz_file` into the cache the way the ingest does, returning the parsed records.
+def cache_file(cache: ArticleCache, gz_file: str) -> list:
+    with open_article_source(gz_file) as f:
+        batches = iter_article_batches(f, 20, get_file_version(gz_file), keep_xml=True)
+        return [article for batch in cache.tee(gz_file, lambda: ArticleCache.file_checksum(gz_file), batches) for article in batch]
+
+@pytest.fixture
+def update(tmp_path, monkeypatch):
+    monkeypatch.setattr(pubmed_load, 'SQLManager', FakeDB)
+    monkeypatch.setattr(pubmed_load, 'ElasticPush', FakeElasticPush)
+    return PubmedUpdate(pipelined=False, article_cache_dir=str(tmp_path / 'cache'))
+
+
+def test_cache_keeps_source_xml(tmp_path, gz_file):
+    cache = ArticleCache(str(tmp_path / 'cache'))
+    articles = cache_file(cache, gz_file)
+    article = next(a for a in articles if not a.deleted)
+    cached = cache.find_article(article.pubmed_id)
+    assert cached.xml == article.xml
+    assert cached.xml.startswith(b'<PubmedArticle>')
+    assert parse_article_xml(cached.xml, cached.version) == article
+
+def test_reprocess_parses_stored_xml(gz_file, update, monkeypatch):
+    articles = cache_file(update.article_cache, gz_file)
+    article = next(a for a in articles if not a.deleted)
+    deleted = next(a for a in articles if a.deleted)
+
+    # A parser fix made after the file was cached.
+    parse_article_record = parse_xml.parse_article_record
+    def fixed_parse_article_record(elem, version=0):
+        record = parse_article_record(elem, version)
+        record.title = 'Fixed ' + record.title
+        return record
+    monkeypatch.setattr(parse_xml, 'parse_article_record', fixed_parse_article_record)
+
+    results = update.reprocess([article.pubmed_id, deleted.pubmed_id, '99999'])
+    assert results == {article.pubmed_id: True, deleted.pubmed_id: True, '99999': False}
+    pushed = {a.pubmed_id: a for a in update.ep.pushed}
+    assert pushed[article.pubmed_id].title == 'Fixed ' + article.title
+    assert pushed[deleted.pubmed_id].deleted
+    assert [a.pubmed_id for a in update.db.pushed] == [article.pubmed_id, deleted.pubmed_id]
+
+def test_reprocess_fails_invalid_xml(gz_file, update):
+    articles = cache_file(update.article_cache, gz_file)
+    article = next(a for a in articles if not a.deleted)
+    entry = update.article_cache.index.lookup(article.pubmed_id)
+    # Corrupts the stored XML in place, keeping the record's length.
+    with open(entry.path, 'r+b') as f:
+        f.seek(entry.offset)
+        data = f.read(entry.length)
+        f.seek(entry.offset)
+        f.write(data.replace(b'</PubmedArticle>', b'</PubmedArticlX>'))
+    assert update.reprocess([article.pubmed_id]) == {article.pubmed_id: False}
+    assert update.ep.pushed == []
+
+# Two indexes on one directory stand in for two processes sharing the cache.
+def test_index_shared_between_processes(tmp_path):
+    index_dir = str(tmp_path)
+    first, second = ArticleIndex(index_dir, index_dir), ArticleIndex(index_dir, index_dir)
+    first.add('pubmed24n0001.xml.gz', 'a.mbac', [('1', 10, 5, 100)])
+    second.add('pubmed24n0002.xml.gz', 'b.mbac', [('2', 20, 5, 200), (str(INDEX_GROW_SLOTS + 5), 30, 5, 200)])
+    first.add('pubmed24n0003.xml.gz', 'c.mbac', [('3', 40, 5, 300)])
+
+    with open(os.path.join(index_dir, 'pmid.files')) as f:
+        assert [line.split('\t')[0] for line in f] == ['pubmed24n0001.xml.gz', 'pubmed24n0002.xml.gz', 'pubmed24n0003.xml.gz']
+    for index in (first, second):
+        assert [index.lookup(pubmed_id).file_name for pubmed_id in (1, 2, INDEX_GROW_SLOTS + 5, 3)] == [
+            'pubmed24n0001.xml.gz', 'pubmed24n0002.xml.gz', 'pubmed24n0002.xml.gz', 'pubmed24n0003.xml.gz']
+    assert second.lookup(3).offset == 40
+    assert first.indexed_entries() == second.indexed_entries() == {'a.mbac', 'b.mbac', 'c.mbac'}
+
+def test_reprocess_drops_records_older_than_stored(gz_file, update):
+    articles = [a for a in cache_file(update.article_cache, gz_file) if not a.deleted]
+    older, current = articles[0], articles[1]
+    update.db.stored_hashes = {older.pubmed_id: (b'x' * 16, older.version + 1), current.pubmed_id: (b'x' * 16, current.version)}
+    assert update.reprocess([older.pubmed_id, current.pubmed_id]) == {older.pubmed_id: False, current.pubmed_id: True}
+    assert [a.pubmed_id for a in update.db.pushed] == [a.pubmed_id for a in update.ep.pushed] == [current.pubmed_id]
+    assert set(update.db.written_hashes) == {current.pubmed_id}
+
+def test_cache_write_errors_dont_stop_the_batches(tmp_path, gz_file, monkeypatch):
+    cache = ArticleCache(str(tmp_path / 'cache'))
+    expected = parse_xml.parse_file(gz_file)
+    def full_disk(article):
+        raise OSError(28, 'No space left on device')
+    monkeypatch.setattr(article_cache, 'encode_article', full_disk)
+    assert cache_file(cache, gz_file) == expected
+    assert os.listdir(cache.cache_dir) == ['index']
+
+def test_index_errors_dont_stop_the_batches(tmp_path, gz_file, monkeypatch):
+    cache = ArticleCache(str(tmp_path / 'cache'))
+    def full_disk(*args):
+        raise OSError(28, 'No space left on device')
+    monkeypatch.setattr(cache.index, 'add', full_disk)
+    assert len(cache_file(cache, gz_file)) == len(parse_xml.parse_file(gz_file))
+    assert cache.find(gz_file) is not None
+
+# Another process evicting the same entries first.
+def test_evict_ignores_entries_already_gone(tmp_path, gz_file, monkeypatch):
+    cache = ArticleCache(str(tmp_path / 'cache'), max_bytes=0)
+    for name in ('a', 'b'):
+        with open(os.path.join(cache.cache_dir, f'{name}.0{article_cache.CACHE_SUFFIX}'), 'wb') as f:
+            f.write(b'x' * 100)
+    remove = os.remove
+    def remove_twice(path):
+        remove(path)
+        remove(path)
+    monkeypatch.setattr(article_cache.os, 'remove', remove_twice)
+    cache.evict()
+    assert os.listdir(cache.cache_dir) == ['index']
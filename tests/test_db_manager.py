@@ -0,0 +1,108 @@
+from mysql.connector import errors
+import pytest
+
+from article import Article, Author
+import db_manager
+from db_manager import SQLManager, UpsertBatchError
+from tests.fake_mysql import FakePool
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(db_manager.pooling, 'MySQLConnectionPool', FakePool)
+    monkeypatch.setattr(db_manager, 'WRITE_RETRY_BACKOFF_SECONDS', 0.0)
+    return SQLManager({}, pool_size=2, create_tables=False)
+
+
+def statements(db, fragment: str) -> list:
+    return [params for sql, params in db.pool.committed if fragment in sql]
+
+
+def articles(count: int) -> list:
+    return [Article(str(pubmed_id), title=f'Title {pubmed_id}', authors=(Author('A'),), version=101) for pubmed_id in range(1, count + 1)]
+
+
+@pytest.mark.parametrize('errno', [1205, 1213])
+def test_run_write_retries_transient_errors(db, errno):
+    db.pool.failures = [('INSERT INTO t', errno), ('INSERT INTO t', errno)]
+    db.run_write(lambda connection, cursor: cursor.execute('INSERT INTO t VALUES (%s)', (1,)))
+    assert statements(db, 'INSERT INTO t') == [(1,)]
+    assert db.pool.rollbacks == 2
+    assert db.write_limiter.overloads == 2
+
+
+def test_run_write_raises_other_errors_at_once(db):
+    db.pool.failures = [('INSERT INTO t', 1062)]
+    with pytest.raises(errors.DatabaseError):
+        db.run_write(lambda connection, cursor: cursor.execute('INSERT INTO t VALUES (%s)', (1,)))
+    assert db.pool.rollbacks == 1
+    assert db.write_limiter.overloads == 0
+
+
+def test_run_write_gives_up_after_max_retries(db):
+    db.pool.failures = [('INSERT INTO t', 1205)] * 3
+    with pytest.raises(errors.DatabaseError):
+        db.run_write(lambda connection, cursor: cursor.execute('INSERT INTO t VALUES (%s)', (1,)), max_retries=2)
+    assert db.pool.committed == []
+
+
+def test_upsert_retries_a_deadlocked_batch_at_the_new_size(db):
+    db.pool.failures = [('INSERT INTO pubmed_articles', 1213)]
+    assert db.upsert_pubmed_articles(articles(2500)) == 2500
+    batch_rows = [len(params) // len(db_manager.ARTICLE_COLUMNS) for params in statements(db, 'INSERT INTO pubmed_articles')]
+    # The deadlock halved the limiter from 1000 rows, and the batch was re-cut to that before its retry.
+    assert batch_rows == [500] * 5
+    assert sorted(int(p) for params in statements(db, 'INSERT INTO pubmed_articles') for p in params[::len(db_manager.ARTICLE_COLUMNS)]) == list(range(1, 2501))
+
+
+def test_upsert_reports_the_failed_batch(db):
+    db.pool.failures = [('INSERT INTO pubmed_articles', 1064)]
+    with pytest.raises(UpsertBatchError) as excinfo:
+        db.upsert_pubmed_articles(articles(10))
+    assert (excinfo.value.batch_index, excinfo.value.rows_committed) == (0, 0)
+
+
+def test_child_rows_retry_on_lock_wait_timeout(db):
+    db.pool.failures = [('INSERT INTO pubmed_article_authors', 1205)]
+    assert db.push_pubmed_articles(articles(3))
+    assert statements(db, 'INSERT INTO pubmed_article_authors') == [[('1', 0, 'A'), ('2', 0, 'A'), ('3', 0, 'A')]]
+    assert len(statements(db, 'DELETE FROM pubmed_article_authors')) == 1
+
+
+def test_push_reports_failure(db):
+    db.pool.failures = [('INSERT INTO pubmed_article_authors', 1064)]
+    assert not db.push_pubmed_articles(articles(3))
+
+
+def test_take_row_batch_counts_utf8_bytes():
+    rows = [('1', 'é' * 100), ('2', 'é' * 100), ('3', 'e' * 100)]
+    assert len(SQLManager.take_row_batch(rows, 0, 10, 250)) == 1
+    assert len(SQLManager.take_row_batch(rows, 1, 10, 350)) == 2
+
+
+# Another worker's rows, as they become visible to this one.
+def add_indexed_file(db, file_name: str, last_update):
+    db.pool.indexed_files.rows[file_name] = {'file_name': file_name, 'last_update': last_update}
+
+def test_indexed_files_read_incrementally_with_margin(db):
+    db.pool.indexed_files.now = 1000
+    assert db.write_file_names(['f1'])
+    assert db.get_indexed_pubmed_files() == {'f1'}
+    assert db.indexed_files_seen_until == 1000
+    # A transaction that started before f1 committed after it: its last_update is older than f1's, but
+    # still within INDEXED_FILES_MARGIN_SECONDS.
+    add_indexed_file(db, 'f2', 1000 - db_manager.INDEXED_FILES_MARGIN_SECONDS + 1)
+    add_indexed_file(db, 'f3', 1100)
+    # Only the full read sees rows older than the margin.
+    add_indexed_file(db, 'f0', 1000 - db_manager.INDEXED_FILES_MARGIN_SECONDS - 1)
+    assert db.get_indexed_pubmed_files() == {'f1', 'f2', 'f3'}
+    assert db.indexed_files_seen_until == 1100
+    assert db.write_file_names(['f4'])
+    assert db.get_indexed_pubmed_files() == {'f1', 'f2', 'f3', 'f4'}
+
+def test_indexed_files_without_last_update_keep_reading_in_full(db):
+    add_indexed_file(db, 'f1', None)
+    assert db.get_indexed_pubmed_files() == {'f1'}
+    assert db.indexed_files_seen_until is None
+    add_indexed_file(db, 'f0', None)
+    assert db.get_indexed_pubmed_files() == {'f0', 'f1'}
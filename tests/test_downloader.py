@@ -0,0 +1,159 @@
+import gzip
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import random
+import threading
+
+import pytest
+
+from downloader import GzDownloader
+
+# Random bytes, so the file stays big enough to be cut short and resumed.
+CONTENT = gzip.compress(random.Random(0).randbytes(200000))
+LISTING = b'<html><body><a href="../">../</a><a href="pubmed24n0001.xml.gz">x</a><a href="pubmed24n0001.xml.gz.md5">x</a></body></html>'
+
+
+class FakeNCBI(BaseHTTPRequestHandler):
+    '''
+    Serves a directory listing, one .gz and its .md5 from the `server` attributes set up by the fixture:
+    `truncate` cuts the next .gz response short, `wrong_md5` publishes a bad checksum, `ranges` is False
+    for a server that ignores Range headers. Every request is logged to `server.requests`.
+    '''
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get('Range'), self.headers.get('If-None-Match')))
+        if self.path == '/':
+            if self.headers.get('If-None-Match') == '"listing"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_body(200, LISTING, [('ETag', '"listing"')])
+        elif self.path == '/pubmed24n0001.xml.gz.md5':
+            digest = '0' * 32 if server.wrong_md5 else hashlib.md5(CONTENT).hexdigest()
+            self.send_body(200, f'MD5(pubmed24n0001.xml.gz)= {digest}\n'.encode())
+        elif self.path == '/pubmed24n0001.xml.gz':
+            range_header = self.headers.get('Range')
+            if range_header and server.ranges:
+                start = int(range_header[len('bytes='):].rstrip('-'))
+                if start >= len(CONTENT):
+                    self.send_body(416, b'')
+                    return
+                status, body = 206, CONTENT[start:]
+            else:
+                status, body = 200, CONTENT
+            if server.truncate:
+                # Promise the whole body but hang up halfway, like a dropped connection.
+                server.truncate = False
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body[:len(body) // 2])
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            self.send_body(status, body)
+        else:
+            self.send_body(404, b'')
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FakeNCBI)
+    httpd.requests, httpd.truncate, httpd.wrong_md5, httpd.ranges = [], False, False, True
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    httpd.url = f'http://127.0.0.1:{httpd.server_address[1]}/'
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def file_requests(server):
+    return [(path, range_header) for path, range_header, _ in server.requests if path.endswith('.gz')]
+
+
+def test_list_gz_files_reuses_listing_on_304(server):
+    downloader = GzDownloader(max_workers=1)
+    assert downloader.list_gz_files(server.url) == ['pubmed24n0001.xml.gz']
+    assert downloader.list_gz_files(server.url) == ['pubmed24n0001.xml.gz']
+    assert server.requests[-1] == ('/', None, '"listing"')
+
+
+def test_download_verifies_and_renames(server, tmp_path):
+    save_path = str(tmp_path / 'pubmed24n0001.xml.gz')
+    downloader = GzDownloader(max_workers=1, chunk_size=4096)
+    assert downloader.download(server.url + 'pubmed24n0001.xml.gz', save_path)
+    with open(save_path, 'rb') as f:
+        assert f.read() == CONTENT
+    assert not os.path.exists(save_path + GzDownloader.PART_SUFFIX)
+    totals = downloader.metrics.snapshot()['download']
+    assert (totals['samples'], totals['failures'], totals['bytes']) == (1, 0, len(CONTENT))
+
+
+def test_truncated_download_resumes_with_range(server, tmp_path):
+    server.truncate = True
+    save_path = str(tmp_path / 'pubmed24n0001.xml.gz')
+    downloader = GzDownloader(max_workers=1, chunk_size=4096)
+    assert downloader.download(server.url + 'pubmed24n0001.xml.gz', save_path)
+    with open(save_path, 'rb') as f:
+        assert f.read() == CONTENT
+
+    first, second = file_requests(server)
+    assert first == ('/pubmed24n0001.xml.gz', None)
+    assert second[1] is not None and 0 < int(second[1][len('bytes='):].rstrip('-')) < len(CONTENT)
+
+
+def test_partial_file_is_resumed(server, tmp_path):
+    save_path = str(tmp_path / 'pubmed24n0001.xml.gz')
+    with open(save_path + GzDownloader.PART_SUFFIX, 'wb') as f:
+        f.write(CONTENT[:1000])
+    assert GzDownloader(max_workers=1).download(server.url + 'pubmed24n0001.xml.gz', save_path)
+    assert file_requests(server) == [('/pubmed24n0001.xml.gz', 'bytes=1000-')]
+    with open(save_path, 'rb') as f:
+        assert f.read() == CONTENT
+
+
+def test_complete_partial_file_gets_416(server, tmp_path):
+    save_path = str(tmp_path / 'pubmed24n0001.xml.gz')
+    with open(save_path + GzDownloader.PART_SUFFIX, 'wb') as f:
+        f.write(CONTENT)
+    assert GzDownloader(max_workers=1).download(server.url + 'pubmed24n0001.xml.gz', save_path)
+    assert os.path.exists(save_path) and not os.path.exists(save_path + GzDownloader.PART_SUFFIX)
+
+
+def test_server_ignoring_range_starts_over(server, tmp_path):
+    server.ranges = False
+    save_path = str(tmp_path / 'pubmed24n0001.xml.gz')
+    with open(save_path + GzDownloader.PART_SUFFIX, 'wb') as f:
+        f.write(b'garbage')
+    assert GzDownloader(max_workers=1).download(server.url + 'pubmed24n0001.xml.gz', save_path)
+    with open(save_path, 'rb') as f:
+        assert f.read() == CONTENT
+
+
+def test_md5_mismatch_is_rejected(server, tmp_path):
+    server.wrong_md5 = True
+    save_path = str(tmp_path / 'pubmed24n0001.xml.gz')
+    downloader = GzDownloader(max_workers=1, max_retries=2)
+    assert not downloader.download(server.url + 'pubmed24n0001.xml.gz', save_path)
+    # Nothing shows up under the real name, and the bad part file isn't kept around to resume from.
+    assert os.listdir(tmp_path) == []
+    assert [range_header for _, range_header in file_requests(server)] == [None, None]
+    assert downloader.metrics.snapshot()['download']['failures'] == 1
+
+
+def test_download_all(server, tmp_path):
+    pairs = [(server.url + 'pubmed24n0001.xml.gz', str(tmp_path / f'copy{i}.xml.gz')) for i in range(3)]
+    assert GzDownloader(max_workers=3).download_all(pairs) == {save_path: True for _, save_path in pairs}
@@ -0,0 +1,157 @@
+import pytest
+
+from article import Article
+import elasticsearch_post
+from elasticsearch_post import ElasticPush
+from tests.fake_elasticsearch import fake_client
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(elasticsearch_post, 'BULK_RETRY_BACKOFF_SECONDS', 0.001)
+    monkeypatch.setattr(elasticsearch_post, 'BULK_RETRY_MAX_BACKOFF_SECONDS', 0.01)
+
+
+def articles(count: int, start: int = 1) -> list:
+    return [Article(str(pubmed_id), title=f'Title {pubmed_id}', pub_date='2024-01-02', version=101) for pubmed_id in range(start, start + count)]
+
+
+def push(chunk_size: int = 100, **fake) -> tuple:
+    es, node = fake_client(**fake)
+    return ElasticPush(es=es, chunk_size=chunk_size, thread_count=2), node
+
+
+def test_all_documents_succeed():
+    ep, node = push()
+    assert ep.bulk_index(articles(250)) == (250, 0)
+    assert sum(len(ids) for ids in node.bulk_requests) == 250
+    assert set(node.attempts.values()) == {1}
+
+
+def test_429_documents_are_retried():
+    ep, node = push(statuses={3: [429, 429, 201], 7: [429, 201]})
+    assert ep.bulk_index(articles(10)) == (10, 0)
+    assert (node.attempts['3'], node.attempts['7'], node.attempts['1']) == (3, 2, 1)
+    assert ep.limiter.overloads >= 1
+
+
+def test_other_document_errors_are_not_retried():
+    ep, node = push(statuses={2: [400], 4: [500], 6: [503]})
+    assert ep.bulk_index(articles(10)) == (7, 3)
+    assert set(node.attempts.values()) == {1}
+
+
+def test_retries_give_up_after_max_retries():
+    es, node = fake_client(statuses={5: [429]})
+    ep = ElasticPush(es=es, max_retries=2)
+    assert ep.bulk_index(articles(10)) == (9, 1)
+    assert node.attempts['5'] == 3
+
+
+def test_noop_statuses_count_as_success():
+    # 409: the index already has a newer version; 404 on a delete: nothing to delete.
+    ep, node = push(statuses={1: [409], 2: [404], 3: [409]})
+    records = [Article('1', version=101), Article.deleted_record('2', 101), Article.deleted_record('3', 101), Article('4', version=101)]
+    assert ep.bulk_index(records) == (4, 0)
+    assert set(node.attempts.values()) == {1}
+
+
+def test_404_on_index_is_a_failure():
+    ep, _ = push(statuses={1: [404]})
+    assert ep.bulk_index(articles(2)) == (1, 1)
+
+
+def test_rejected_request_is_retried_whole():
+    ep, node = push(chunk_size=100, request_statuses=[429, 503])
+    assert ep.bulk_index(articles(100)) == (100, 0)
+    # Rejected requests never reach the documents; each is then sent once, as its backoff comes due.
+    assert set(node.attempts.values()) == {1}
+    assert sorted(int(i) for ids in node.bulk_requests for i in ids) == list(range(1, 101))
+    assert ep.limiter.overloads == 2
+
+
+def test_failed_request_is_not_retried():
+    ep, node = push(chunk_size=100, request_statuses=[400])
+    assert ep.bulk_index(articles(100)) == (0, 100)
+    assert node.bulk_requests == []
+
+
+def test_bulk_insert_reports_failures():
+    assert push()[0].bulk_insert(articles(10))
+    assert not push(statuses={1: [400]})[0].bulk_insert(articles(10))
+
+
+def test_failed_documents_are_logged_and_returned(caplog):
+    ep, _ = push(statuses={3: [400], 5: [429]})
+    ep.max_retries = 1
+    failed = ep.insert_articles(articles(10))
+    assert [article.pubmed_id for article in failed] == ['3', '5']
+    errors = [record for record in caplog.records if record.levelname == 'ERROR' and 'documents failed' in record.getMessage()]
+    assert len(errors) == 1
+    message = errors[0].getMessage()
+    for expected in ("'_id': '3'", "'status': 400", 'mapper_parsing_exception', "'_id': '5'", "'status': 429", 'es_rejected_execution_exception'):
+        assert expected in message
+
+def test_failed_documents_past_the_first_few_are_logged_at_debug(caplog):
+    caplog.set_level('DEBUG', logger='medbrevia')
+    ep, _ = push(statuses={i: [400] for i in range(1, 9)})
+    assert ep.bulk_index(articles(10)) == (2, 8)
+    error = next(r for r in caplog.records if r.levelname == 'ERROR' and 'documents failed' in r.getMessage())
+    assert error.getMessage().count("'_id'") == elasticsearch_post.BULK_ERRORS_LOGGED
+    debug = next(r for r in caplog.records if r.levelname == 'DEBUG' and 'All failed documents' in r.getMessage())
+    assert debug.getMessage().count("'_id'") == 8
+
+def test_versions_are_external():
+    action = push()[0].generate_dict(Article('1', title='t', version=2401))
+    assert (action['_version'], action['_version_type']) == (2401, 'external_gte')
+
+
+def test_429s_shrink_the_bulk_requests():
+    ep, node = push(chunk_size=1000, statuses={1: [429, 201]})
+    assert ep.bulk_index(articles(6000)) == (6000, 0)
+    assert (ep.limiter.chunk_size, ep.limiter.concurrency) == (500, 1)
+    # At most three requests (two in flight, one waiting for a slot) were cut before the 429 came back;
+    # everything after follows the limiter's new size.
+    assert len(node.bulk_requests) > 3
+    assert all(len(ids) <= 500 for ids in node.bulk_requests[3:])
+
+
+def test_requests_are_cut_at_max_chunk_bytes():
+    es, node = fake_client()
+    ep = ElasticPush(es=es, chunk_size=1000, max_chunk_bytes=20000)
+    assert ep.bulk_index(articles(100)) == (100, 0)
+    assert len(node.bulk_requests) > 1
+
+
+def test_bulk_load_restores_the_original_settings():
+    ep, node = push(index_settings={'index.refresh_interval': '30s'}, index_meta={'owner': 'search'})
+    with ep.bulk_load():
+        assert node.index_settings == elasticsearch_post.BULK_LOAD_SETTINGS
+        assert node.index_meta == {'owner': 'search', elasticsearch_post.BULK_LOAD_MARKER: {
+            'index.refresh_interval': '30s', 'index.number_of_replicas': None}}
+    assert node.index_settings == {'index.refresh_interval': '30s'}
+    assert node.index_meta == {'owner': 'search'}
+
+# A run killed inside bulk_load() leaves its marker; the next run's startup check restores from it.
+def test_restore_uses_the_marker_of_a_crashed_bulk_load():
+    ep, node = push(index_settings={'index.number_of_replicas': '2'})
+    ep.set_bulk_load_marker(ep.get_index_settings(elasticsearch_post.BULK_LOAD_SETTINGS))
+    ep.es.indices.put_settings(index=ep.index_name, settings=elasticsearch_post.BULK_LOAD_SETTINGS)
+    assert ep.restore_bulk_load_settings()
+    assert node.index_settings == {'index.number_of_replicas': '2'}
+    assert node.index_meta == {}
+    assert not ep.restore_bulk_load_settings()
+
+def test_bulk_load_after_a_crash_keeps_the_saved_settings():
+    marker = {'index.refresh_interval': '5s', 'index.number_of_replicas': '1'}
+    ep, node = push(index_settings=elasticsearch_post.BULK_LOAD_SETTINGS, index_meta={elasticsearch_post.BULK_LOAD_MARKER: marker})
+    with ep.bulk_load():
+        pass
+    assert node.index_settings == marker
+    assert node.index_meta == {}
+
+# An index configured without refreshes and replicas on purpose carries no marker, and is left alone.
+def test_restore_leaves_an_index_without_the_marker_alone():
+    ep, node = push(index_settings=elasticsearch_post.BULK_LOAD_SETTINGS)
+    assert not ep.restore_bulk_load_settings()
+    assert node.index_settings == elasticsearch_post.BULK_LOAD_SETTINGS
@@ -0,0 +1,122 @@
+import time
+
+import pytest
+
+import db_manager
+from db_manager import SQLManager
+from lease import LeaseKeeper
+from tests.fake_mysql import FakePool
+
+FILE = 'pubmed24n0001.xml.gz'
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(db_manager.pooling, 'MySQLConnectionPool', FakePool)
+    return SQLManager({}, pool_size=2, create_tables=False)
+
+
+def lease(db, file_name: str = FILE) -> dict:
+    return db.pool.leases.rows[file_name]
+
+
+def test_claim_unclaimed_file(db):
+    assert db.claim_file(FILE, 'a', 60)
+    assert lease(db) == {'file_name': FILE, 'owner': 'a', 'status': 'claimed', 'lease_expires': 60, 'attempts': 1}
+
+def test_claim_fails_while_another_worker_holds_the_lease(db):
+    assert db.claim_file(FILE, 'a', 60)
+    db.pool.leases.now = 59
+    assert not db.claim_file(FILE, 'b', 60)
+    assert lease(db) == {'file_name': FILE, 'owner': 'a', 'status': 'claimed', 'lease_expires': 60, 'attempts': 1}
+
+def test_claim_takes_over_an_expired_lease(db):
+    assert db.claim_file(FILE, 'a', 60)
+    assert db.set_lease_status(FILE, 'a', 'db_done')
+    db.pool.leases.now = 61
+    assert db.claim_file(FILE, 'b', 60)
+    # The new owner starts the file over, on a fresh lease.
+    assert lease(db) == {'file_name': FILE, 'owner': 'b', 'status': 'claimed', 'lease_expires': 121, 'attempts': 2}
+    assert not db.set_lease_status(FILE, 'a', 'es_done')
+    assert lease(db)['status'] == 'claimed'
+
+def test_claim_by_the_holder_renews_the_lease(db):
+    assert db.claim_file(FILE, 'a', 60)
+    assert db.set_lease_status(FILE, 'a', 'parsed')
+    db.pool.leases.now = 30
+    assert db.claim_file(FILE, 'a', 60)
+    assert lease(db) == {'file_name': FILE, 'owner': 'a', 'status': 'parsed', 'lease_expires': 90, 'attempts': 1}
+
+@pytest.mark.parametrize('owner', ['a', 'b'])
+def test_finished_file_cannot_be_claimed(db, owner):
+    assert db.claim_file(FILE, 'a', 60)
+    assert db.write_file_names([FILE])
+    db.pool.leases.now = 1000
+    assert not db.claim_file(FILE, owner, 60)
+    assert lease(db) == {'file_name': FILE, 'owner': 'a', 'status': 'es_done', 'lease_expires': 60, 'attempts': 1}
+
+def test_claim_files_skips_live_leases_and_stops_at_the_limit(db):
+    names = [f'pubmed24n000{i}.xml.gz' for i in range(1, 6)]
+    assert db.claim_files(names[:2], 'b', 60) == names[:2]
+    assert db.claim_files(names, 'a', 60, limit=2) == names[2:4]
+    # A released lease is free for anyone straight away; the worker's own leases are claimed again (renewed).
+    db.release_leases([names[0]], 'b')
+    assert db.claim_files(names, 'a', 60) == [names[0]] + names[2:]
+
+def test_renew_returns_only_the_leases_still_held(db):
+    assert db.claim_files(['f1', 'f2', 'f3'], 'a', 60) == ['f1', 'f2', 'f3']
+    db.pool.leases.now = 61
+    assert db.claim_file('f2', 'b', 60)
+    assert db.write_file_names(['f3'])
+    assert db.renew_leases(['f1', 'f2', 'f3'], 'a', 60) == {'f1', 'f3'}
+    assert lease(db, 'f1')['lease_expires'] == 121
+    # A finished file's lease isn't pushed out.
+    assert lease(db, 'f3')['lease_expires'] == 60
+
+def test_heartbeat_marks_taken_over_files_lost(db):
+    keeper = LeaseKeeper(db, 'a', lease_seconds=60)
+    keeper.start = lambda: None
+    assert keeper.claim(['f1', 'f2']) == ['f1', 'f2']
+    db.pool.leases.now = 50
+    keeper.heartbeat()
+    assert lease(db, 'f1')['lease_expires'] == lease(db, 'f2')['lease_expires'] == 110
+    # The worker stalls past its lease, and another worker takes f2 over.
+    db.pool.leases.now = 111
+    assert db.claim_file('f2', 'b', 60)
+    keeper.heartbeat()
+    assert (keeper.held, keeper.lost) == ({'f1'}, {'f2'})
+    assert lease(db, 'f1')['lease_expires'] == 171
+    assert keeper.is_lost('f2') and not keeper.is_lost('f1')
+    # Claiming it back clears it from lost.
+    db.pool.leases.now = 200
+    assert keeper.claim(['f2']) == ['f2']
+    assert not keeper.is_lost('f2')
+
+def test_mark_after_takeover_loses_the_file(db):
+    keeper = LeaseKeeper(db, 'a', lease_seconds=60)
+    keeper.start = lambda: None
+    keeper.claim(['f1'])
+    db.pool.leases.now = 61
+    assert db.claim_file('f1', 'b', 60)
+    keeper.mark('f1', 'db_done')
+    assert keeper.is_lost('f1')
+    assert lease(db, 'f1')['status'] == 'claimed'
+
+# The heartbeat thread keeps a live worker's lease going, through a failed renewal, until it stops.
+def test_heartbeat_thread_keeps_the_lease_until_stopped(db):
+    db.pool.leases.clock = time.monotonic
+    db.pool.failures = [('UPDATE pubmed_file_leases SET lease_expires', 1205)]
+    keeper = LeaseKeeper(db, 'a', lease_seconds=0.6)
+    try:
+        assert keeper.claim([FILE]) == [FILE]
+        deadline = time.monotonic() + 1.5
+        while time.monotonic() < deadline:
+            assert not db.claim_file(FILE, 'b', 60)
+            time.sleep(0.05)
+        assert db.pool.failures == []
+    finally:
+        keeper.stop()
+    time.sleep(0.7)
+    assert db.claim_file(FILE, 'b', 60)
+    keeper.heartbeat()
+    assert keeper.is_lost(FILE)
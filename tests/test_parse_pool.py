@@ -0,0 +1,27 @@
+from article import Article
+import pubmed_load
+from parse_pool import ParsePool
+from pubmed_load import PubmedUpdate
+from tests.fake_writers import FakeDB, FakeElasticPush
+
+
+# Files come back in order, with no more than max_pending of them taken from the input ahead of the consumer.
+def test_imap_holds_at_most_max_pending_files():
+    taken = []
+    def file_names():
+        for i in range(10):
+            taken.append(i)
+            yield f'pubmed24n{i:04d}.xml.gz'
+
+    pool = ParsePool(max_workers=2)
+    assert pool.max_pending == 3
+    results = pool.imap(file_names(), load_cached=lambda file_name: [Article(file_name)])
+    for i, (file_name, articles) in enumerate(results):
+        assert articles[0].pubmed_id == file_name == f'pubmed24n{i:04d}.xml.gz'
+        assert len(taken) <= i + pool.max_pending
+
+def test_parse_max_pending_is_passed_on(monkeypatch):
+    monkeypatch.setattr(pubmed_load, 'SQLManager', FakeDB)
+    monkeypatch.setattr(pubmed_load, 'ElasticPush', FakeElasticPush)
+    assert PubmedUpdate(parse_workers=4).parse_pool.max_pending == 5
+    assert PubmedUpdate(parse_workers=4, parse_max_pending=2).parse_pool.max_pending == 2
@@ -0,0 +1,101 @@
+import os
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from article import Article
+from benchmarks.synthetic import write_pubmed_file
+from parse_xml import (get_file_version, get_record_version, iter_articles, parse_article, parse_article_by_search,
+                       parse_article_record, parse_file)
+
+# A hand-written update file: a full article, a minimal one with <PMID Version="2">, one with no pubmed date
+# (skipped), and a <DeleteCitation> that also deletes the first article.
+SAMPLE = os.path.join(os.path.dirname(__file__), 'data', 'pubmed24n1234.xml')
+
+
+def pmid(version: str = None) -> ET.Element:
+    elem = ET.Element('PMID', {'Version': version} if version is not None else {})
+    elem.text = '1'
+    return elem
+
+def pubmed_articles(path: str) -> list:
+    return ET.parse(path).getroot().findall('PubmedArticle')
+
+
+def test_file_version():
+    assert get_file_version('pubmed24n1234.xml.gz') == 241234
+    assert get_file_version('/data/updatefiles/pubmed25n0001.xml.gz') == 250001
+    # The next baseline sorts after every update file of the previous year.
+    assert get_file_version('pubmed25n0001.xml.gz') > get_file_version('pubmed24n1500.xml.gz')
+    assert get_file_version('articles.xml') == 0
+
+def test_record_version_tiebreak():
+    assert get_record_version(241234, pmid()) == 24123401
+    assert get_record_version(241234, pmid('2')) == 24123402
+    # Capped so the PMID version can never reach into the file version.
+    assert get_record_version(241234, pmid('250')) == 24123499 < get_record_version(241235, pmid())
+    assert get_record_version(241234, pmid('x')) == get_record_version(241234, None) == 24123401
+
+def test_single_pass_parser_matches_search():
+    elems = pubmed_articles(SAMPLE)
+    assert len(elems) == 3
+    for elem in elems:
+        assert parse_article(elem) == parse_article_by_search(elem)
+
+def test_single_pass_parser_matches_search_on_synthetic_file(tmp_path):
+    path = str(tmp_path / 'pubmed24n0001.xml')
+    write_pubmed_file(path, articles=200)
+    for elem in pubmed_articles(path):
+        assert parse_article(elem) == parse_article_by_search(elem)
+
+def test_parse_sample_article():
+    record = parse_article_record(pubmed_articles(SAMPLE)[0], 24123401)
+    assert record.pubmed_id == '101'
+    assert record.version == 24123401
+    # Inline markup is flattened, and the tail of the title doesn't leak in.
+    assert record.title == 'Effects of in vivo dosing on H2O uptake.'
+    assert record.abstract == 'Water is essential. Uptake rose by 102 fold (p < 0.05).'
+    # The DOI of the article, not of its references.
+    assert record.doi == '10.1000/test.101'
+    assert (record.pub_date, record.accepted_date) == ('2024-01-05', '2023-06-15')
+    # February 31st is clamped to the end of the month.
+    assert record.received_date == '2023-02-28'
+    assert [author.name for author in record.authors][:2] == ['Jane A Smith', 'Müller']
+    assert [(m.name, m.major_topic) for m in record.mesh_headings] == [('Water', True), ('Humans', False)]
+    assert [(k.name, k.major_topic) for k in record.keywords] == [('hydration', True), ('uptake', False)]
+    # A grant with no id, country or agency is left out.
+    assert [(g.grant_id, g.agency) for g in record.grants] == [('R01 GM000001', 'NIGMS NIH HHS'), ('', 'Wellcome Trust')]
+    assert (record.journal, record.nlm_unique_id) == ('Journal of Test Biology', '0001234')
+    assert list(record.pub_types) == ['Journal Article', 'Review']
+
+def test_article_without_pubmed_date_is_skipped():
+    elem = pubmed_articles(SAMPLE)[2]
+    assert parse_article_record(elem) is None
+    assert parse_article(elem) == parse_article_by_search(elem) == {}
+
+def test_iter_articles_versions_and_deletes():
+    records = list(iter_articles(SAMPLE, get_file_version(SAMPLE)))
+    assert [(a.pubmed_id, a.version, a.deleted) for a in records] == [
+        ('101', 24123401, False),
+        ('102', 24123402, False),
+        ('104', 24123401, True),
+        ('101', 24123403, True),
+    ]
+    assert records[2] == Article.deleted_record('104', 24123401)
+    assert records[2].to_dict() == {'pubmed_id': '104', 'deleted': True}
+    assert parse_file(SAMPLE) == records
+
+def test_iter_articles_keeps_xml():
+    records = list(iter_articles(SAMPLE, keep_xml=True))
+    article = records[0]
+    assert article.xml.startswith(b'<PubmedArticle>') and article.xml.endswith(b'</PubmedArticle>')
+    assert parse_article_record(ET.fromstring(article.xml), article.version) == article
+    assert all(record.xml is None for record in records if record.deleted)
+
+@pytest.mark.parametrize('name', ['pubmed24n1234.xml', 'pubmed24n1234.xml.gz'])
+def test_parse_file_plain_and_gzipped(tmp_path, name):
+    path = str(tmp_path / name)
+    write_pubmed_file(path, articles=20, deletes=3)
+    records = parse_file(path)
+    assert len([a for a in records if a.deleted]) == 3
+    assert {a.version // 100 for a in records} == {241234}
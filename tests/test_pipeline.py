@@ -0,0 +1,209 @@
+import gzip
+import os
+import threading
+import time
+
+import pytest
+
+import pubmed_load
+from pubmed_load import PubmedUpdate
+from tests.fake_writers import FakeDB, FakeElasticPush
+
+
+# Writes a PubMed file of `records`: (pmid, title) for an article, ('delete', pmid) for a deleted citation.
+def write_file(path: str, records) -> str:
+    articles, deletes = [], []
+    for first, second in records:
+        if first == 'delete':
+            deletes.append(f'<PMID Version="1">{second}</PMID>')
+            continue
+        articles.append(f'<PubmedArticle><MedlineCitation><PMID Version="1">{first}</PMID><Article><Journal><Title>J</Title></Journal>'
+                        f'<ArticleTitle>{second}</ArticleTitle></Article><MedlineJournalInfo><NlmUniqueID>1</NlmUniqueID>'
+                        f'</MedlineJournalInfo></MedlineCitation><PubmedData><History><PubMedPubDate PubStatus="pubmed">'
+                        f'<Year>2024</Year><Month>1</Month><Day>1</Day></PubMedPubDate></History></PubmedData></PubmedArticle>')
+    delete_xml = f"<DeleteCitation>{''.join(deletes)}</DeleteCitation>" if deletes else ''
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write(f"<?xml version='1.0' encoding='utf-8'?>\n<PubmedArticleSet>{''.join(articles)}{delete_xml}</PubmedArticleSet>\n")
+    return path
+
+@pytest.fixture
+def update(monkeypatch):
+    monkeypatch.setattr(pubmed_load, 'SQLManager', FakeDB)
+    monkeypatch.setattr(pubmed_load, 'ElasticPush', FakeElasticPush)
+    monkeypatch.setattr(pubmed_load, 'RETRY_BACKOFF_SECONDS', 0)
+    return PubmedUpdate(pipelined=True)
+
+# Runs the pipeline over files of `records_per_file`, named so each file's version is higher than the last.
+def run_files(update, tmp_path, records_per_file, first_number: int = 1):
+    file_names = [write_file(str(tmp_path / f'pubmed24n{first_number + i:04d}.xml.gz'), records)
+                  for i, records in enumerate(records_per_file)]
+    update.pipeline.run(file_names, '')
+    return file_names
+
+
+# File 2's hashes are still in flight (ES is slow) when the diff stage compares file 3 against them.
+@pytest.mark.parametrize('middle, last', [
+    ([('1', 'Changed')], [('1', 'Original')]),
+    ([('delete', '1')], [('1', 'Original')]),
+])
+def test_diff_sees_hashes_of_earlier_files_in_flight(tmp_path, update, middle, last):
+    run_files(update, tmp_path, [[('1', 'Original'), ('2', 'Other')]])
+    update.ep.delay = 0.2
+    file_names = run_files(update, tmp_path, [middle, last], first_number=2)
+    assert update.db.recorded_files[-2:] == file_names
+    assert update.db.rows['1'].title == update.ep.documents['1'].title == 'Original'
+    assert update.db.stored_hashes['1'][1] == update.db.rows['1'].version
+    assert update.pipeline.pending_hashes == {}
+
+def test_diff_skip_change_revert_and_older(tmp_path, update):
+    run_files(update, tmp_path, [[('1', 'Original'), ('2', 'Other')]], first_number=5)
+    pushed = len(update.ep.pushed)
+    # Skip: file 6 repeats file 5.
+    run_files(update, tmp_path, [[('1', 'Original'), ('2', 'Other')]], first_number=6)
+    assert len(update.ep.pushed) == pushed
+    assert update.pipeline.skipped_articles == 2
+    # Change, then revert in the next file.
+    run_files(update, tmp_path, [[('1', 'Changed')], [('1', 'Original')]], first_number=7)
+    assert [a.title for a in update.ep.pushed[pushed:]] == ['Changed', 'Original']
+    # Older: file 3 arrives late and is dropped.
+    run_files(update, tmp_path, [[('2', 'Ancient')]], first_number=3)
+    assert update.pipeline.skipped_articles == 1
+    assert update.db.rows['2'].title == update.ep.documents['2'].title == 'Other'
+
+# A failed file's hashes never get stored: the next file, which was compared against them, fails too, and
+# both go through again in the next run.
+def test_file_compared_against_failed_file_is_dropped(tmp_path, update):
+    run_files(update, tmp_path, [[('1', 'Original')]])
+    update.ep.fail_inserts = 2  # both attempts
+    update.ep.delay = 0.1
+    file_names = run_files(update, tmp_path, [[('1', 'Changed')], [('1', 'Changed')]], first_number=2)
+    assert update.pipeline.failed_files == set(file_names)
+    assert not set(file_names) & set(update.db.recorded_files)
+    assert update.pipeline.pending_hashes == {}
+
+    update.pipeline.run(file_names, '')
+    assert update.db.recorded_files[-2:] == file_names
+    assert update.ep.documents['1'].title == 'Changed'
+
+
+class FakeDownloader:
+    '''
+    Writes each file from `files` ({path: records}) after `delays[path]` seconds; paths in `failing` fail.
+    Tracks the most downloads that were running at once.
+    '''
+    def __init__(self, files: dict, delays: dict = None, failing=(), max_workers: int = 4):
+        self.files = files
+        self.delays = delays or {}
+        self.failing = set(failing)
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def download(self, url: str, path: str) -> bool:
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(self.delays.get(path, 0.0))
+            if path in self.failing:
+                return False
+            write_file(path, self.files[path])
+            return True
+        finally:
+            with self.lock:
+                self.running -= 1
+
+# {path: records} for `count` files of `articles_per_file` articles each, none written yet.
+def make_files(tmp_path, count: int, articles_per_file: int = 3) -> dict:
+    return {str(tmp_path / f'pubmed24n{i + 1:04d}.xml.gz'): [(str(i * 100 + j), f'Title {i} {j}') for j in range(articles_per_file)]
+            for i in range(count)}
+
+# Runs the pipeline in a thread so a hang fails the test instead of blocking it.
+def run_pipeline(update, file_names, timeout: float = 10.0):
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault('summary', update.pipeline.run(file_names, '')), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'pipeline did not shut down'
+    return result.get('summary')
+
+
+def test_stages_run_in_order_and_files_stay_in_sequence(tmp_path, update):
+    files = make_files(tmp_path, 6)
+    file_names = list(files)
+    # Later files finish downloading first.
+    update.downloader = FakeDownloader(files, delays={name: 0.05 * (len(files) - i) for i, name in enumerate(file_names)})
+    summary = run_pipeline(update, file_names)
+    assert [s['stage'] for s in summary] == ['download', 'parse', 'diff', 'mysql', 'elasticsearch', 'record']
+    assert update.db.recorded_files == file_names
+    assert 1 < update.downloader.max_running <= update.pipeline.queue_size
+    assert [a.pubmed_id for a in update.db.pushed] == [a.pubmed_id for a in update.ep.pushed] == [
+        pubmed_id for records in files.values() for pubmed_id, _ in records]
+    # Recorded files are removed.
+    assert not any(os.path.exists(name) for name in file_names)
+
+def test_queues_stay_bounded(tmp_path, update):
+    files = make_files(tmp_path, 4, articles_per_file=20)
+    update.downloader = FakeDownloader(files)
+    update.pipeline.batch_size = 1
+    update.ep.delay = 0.005
+    summary = run_pipeline(update, list(files))
+    assert all(s['max_queue_depth'] <= update.pipeline.queue_size for s in summary)
+    # The slow ES stage made the queue in front of it fill up (depth is sampled right after a get).
+    assert next(s for s in summary if s['stage'] == 'elasticsearch')['max_queue_depth'] == update.pipeline.queue_size - 1
+    assert update.db.recorded_files == list(files)
+
+# Wraps a FakeDB writer so calls carrying any of `pubmed_ids` (articles, or a {pubmed_id: ...} dict) fail.
+def fail_for(write, pubmed_ids):
+    def failing_write(records):
+        ids = records.keys() if isinstance(records, dict) else [article.pubmed_id for article in records]
+        return False if set(ids) & pubmed_ids else write(records)
+    return failing_write
+
+@pytest.mark.parametrize('stage', ['download', 'parse', 'mysql', 'elasticsearch', 'hashes'])
+def test_failed_file_is_not_recorded(tmp_path, update, stage):
+    files = make_files(tmp_path, 3)
+    file_names = list(files)
+    failing = file_names[1]
+    failing_ids = {pubmed_id for pubmed_id, _ in files[failing]}
+    update.downloader = FakeDownloader(files, failing=[failing] if stage == 'download' else [])
+    if stage == 'parse':
+        with open(failing, 'wb') as f:
+            f.write(b'not gzip')
+    elif stage == 'mysql':
+        update.db.push_pubmed_articles = fail_for(update.db.push_pubmed_articles, failing_ids)
+    elif stage == 'elasticsearch':
+        update.ep.failing_ids = failing_ids
+    elif stage == 'hashes':
+        update.db.write_content_hashes = fail_for(update.db.write_content_hashes, failing_ids)
+    run_pipeline(update, file_names)
+    assert update.pipeline.failed_files == {failing}
+    assert update.db.recorded_files == [file_names[0], file_names[2]]
+    # Left for the next run (a failed download never wrote it).
+    assert os.path.exists(failing) == (stage != 'download')
+    assert not failing_ids & set(update.db.stored_hashes)
+
+# Failures reported from several download threads at once all end up in failed_files.
+def test_concurrent_failures_are_all_kept(tmp_path, update):
+    files = make_files(tmp_path, 12)
+    failing = list(files)[::2]
+    update.downloader = FakeDownloader(files, delays={name: 0.02 for name in files}, failing=failing)
+    run_pipeline(update, list(files))
+    assert update.pipeline.failed_files == set(failing)
+    assert update.db.recorded_files == [name for name in files if name not in failing]
+
+# A stage that raises stops passing items on but keeps draining its input, so the stages before it never
+# block on a full queue and run() still returns.
+def test_pipeline_shuts_down_when_a_stage_raises(tmp_path, update):
+    files = make_files(tmp_path, 8)
+    update.downloader = FakeDownloader(files)
+    update.pipeline.batch_size = 1
+    def broken_push(articles, file_name):
+        raise RuntimeError('broken writer')
+    update.push_articles_to_db = broken_push
+    summary = run_pipeline(update, list(files))
+    assert update.db.recorded_files == []
+    assert next(s for s in summary if s['stage'] == 'mysql')['items'] == 0
+    assert next(s for s in summary if s['stage'] == 'parse')['items'] == 8 * 3
+    assert not any(thread.name.startswith('pipeline-') and thread.is_alive() for thread in threading.enumerate())
@@ -0,0 +1,117 @@
+import os
+import time
+
+import pytest
+
+from article import Article
+from elasticsearch_post import ElasticPush
+from benchmarks.synthetic import write_pubmed_file
+from parse_xml import latest_records, parse_file
+import pubmed_load
+from pubmed_load import PubmedUpdate
+from tests.fake_elasticsearch import fake_client
+from tests.fake_writers import FakeDB, FakeElasticPush
+
+
+def article(pubmed_id: str, version: int, title: str = 'Title') -> Article:
+    return Article(pubmed_id, title=title, pub_date='2024-01-01', journal='J', version=version)
+
+@pytest.fixture
+def update(monkeypatch):
+    monkeypatch.setattr(pubmed_load, 'SQLManager', FakeDB)
+    monkeypatch.setattr(pubmed_load, 'ElasticPush', FakeElasticPush)
+    return PubmedUpdate(pipelined=False)
+
+
+def test_latest_records():
+    first, newer, older = article('1', 5), article('1', 6), article('1', 4)
+    deleted = Article.deleted_record('2', 5)
+    assert latest_records([first, article('2', 5), newer, deleted, older]) == [newer, deleted]
+    # Same version: the later record wins.
+    assert latest_records([deleted, article('2', 5, 'Back')])[0].title == 'Back'
+
+def test_filter_keeps_one_record_per_pmid(update):
+    live, deleted = article('1', 5), Article.deleted_record('1', 5)
+    changed, content_hashes = update.filter_changed_articles([live, article('2', 5), deleted])
+    assert [a.pubmed_id for a in changed] == ['2', '1']
+    assert changed[1].deleted
+    assert set(content_hashes) == {'1', '2'}
+    changed, _ = update.filter_changed_articles([live, deleted], skip_unchanged=False)
+    assert changed == [deleted]
+
+# A file with both a <PubmedArticle> and a <DeleteCitation> for the same PMIDs, processed twice.
+def test_deleted_citation_stays_deleted_on_rerun(tmp_path, update):
+    path = str(tmp_path / 'pubmed24n0001.xml.gz')
+    write_pubmed_file(path, articles=200, deletes=20)
+    articles = parse_file(path)
+    deleted_ids = {a.pubmed_id for a in articles if a.deleted}
+    assert deleted_ids
+
+    for _ in range(2):
+        assert update.push_article_batches([articles], path)
+    assert not deleted_ids & set(update.db.rows)
+    assert not deleted_ids & set(update.ep.documents)
+    # The second run found nothing to write.
+    assert len(update.ep.pushed) == len(latest_records(articles))
+
+def test_filter_skip_change_revert_and_older(update):
+    original, changed = article('1', 5, 'Original'), article('1', 6, 'Changed')
+    assert update.push_article_batches([[original]], 'f1')
+    # Skip: same content again.
+    assert update.filter_changed_articles([article('1', 5, 'Original')])[0] == []
+    # Change: a newer version with new content.
+    assert update.filter_changed_articles([changed])[0] == [changed]
+    assert update.push_article_batches([[changed]], 'f2')
+    # Revert: a later file puts the original content back.
+    reverted = article('1', 7, 'Original')
+    assert update.filter_changed_articles([reverted])[0] == [reverted]
+    # Older: an out-of-order file with an earlier version is dropped, even if its content differs.
+    assert update.filter_changed_articles([article('1', 4, 'Ancient')])[0] == []
+    assert update.db.rows['1'].title == update.ep.documents['1'].title == 'Changed'
+
+# A document that fails (here a 400 on the first try) is sent again on its own, not with the whole batch.
+def test_elastic_retries_only_failed_documents(update):
+    es, node = fake_client(statuses={'3': [400, 201]})
+    update.ep = ElasticPush(es=es)
+    assert update.push_articles_to_elastic([article(str(i), 5) for i in range(1, 11)], 'f1')
+    assert sorted(node.bulk_requests[0], key=int) == [str(i) for i in range(1, 11)]
+    assert node.bulk_requests[1:] == [['3']]
+
+# Backdates the directory's mtime, so get_data_files() can trust a scan of it.
+def settle(path, age: float = 60):
+    os.utime(path, (time.time() - age, time.time() - age))
+
+@pytest.fixture
+def listdir_calls(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    calls = []
+    listdir = os.listdir
+    def counting_listdir(*args):
+        calls.append(args)
+        return listdir(*args)
+    monkeypatch.setattr(pubmed_load.os, 'listdir', counting_listdir)
+    return calls
+
+def test_data_files_rescanned_when_the_directory_changes(tmp_path, update, listdir_calls):
+    for name in ('pubmed24n0002.xml.gz', 'pubmed24n0001.xml.gz', 'pubmed24n0001.xml', 'notes.txt'):
+        (tmp_path / name).write_bytes(b'')
+    settle(tmp_path, 60)
+    assert update.get_data_files() == (['pubmed24n0001.xml.gz', 'pubmed24n0002.xml.gz'], ['pubmed24n0001.xml'])
+    assert update.get_data_files() == (['pubmed24n0001.xml.gz', 'pubmed24n0002.xml.gz'], ['pubmed24n0001.xml'])
+    assert len(listdir_calls) == 1
+
+    (tmp_path / 'pubmed24n0003.xml.gz').write_bytes(b'')
+    (tmp_path / 'pubmed24n0001.xml').unlink()
+    settle(tmp_path, 30)
+    assert update.get_data_files() == (['pubmed24n0001.xml.gz', 'pubmed24n0002.xml.gz', 'pubmed24n0003.xml.gz'], [])
+    assert len(listdir_calls) == 2
+
+# A file added in the same mtime step as the scan leaves the mtime where it was.
+def test_data_files_scan_of_a_fresh_directory_is_not_reused(tmp_path, update, listdir_calls):
+    (tmp_path / 'pubmed24n0001.xml.gz').write_bytes(b'')
+    mtime = os.stat(tmp_path).st_mtime_ns
+    assert update.get_data_files() == (['pubmed24n0001.xml.gz'], [])
+    (tmp_path / 'pubmed24n0002.xml.gz').write_bytes(b'')
+    os.utime(tmp_path, ns=(mtime, mtime))
+    assert update.get_data_files() == (['pubmed24n0001.xml.gz', 'pubmed24n0002.xml.gz'], [])
+    assert len(listdir_calls) == 2
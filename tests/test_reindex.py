@@ -0,0 +1,56 @@
+import json
+import os
+
+from article import Article
+from elasticsearch_post import ElasticPush
+from reindex import Reindexer
+from tests.fake_elasticsearch import fake_client
+
+
+class FakeArticleDB:
+    def __init__(self, pubmed_ids):
+        self.articles = {pubmed_id: Article(str(pubmed_id), title=f'Title {pubmed_id}', pub_date='2024-01-01', version=101)
+                         for pubmed_id in pubmed_ids}
+        self.reads = []
+
+    def get_pubmed_id_bounds(self):
+        return min(self.articles), max(self.articles)
+
+    def iter_articles_for_elasticsearch(self, after_pubmed_id: int, up_to_pubmed_id: int, page_size: int = 10000):
+        self.reads.append((after_pubmed_id, up_to_pubmed_id))
+        for pubmed_id in sorted(self.articles):
+            if after_pubmed_id < pubmed_id <= up_to_pubmed_id:
+                yield pubmed_id, self.articles[pubmed_id]
+
+
+def reindexer(db, es, checkpoint_file) -> Reindexer:
+    return Reindexer(db, ElasticPush(es=es, max_retries=1), checkpoint_file=checkpoint_file, partitions=2, page_size=5)
+
+
+def test_reindex_removes_checkpoint_when_every_document_made_it(tmp_path):
+    checkpoint_file = str(tmp_path / 'checkpoint.json')
+    es, node = fake_client()
+    summary = reindexer(FakeArticleDB(range(1, 21)), es, checkpoint_file).run()
+    assert (summary['docs_indexed'], summary['docs_failed']) == (20, 0)
+    assert sorted(int(doc_id) for request in node.bulk_requests for doc_id in request) == list(range(1, 21))
+    assert not os.path.exists(checkpoint_file)
+
+# Rejected documents keep the checkpoint, and the next run sends just the spans they were in.
+def test_reindex_keeps_checkpoint_for_failed_documents(tmp_path):
+    checkpoint_file = str(tmp_path / 'checkpoint.json')
+    db = FakeArticleDB(range(1, 21))
+    es, _ = fake_client(statuses={'3': [400], '4': [400], '17': [400]})
+    summary = reindexer(db, es, checkpoint_file).run()
+    assert (summary['docs_indexed'], summary['docs_failed']) == (17, 3)
+    with open(checkpoint_file) as f:
+        checkpoint = json.load(f)
+    assert [id_range.get('failed') for id_range in checkpoint['ranges']] == [[[2, 4]], [[16, 17]]]
+    assert all(id_range['done'] for id_range in checkpoint['ranges'])
+
+    db.reads.clear()
+    es, node = fake_client()
+    summary = reindexer(db, es, checkpoint_file).run()
+    assert (summary['docs_indexed'], summary['docs_failed']) == (3, 0)
+    assert sorted(db.reads) == [(2, 4), (16, 17)]
+    assert sorted(int(doc_id) for request in node.bulk_requests for doc_id in request) == [3, 4, 17]
+    assert not os.path.exists(checkpoint_file)
@@ -0,0 +1,100 @@
+import threading
+import time
+
+import pytest
+
+from throttle import AdaptiveLimiter, jittered_backoff
+
+
+def limiter(**kwargs) -> AdaptiveLimiter:
+    settings = dict(chunk_size=400, min_chunk_size=100, max_chunk_size=1000, step=100, concurrency=2,
+                    min_concurrency=1, max_concurrency=4, target_seconds=1.0, cooldown=60.0)
+    settings.update(kwargs)
+    return AdaptiveLimiter(**settings)
+
+
+@pytest.mark.parametrize('attempt', range(8))
+def test_jittered_backoff_stays_under_the_cap(attempt):
+    for _ in range(100):
+        assert 0 <= jittered_backoff(attempt, base=0.5, cap=10.0) <= min(10.0, 0.5 * 2 ** attempt)
+
+
+def test_chunk_size_is_clamped_to_steps():
+    assert limiter(chunk_size=450).chunk_size == 400
+    assert limiter(chunk_size=20).chunk_size == 100
+    assert limiter(chunk_size=5000).chunk_size == 1000
+    assert limiter(concurrency=10).concurrency == 4
+
+
+def test_fast_successes_grow_chunk_size_then_concurrency():
+    l = limiter()
+    for _ in range(6):
+        l.on_success(0.1)
+    assert (l.chunk_size, l.concurrency) == (1000, 2)
+    l.on_success(0.1)
+    assert l.concurrency == 2
+    l.on_success(0.1)
+    assert l.concurrency == 3
+    for _ in range(20):
+        l.on_success(0.1)
+    assert l.concurrency == 4
+
+
+def test_slow_request_halves_chunk_size_only():
+    l = limiter(chunk_size=800)
+    l.on_success(5.0)
+    assert (l.chunk_size, l.concurrency) == (400, 2)
+
+
+def test_overload_halves_both_once_per_cooldown():
+    l = limiter(chunk_size=800, concurrency=4)
+    l.on_overload('429')
+    assert (l.chunk_size, l.concurrency) == (400, 2)
+    # Other requests in flight report the same overload; they don't shrink it again.
+    l.on_overload('429')
+    l.on_success(5.0)
+    assert (l.chunk_size, l.concurrency, l.overloads) == (400, 2, 2)
+    # No growth during the cooldown either.
+    l.on_success(0.1)
+    assert l.chunk_size == 400
+
+
+def test_decreases_resume_after_cooldown():
+    l = limiter(chunk_size=800, concurrency=4, cooldown=0.0)
+    l.on_overload()
+    l.on_overload()
+    assert (l.chunk_size, l.concurrency) == (200, 1)
+    l.on_overload()
+    l.on_overload()
+    assert (l.chunk_size, l.concurrency) == (100, 1)
+
+
+def test_acquire_blocks_at_concurrency():
+    l = limiter(concurrency=1, max_concurrency=1)
+    l.acquire()
+    acquired = threading.Event()
+
+    def second():
+        l.acquire()
+        acquired.set()
+        l.release()
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not acquired.wait(0.1)
+    l.release()
+    assert acquired.wait(1.0)
+    thread.join()
+    assert l.snapshot()['in_flight'] == 0
+
+
+def test_growing_concurrency_wakes_a_waiter():
+    l = limiter(chunk_size=1000, concurrency=1, max_concurrency=2, cooldown=0.0)
+    l.acquire()
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (l.acquire(), acquired.set()))
+    thread.start()
+    time.sleep(0.05)
+    l.on_success(0.1)
+    assert acquired.wait(1.0)
+    thread.join()
@@ -0,0 +1,95 @@
+import random
+import threading
+import time
+
+from utils import Utils
+
+# Full-jitter exponential backoff: a random delay in [0, min(cap, base * 2**attempt)], so writers that
+# were turned away together don't all come back at the same moment.
+def jittered_backoff(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class AdaptiveLimiter:
+    '''
+    AIMD control of one writer's chunk size (documents or rows per request) and concurrency (requests in
+    flight, enforced by acquire()/release() across every thread sharing the limiter).
+
+    Each request that succeeds within `target_seconds` adds `step` to the chunk size; once the chunk size is
+    at its max, every `concurrency` such successes add one to the concurrency. A slow request halves the
+    chunk size; an overload (429, rejected execution, lock wait timeout, ...) halves both. Decreases happen at
+    most once per `cooldown` seconds, since the other requests in flight will report the same overload, and
+    there's no increase during a cooldown either. Chunk sizes stay multiples of `step`, so callers that cache
+    statements per size only ever see a handful of sizes.
+    '''
+    def __init__(self, chunk_size: int, min_chunk_size: int, max_chunk_size: int, step: int, concurrency: int = 1,
+                 min_concurrency: int = 1, max_concurrency: int = 1, target_seconds: float = 2.0, cooldown: float = 5.0,
+                 name: str = 'writer'):
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.step = step
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_seconds = target_seconds
+        self.cooldown = cooldown
+        self.name = name
+        self.chunk_size = self.clamp_chunk_size(chunk_size)
+        self.concurrency = min(max(concurrency, min_concurrency), max_concurrency)
+        self.in_flight = 0
+        self.fast_successes = 0
+        self.last_decrease = float('-inf')
+        self.overloads = 0
+        self.condition = threading.Condition()
+
+    def clamp_chunk_size(self, chunk_size: int) -> int:
+        chunk_size = (chunk_size // self.step) * self.step
+        return min(max(chunk_size, self.min_chunk_size), self.max_chunk_size)
+
+    # Blocks until fewer than `concurrency` requests are in flight.
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.concurrency:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def on_success(self, seconds: float):
+        with self.condition:
+            now = time.monotonic()
+            if seconds > self.target_seconds:
+                self.decrease(now, shrink_concurrency=False, reason=f'{seconds:.1f}s request')
+                return
+            if now - self.last_decrease < self.cooldown:
+                return
+            if self.chunk_size < self.max_chunk_size:
+                self.chunk_size = self.clamp_chunk_size(self.chunk_size + self.step)
+                return
+            self.fast_successes += 1
+            if self.fast_successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self.fast_successes = 0
+                self.condition.notify()
+
+    def on_overload(self, reason: str = 'overloaded'):
+        with self.condition:
+            self.overloads += 1
+            self.decrease(time.monotonic(), shrink_concurrency=True, reason=reason)
+
+    def decrease(self, now: float, shrink_concurrency: bool, reason: str):
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self.fast_successes = 0
+        self.chunk_size = self.clamp_chunk_size(self.chunk_size // 2)
+        if shrink_concurrency:
+            self.concurrency = max(self.concurrency // 2, self.min_concurrency)
+        Utils.print(f'{self.name} backing off ({reason}): chunk size {self.chunk_size}, concurrency {self.concurrency}')
+
+    def snapshot(self) -> dict:
+        with self.condition:
+            return {'chunk_size': self.chunk_size, 'concurrency': self.concurrency, 'in_flight': self.in_flight,
+                    'overloads': self.overloads}
@@ -1,4 +1,10 @@
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
 import pprint
+import queue
+import sys
 import time
 from functools import wraps
 
@@ -8,6 +14,12 @@ import pytz
 from pytz import timezone
 from termcolor import colored
 
+PST = timezone('US/Pacific')
+PST_DATE_FORMAT = '%m/%d/%Y %H:%M:%S %Z'
+
+# Level for the medbrevia logger, e.g. MEDBREVIA_LOG_LEVEL=DEBUG.
+LOG_LEVEL = os.environ.get('MEDBREVIA_LOG_LEVEL', 'INFO')
+
 def timeit(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
@@ -18,19 +30,85 @@ def timeit(func):
         return result
     return wrapper
 
+
+class LazyMessage:
+    '''
+    Utils.print()'s arguments, joined (and pretty-printed if they aren't strings) only when a handler
+    actually renders the record, so dropped or queued records cost no formatting on the caller's thread.
+    '''
+    __slots__ = ('args',)
+
+    def __init__(self, args):
+        self.args = args
+
+    def __str__(self):
+        return ' '.join(pprint.pformat(arg) if not isinstance(arg, str) else arg for arg in self.args)
+
+
+class PstFormatter(logging.Formatter):
+    def formatTime(self, record, datefmt=None):
+        return datetime.fromtimestamp(record.created, tz=PST).strftime(datefmt or PST_DATE_FORMAT)
+
+    def format(self, record):
+        message = record.getMessage()
+        color = getattr(record, 'color', None)
+        if color:
+            message = colored(message, color)
+        return f'[{self.formatTime(record)}] {message}'
+
+
+class DeferredQueueHandler(QueueHandler):
+    # The stock prepare() formats the record on the calling thread; the queue is in-process, so the
+    # record can go as-is and the listener thread does the formatting.
+    def prepare(self, record):
+        return record
+
+
+def setup_logger() -> logging.Logger:
+    '''
+    The 'medbrevia' logger: records go onto an unbounded in-process queue and a listener thread formats
+    them and writes them to stdout, so logging never blocks the thread that logs.
+    '''
+    logger = logging.getLogger('medbrevia')
+    if logger.handlers:
+        return logger
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(PstFormatter())
+    queue_handler = DeferredQueueHandler(queue.SimpleQueue())
+
+    def start_listener():
+        listener = QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+        listener.start()
+        # Drain whatever is still queued when the interpreter exits.
+        atexit.register(listener.stop)
+
+    def restart_in_child():
+        # A forked worker (e.g. ParsePool's) inherits the queue but not the listener thread.
+        queue_handler.queue = queue.SimpleQueue()
+        start_listener()
+
+    start_listener()
+    os.register_at_fork(after_in_child=restart_in_child)
+    logger.addHandler(queue_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    return logger
+
+logger = setup_logger()
+
+
 class Utils:
     @staticmethod
     def get_formatted_pst():
-        date_format = '%m/%d/%Y %H:%M:%S %Z'
-        date = datetime.now(tz=pytz.utc).astimezone(timezone('US/Pacific'))
-        return date.strftime(date_format)
+        return datetime.now(tz=pytz.utc).astimezone(PST).strftime(PST_DATE_FORMAT)
 
     '''
-    Prints with nicely-formatted string and color.
+    Logs with nicely-formatted string and color. `level` defaults to ERROR for red messages and INFO
+    otherwise; records below the logger's level are dropped before anything is formatted.
     '''
     @staticmethod
-    def print(*args, color=None):
-        formatted_string = ' '.join(pprint.pformat(arg) if not isinstance(arg, str) else arg for arg in args)
-        if color:
-            formatted_string = colored(formatted_string, color)
-        print('[{pst_time}] {formatted_string}'.format(pst_time=Utils.get_formatted_pst(), formatted_string=formatted_string))
+    def print(*args, color=None, level=None):
+        if level is None:
+            level = logging.ERROR if color == 'red' else logging.INFO
+        if logger.isEnabledFor(level):
+            logger.log(level, LazyMessage(args), extra={'color': color})